@@ -1,61 +1,357 @@
 #-----IMPORT OTHER NECESSARY MODULES-----#
 import datetime
 import queue
-from queue import Queue
 import os
+import time
+import contextlib
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-import statsmodels.api as sm 
+import statsmodels.api as sm
 #-----IMPORT BACKTESTING COMPONENTS-----#
 import event
-from broker import BasicBroker
-from data import AlpacaDataFrame
+from event import EventType, EventQueue
+from broker import BasicBroker, SimulatedBroker
+from data import AlpacaDataFrame, StreamingAlpacaDataFrame, widest_lookback
 from portfolio import SamplePortfolio
 from strategy import PortfolioSharpeMaximization
+from moments import MomentsRegistry
+from instrument import Instrumentation
+from walkforward import build_schedule
+from optimizer_cache import OptimizerCache
+from checkpoint import Checkpointer, config_fingerprint
 
-#---SET ASSETS TO BE TRADED AND LOCATION TO IMPORT ASSETS DATA---#
+#---DEFAULT BACKTEST CONFIGURATION---#
+# every key can be overridden in the config passed to run_backtest()
 
-symbols = ['SPY','MSFT','AAPL','AMZN','BRK.B','JNJ',
-           'JPM','GOOG','FB','GOOGL','XOM','BAC',
-           'UNH','V','PFE','PG','INTC','CVX','VZ','BA','T']
-csv_path = os.path.join(os.getcwd(),'database')
+DEFAULT_CONFIG = {
+    'symbols':['SPY','MSFT','AAPL','AMZN','BRK.B','JNJ',
+               'JPM','GOOG','FB','GOOGL','XOM','BAC',
+               'UNH','V','PFE','PG','INTC','CVX','VZ','BA','T'],
+    'csv_path':os.path.join(os.getcwd(),'database'),
+    'interval':'1D',
+    'warm_up':0.25, # percent of bars loaded as warm up bars (load_warm_up)
+    'update':None, # None = ask before updating the database (never with quiet), True/False = update/skip without asking
+    'feed':'memory', # 'memory' = AlpacaDataFrame, 'stream' = StreamingAlpacaDataFrame (csvs read in chunks)
+    'chunk_size':10000, # rows read per csv chunk by the streaming feed
+    'ledger_rows':None, # portfolio ledger rows held in memory, older ones spilled to disk (None = every row,
+                        # or chunk_size with the streaming feed so its memory stays bounded)
+    'initial_balance':100000.0,
+    'mode':'full', # PortfolioSharpeMaximization window, 'full' or 'tail'
+    'tail_count':None,
+    'allocations_pct':1,
+    'warm_start':True, # start each solve from the previous bar's weights
+    'batched':True, # one RebalanceEvent per bar (False = one SignalEvent -> OrderEvent -> FillEvent per trade)
+    'broker':'basic', # 'basic' = every order filled at the close, 'simulated' = SimulatedBroker (limit/stop orders)
+    'commission':None, # commission model of the simulated broker (broker.py), None = no commission
+    'slippage':None, # slippage model of the simulated broker, None = no slippage
+    'optimizer_cache':None, # folder of the optimizer cache shared across runs (optimizer_cache.py), None = off
+    'cache_exact':True, # only reuse results solved from the very same optimizer inputs
+    'checkpoint_dir':None, # folder the run is checkpointed into (checkpoint.py), None = no checkpoints
+    'checkpoint_every':1000, # bars between checkpoints
+    'resume':False, # resume from the latest checkpoint in checkpoint_dir, if there is one (False = start over,
+                    # removing the checkpoints already in the folder)
+    'walk_forward':False, # solve the strategy's weights for every bar ahead of the run (walkforward.py)
+    'workers':None, # processes used to build the walk-forward schedule, only with warm_start=False or
+                    # schedule_exact=False: a warm-started exact schedule is one chain, solved serially
+    'schedule_exact':True, # False = with warm_start, every worker's chunk starts cold (slightly different weights)
+    'quiet':False, # silence component prints (order logs, reports) during the run
+    'instrument':False, # time every component call and watch the event queue (instrument.py)
+    'trace_file':None, # where to export the instrumentation trace, if any
+}
 
-#---INITIALIZING COMPONENTS TO READY FOR BACKTEST---#
 
-Events = Queue()
+# keys a run's results (and checkpointed state) depend on: a checkpoint only resumes under the same ones
+RESULT_KEYS = ['symbols','interval','warm_up','feed','chunk_size','initial_balance','mode','tail_count',
+               'allocations_pct','warm_start','batched','broker','commission','slippage','walk_forward',
+               'schedule_exact','workers','cache_exact']
 
-DataFrame = AlpacaDataFrame(events = Events, csv_path = csv_path,
-                         symbols = symbols,interval='1D')
 
-Portfolio = SamplePortfolio(bars = DataFrame, events = Events)
-Strategy = PortfolioSharpeMaximization(bars = DataFrame, events = Events,
-                            portfolio = Portfolio)
-Broker = BasicBroker(events = Events)
+def run_backtest(config=None):
+    # builds every component from config, runs the event loop and returns the results:
+    #   'summary' -> compact dict of the run (used by sweep.py)
+    #   'portfolio_value' -> portfolio value over time (DataFrame)
+    config = quiet_config(dict(DEFAULT_CONFIG,**(config or {})))
+    start_time = time.perf_counter()
+    with open(os.devnull,'w') as devnull:
+        output = contextlib.redirect_stdout(devnull) if config['quiet'] else contextlib.nullcontext()
+        with output:
+            #---INITIALIZING COMPONENTS TO READY FOR BACKTEST---#
+            Events = EventQueue() # lock-free deque, the backtest runs on a single thread
+            DataFrame = build_feed(config,Events,stack_lookback(config))
+            Portfolio, Strategy, Broker = build_stack(config,DataFrame,Events)
+            optimizer_cache = Strategy.optimizer_cache
+            checkpoint = None
+            if config['checkpoint_dir'] is not None:
+                checkpoint = Checkpointer(config['checkpoint_dir'],DataFrame,Events,Portfolio,Strategy,Broker,
+                                          every = config['checkpoint_every'],
+                                          config_key = config_fingerprint(config,RESULT_KEYS))
+                if not config['resume'] or checkpoint.restore() is None:
+                    checkpoint.clear() # a fresh run never leaves an earlier run's checkpoints behind
 
+            instrumentation = None
+            if config['instrument']:
+                instrumentation = Instrumentation(trace_file = config['trace_file'])
 
-#--------START TRADING--------#
+            #--------START TRADING--------#
+            print('BACKTESTING IN PROGRESS...')
+            event_counts = run_event_loop(DataFrame,Events,Portfolio,Strategy,Broker,
+                                        instrumentation = instrumentation,checkpoint = checkpoint)
+            if checkpoint is not None:
+                checkpoint.close()
+                checkpoint.report()
+            Strategy.optimizer_report()
+            if config['broker'] == 'simulated':
+                Broker.report()
+            if optimizer_cache is not None:
+                optimizer_cache.evict()
+                optimizer_cache.report()
+            if instrumentation is not None:
+                instrumentation.summary()
+                instrumentation.export_trace()
+    run_time = time.perf_counter() - start_time
+    return {'summary':summarize_run(config,Portfolio,Strategy,event_counts,run_time),
+            'portfolio_value':Portfolio.portfolio_value,
+            'daily_value':Portfolio.daily_value() if config['interval'][-1].lower() != 'd' else None}
 
-print('BACKTESTING IN PROGRESS...')
-while True:
-    if DataFrame.continue_backtest == True:
-        DataFrame.update_bars()
+
+def quiet_config(config):
+    # with the output silenced the database update prompt could never be seen, so it is not asked
+    if config['quiet'] and config['update'] is None:
+        config['update'] = False
+    return config
+
+
+def stack_lookback(config):
+    # bars the strategy reads back: its tail window, or all of them (None)
+    return config['tail_count'] if config['mode'] == 'tail' else None
+
+
+def build_feed(config,Events,lookback=None):
+    # the dataframe every component reads bars from, putting its MarketEvents into Events
+    if config['feed'] == 'stream':
+        # the strategy's tail window bounds the bars kept in memory from the warm-up onwards
+        return StreamingAlpacaDataFrame(events = Events, csv_path = config['csv_path'],
+                            symbols = list(config['symbols']),interval=config['interval'],
+                            chunk_size = config['chunk_size'],lookback = lookback,
+                            warm_up = config['warm_up'],update = config['update'])
+    return AlpacaDataFrame(events = Events, csv_path = config['csv_path'],
+                            symbols = list(config['symbols']),interval=config['interval'],
+                            lookback = lookback,warm_up = config['warm_up'],update = config['update'])
+
+
+def build_stack(config,DataFrame,Events,moments=None,optimizer_cache=None,schedules=None):
+    # (Portfolio, Strategy, Broker) of one config over the dataframe, routing their events through Events
+    # moments (MomentsRegistry), optimizer_cache and schedules
+    # ({(mode, tail_count, warm_start, schedule_exact): schedule}) are shared between the stacks of run_multi_backtest
+    ledger_rows = config['ledger_rows']
+    if ledger_rows is None and config['feed'] == 'stream':
+        ledger_rows = config['chunk_size']
+    Portfolio = SamplePortfolio(bars = DataFrame, events = Events,
+                            initial_balance = config['initial_balance'],ledger_rows = ledger_rows)
+    schedule = None
+    if config['walk_forward']:
+        key = (config['mode'],config['tail_count'],config['warm_start'],config['schedule_exact'])
+        if schedules is not None and key in schedules:
+            schedule = schedules[key]
+        else:
+            schedule = build_schedule(DataFrame,mode = config['mode'],tail_count = config['tail_count'],
+                                warm_start = config['warm_start'],workers = config['workers'],
+                                exact = config['schedule_exact'])
+            if schedules is not None:
+                schedules[key] = schedule
+    if optimizer_cache is None and config['optimizer_cache'] is not None:
+        optimizer_cache = OptimizerCache(config['optimizer_cache'],exact = config['cache_exact'])
+    Strategy = PortfolioSharpeMaximization(bars = DataFrame, events = Events,
+                            portfolio = Portfolio, mode = config['mode'],
+                            tail_count = config['tail_count'],
+                            allocations_pct = config['allocations_pct'],
+                            warm_start = config['warm_start'],schedule = schedule,
+                            batched = config['batched'],optimizer_cache = optimizer_cache,
+                            moments = moments)
+    if config['broker'] == 'simulated':
+        Broker = SimulatedBroker(bars = DataFrame, events = Events,
+                            commission = config['commission'],slippage = config['slippage'])
     else:
-        break
-    while True:
-        try:
-            event = Events.get(False)
-        except queue.Empty:
-            break
-        
-        if event is not None:
-            if event.type == 'MARKET':
-                Portfolio.update_holdings(event) 
-                Strategy.calculate_signals(event)
-            elif event.type == 'SIGNAL':
-                Portfolio.update_signal(event)
-            elif event.type == 'ORDER':
-                Broker.execute_order(event)
-            elif event.type == 'FILL':
-                Portfolio.update_portfolio(event)
+        Broker = BasicBroker(events = Events)
+    return Portfolio, Strategy, Broker
+
+
+def build_handlers(Portfolio,Strategy,Broker):
+    # handler registry: event type -> component methods called (in order) for every event of that type
+    return {EventType.MARKET:(Portfolio.update_holdings,Broker.check_orders,Strategy.calculate_signals),
+            EventType.SIGNAL:(Portfolio.update_signal,),
+            EventType.ORDER:(Broker.execute_order,),
+            EventType.FILL:(Portfolio.update_portfolio,),
+            EventType.REBALANCE:(Portfolio.update_signal,),
+            EventType.BATCH_ORDER:(Broker.execute_order,),
+            EventType.BATCH_FILL:(Portfolio.update_portfolio,)}
+
+
+# raised by popleft (EventQueue, deque) and get_nowait (queue.Queue) once the queue is empty
+EMPTY = (IndexError, queue.Empty)
+
+
+def run_event_loop(DataFrame,Events,Portfolio,Strategy,Broker,handlers=None,instrumentation=None,checkpoint=None):
+    # OUTER LOOP: update bars onto the dataframe, which places a MarketEvent into the queue
+    # INNER LOOP: pop every queued event and hand it to the handlers registered for its type,
+    #             until the queue is empty, then update more bars
+    # with a checkpoint (checkpoint.Checkpointer) the state is saved every `every` bars, between two bars
+    # with an instrumentation (instrument.py) every call of this same loop is timed and the queue watched
+    # Events can be an EventQueue (or deque) or a queue.Queue
+    # returns the number of events processed by type
+    if handlers is None:
+        handlers = build_handlers(Portfolio,Strategy,Broker)
+    update_bars = DataFrame.update_bars
+    popleft = Events.popleft if hasattr(Events,'popleft') else Events.get_nowait
+    after_bar = [checkpoint.tick] if checkpoint is not None else [] # called once every event of a bar was handled
+    if instrumentation is not None:
+        update_bars, popleft, handlers, after_bar = instrumentation.wrap_loop(update_bars,popleft,handlers,
+                                                                              after_bar,Events)
+    event_counts = dict.fromkeys(handlers,0)
+    while DataFrame.continue_backtest:
+        update_bars()
+        while True:
+            try:
+                event = popleft()
+            except EMPTY:
+                break
+            event_type = event.type
+            event_counts[event_type] += 1
+            for handler in handlers[event_type]:
+                handler(event)
+        for hook in after_bar:
+            hook()
+    if instrumentation is not None:
+        instrumentation.finish_loop(event_counts)
+    return event_counts
+
+
+#---MULTI-STRATEGY BACKTEST---#
+# keys every stack of run_multi_backtest shares: the feed and the caches built around it
+SHARED_KEYS = ['symbols','csv_path','interval','warm_up','update','feed','chunk_size',
+               'optimizer_cache','cache_exact','quiet']
+# keys only run_backtest supports (instrumentation and checkpoints follow a single stack), with their defaults
+SINGLE_RUN_KEYS = {'instrument':False,'trace_file':None,'checkpoint_dir':None,'resume':False}
+
+
+def run_multi_backtest(stacks,config=None):
+    # one feed drives several (Portfolio, Strategy, Broker) stacks in the same pass over the bars
+    #   stacks -> {name: config overrides of that stack}, config -> base config of every stack and of the feed
+    # the csvs are parsed once, and the return moments (MomentsRegistry), optimizer results (OptimizerCache,
+    # in memory without an 'optimizer_cache' folder) and walk-forward schedules are computed once and
+    # reused by every stack asking for the same ones
+    # returns {name: results of that stack, same as run_backtest}, the summary's run_time is the time spent
+    # in that stack's handlers and total_time the whole run
+    base = quiet_config(dict(DEFAULT_CONFIG,**(config or {})))
+    configs = {}
+    for name,overrides in stacks.items():
+        shared = [k for k in SHARED_KEYS if k in overrides and overrides[k] != base[k]]
+        if len(shared) > 0:
+            raise ValueError('stack '+str(name)+' overrides keys shared by every stack: '+', '.join(shared))
+        configs[name] = dict(base,**overrides)
+        single = [k for k,v in SINGLE_RUN_KEYS.items() if configs[name][k] != v]
+        if len(single) > 0:
+            raise ValueError('stack '+str(name)+' sets keys only run_backtest supports: '+', '.join(single))
+    start_time = time.perf_counter()
+    with open(os.devnull,'w') as devnull:
+        output = contextlib.redirect_stdout(devnull) if base['quiet'] else contextlib.nullcontext()
+        with output:
+            #---ONE FEED, SHARED STATISTICS---#
+            FeedEvents = EventQueue()
+            lookbacks = [stack_lookback(c) for c in configs.values()]
+            lookback = lookbacks[0] if len(lookbacks) > 0 else None
+            for l in lookbacks[1:]:
+                lookback = widest_lookback(lookback,l)
+            DataFrame = build_feed(base,FeedEvents,lookback)
+            DataFrame.shared = True # the strategies' set_lookback keep the widest one
+            moments = MomentsRegistry(DataFrame)
+            optimizer_cache = OptimizerCache(base['optimizer_cache'],exact = base['cache_exact'])
+            schedules = {}
+            #---ONE EVENT QUEUE PER STACK---#
+            components = {}
+            for name,c in configs.items():
+                Events = EventQueue()
+                Portfolio, Strategy, Broker = build_stack(c,DataFrame,Events,moments,optimizer_cache,schedules)
+                components[name] = (Events,Portfolio,Strategy,Broker)
+
+            #--------START TRADING--------#
+            print('BACKTESTING',len(components),'STRATEGIES IN PROGRESS...')
+            event_counts, handler_time = run_stacks_loop(DataFrame,FeedEvents,components)
+            for name,(Events,Portfolio,Strategy,Broker) in components.items():
+                print('<<-------|',name,'|------->>')
+                Strategy.optimizer_report()
+                if configs[name]['broker'] == 'simulated':
+                    Broker.report()
+            print('Shared Moment Estimators:',len(moments),' Walk-Forward Schedules:',len(schedules))
+            if base['optimizer_cache'] is not None:
+                optimizer_cache.evict()
+            optimizer_cache.report()
+    run_time = time.perf_counter() - start_time
+    results = {}
+    for name,(Events,Portfolio,Strategy,Broker) in components.items():
+        c = configs[name]
+        summary = summarize_run(c,Portfolio,Strategy,event_counts[name],handler_time[name])
+        summary['total_time'] = run_time
+        results[name] = {'summary':summary,
+                         'portfolio_value':Portfolio.portfolio_value,
+                         'daily_value':Portfolio.daily_value() if c['interval'][-1].lower() != 'd' else None}
+    return results
+
+
+def run_stacks_loop(DataFrame,FeedEvents,components):
+    # OUTER LOOP: update bars onto the shared dataframe, which places a MarketEvent into FeedEvents
+    # INNER LOOP: every stack in turn gets the MarketEvent in its own queue and handles its events
+    #             until that queue is empty
+    # returns ({name: number of events processed by type}, {name: seconds spent in its handlers})
+    routes = []
+    event_counts = {}
+    handler_time = [0.0]*len(components)
+    for k,(name,(Events,Portfolio,Strategy,Broker)) in enumerate(components.items()):
+        handlers = build_handlers(Portfolio,Strategy,Broker)
+        event_counts[name] = dict.fromkeys(handlers,0)
+        routes.append((k,Events,handlers,event_counts[name]))
+    popleft = FeedEvents.popleft
+    perf_counter = time.perf_counter
+    while DataFrame.continue_backtest:
+        DataFrame.update_bars()
+        while FeedEvents:
+            market_event = popleft()
+            for k,Events,handlers,counts in routes:
+                start = perf_counter()
+                Events.put(market_event)
+                while Events:
+                    event = Events.popleft()
+                    counts[event.type] += 1
+                    for handler in handlers[event.type]:
+                        handler(event)
+                handler_time[k] += perf_counter() - start
+    return event_counts, dict(zip(components,handler_time))
+
+
+def summarize_run(config,portfolio,strategy,event_counts,run_time):
+    # compact per-run summary, cheap to send back from sweep workers
+    total_value = np.array(portfolio.ledger.read('total'))
+    returns = total_value[1:]/total_value[:-1] - 1
+    drawdown = 1 - total_value/np.maximum.accumulate(total_value)
+    solves = max(strategy.solver_stats['solves'],1)
+    return {'symbols':','.join(config['symbols']),
+            'interval':config['interval'],
+            'warm_up':config['warm_up'],
+            'mode':config['mode'],
+            'tail_count':config['tail_count'],
+            'allocations_pct':config['allocations_pct'],
+            'bars':len(total_value),
+            'fills':portfolio.fill_count,
+            'final_value':float(total_value[-1]),
+            'total_return':float(total_value[-1]/total_value[0] - 1),
+            'sharpe':float(np.mean(returns)/np.std(returns)) if len(returns) > 1 and np.std(returns) > 0 else np.nan,
+            'max_drawdown':float(np.max(drawdown)),
+            'avg_solve_time':strategy.solver_stats['solve_time']/solves,
+            'cache_hit_rate':strategy.optimizer_cache.hit_rate if strategy.optimizer_cache is not None else np.nan,
+            'run_time':run_time}
+
 
+if __name__ == '__main__':
+    results = run_backtest()
+    print(pd.Series(results['summary']))
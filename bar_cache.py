@@ -0,0 +1,134 @@
+import os, os.path
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+from cache_files import atomic_write
+
+
+# ------------------------------------------------------------------------------------------------------
+# BINARY BAR CACHE
+# each database csv is compiled once into a compact columnar file that later runs memory-map directly:
+#   [header][int64 stamps (epoch ns)][float64 open][float64 high][float64 low][float64 close][float64 volume]
+# the header records the source csv's mtime and size, a stale entry is rebuilt automatically
+# ------------------------------------------------------------------------------------------------------
+
+MAGIC = b'BARCACHE'
+VERSION = 1
+HEADER = np.dtype([('magic','S8'),('version','<u4'),('n_fields','<u4'),('n_rows','<u8'),
+                   ('mtime_ns','<i8'),('size','<i8'),('reserved','<u8',3)])
+FIELDS = ['open','high','low','close','volume']
+CACHE_FOLDER = '.cache'
+NS_PER_DAY = 86400*10**9 # stamps are epoch ns, stamp // NS_PER_DAY = day number
+
+
+def source_fingerprint(csv_file):
+    # (absolute path, mtime in ns, size in bytes) of a source csv
+    stat = os.stat(csv_file)
+    return os.path.abspath(csv_file), stat.st_mtime_ns, stat.st_size
+
+def cache_path(csv_file, cache_dir=None):
+    # cache entries live next to the csv folder, keyed by the source's absolute path
+    csv_file = os.path.abspath(csv_file)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(csv_file),CACHE_FOLDER)
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    key = hashlib.sha1(csv_file.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir,'{name}_{key}.bars'.format(name=name,key=key))
+
+def read_header(cache_file):
+    try:
+        header = np.fromfile(cache_file,dtype=HEADER,count=1)
+    except (OSError, ValueError):
+        return None
+    if len(header) == 0 or header['magic'][0] != MAGIC or header['version'][0] != VERSION:
+        return None
+    return header[0]
+
+def is_fresh(csv_file, cache_file):
+    header = read_header(cache_file)
+    if header is None:
+        return False
+    path, mtime_ns, size = source_fingerprint(csv_file)
+    return (header['mtime_ns'] == mtime_ns) and (header['size'] == size)
+
+def build_cache(csv_file, cache_file=None):
+    # parse the csv once (same cleanup as AlpacaDataFrame.initialize_df) and write the binary columns
+    if cache_file is None:
+        cache_file = cache_path(csv_file)
+    path, mtime_ns, size = source_fingerprint(csv_file)
+    data = pd.read_csv(csv_file,header=0,index_col=0)
+    data = data.iloc[:,:len(FIELDS)]
+    data.columns = FIELDS
+    stamps = pd.to_datetime(data.index).values.astype('datetime64[ns]').astype(np.int64)
+    order = np.argsort(stamps,kind='stable') # make sure it's monotonic
+    stamps = stamps[order]
+    columns = data.to_numpy(dtype=np.float64)[order].T
+    header = np.zeros(1,dtype=HEADER)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['n_fields'] = len(FIELDS)
+    header['n_rows'] = len(stamps)
+    header['mtime_ns'] = mtime_ns
+    header['size'] = size
+    def write(f):
+        f.write(header.tobytes())
+        f.write(np.ascontiguousarray(stamps).tobytes())
+        f.write(np.ascontiguousarray(columns).tobytes())
+    atomic_write(cache_file,write)
+    return cache_file
+
+def load_bars(csv_file, cache_dir=None):
+    # returns (stamps, columns) memory-mapped from the cache:
+    #   stamps  -> int64 epoch nanoseconds, shape (n,)
+    #   columns -> float64 open/high/low/close/volume, shape (5, n)
+    cache_file = cache_path(csv_file,cache_dir)
+    if not is_fresh(csv_file,cache_file):
+        build_cache(csv_file,cache_file)
+    header = read_header(cache_file)
+    n_rows = int(header['n_rows'])
+    n_fields = int(header['n_fields'])
+    if n_rows == 0:
+        return np.zeros(0,dtype=np.int64), np.zeros((n_fields,0),dtype=np.float64)
+    stamps = np.memmap(cache_file,dtype=np.int64,mode='r',offset=HEADER.itemsize,shape=(n_rows,))
+    columns = np.memmap(cache_file,dtype=np.float64,mode='r',
+                        offset=HEADER.itemsize+8*n_rows,shape=(n_fields,n_rows))
+    return stamps, columns
+
+def stamps_to_index(stamps, daily=False):
+    # int64 epoch ns -> the string stamps used across the engine ('YYYY-mm-dd' or 'YYYY-mm-dd HH:MM:SS')
+    stamps = np.asarray(stamps).view('datetime64[ns]')
+    if daily:
+        return pd.Index(np.datetime_as_string(stamps,unit='D'))
+    strings = np.datetime_as_string(stamps,unit='s') # 'YYYY-mm-ddTHH:MM:SS', 'NaT' for missing stamps
+    if len(strings) > 0 and strings.dtype.itemsize >= 4*11:
+        # 'T' -> ' ' in place, only where the 11th character is that 'T' (not 'NaT' or years past 9999)
+        chars = strings.view(np.uint32).reshape(len(strings),-1)
+        chars[chars[:,10] == ord('T'),10] = ord(' ')
+    return pd.Index(strings)
+
+def warm_cache(csv_path, symbols, cache_dir=None):
+    # pre-build the cache for a list of symbols in one interval folder
+    for s in symbols:
+        csv_file = os.path.join(csv_path,'{file_name}.{file_extension}'.format(file_name=s,file_extension='csv'))
+        if not os.path.exists(csv_file):
+            print(s+'\'s OHLCV data not found in database. Skipping...')
+            continue
+        cache_file = cache_path(csv_file,cache_dir)
+        if is_fresh(csv_file,cache_file):
+            print(s+'\'s cache is up to date.')
+        else:
+            build_cache(csv_file,cache_file)
+            print(s+'\'s cache built -> '+cache_file)
+
+
+if __name__ == '__main__':
+    # python bar_cache.py --interval 1D SPY MSFT AAPL
+    parser = argparse.ArgumentParser(description='Pre-warm the binary bar cache for a list of symbols')
+    parser.add_argument('symbols',nargs='+')
+    parser.add_argument('--csv_path',default=os.path.join(os.getcwd(),'database'))
+    parser.add_argument('--interval',default='1D')
+    parser.add_argument('--cache_dir',default=None)
+    args = parser.parse_args()
+    warm_cache(os.path.join(args.csv_path,args.interval.lower()),args.symbols,args.cache_dir)
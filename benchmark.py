@@ -0,0 +1,401 @@
+import os, os.path
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+import event
+from broker import BasicBroker
+from backtest import run_event_loop
+from bar_cache import stamps_to_index
+
+
+# ------------------------------------------------------------------------------------------------------
+# BENCHMARK SUITE
+# times the engine's hot paths on synthetic OHLCV panels, one stage at a time.
+# every stage runs in its own process so its peak memory can be measured on its own.
+#
+#   python benchmark.py --sizes 10x10000 200x100000 --output bench.json
+#   python benchmark.py --sizes 10x10000 200x100000 --compare bench.json
+#   python benchmark.py --results new.json --compare bench.json
+# ------------------------------------------------------------------------------------------------------
+
+STAGES = ['initialize_df_cold','initialize_df','load_warm_up','update_bars','update_holdings',
+          'update_portfolio','calculate_signals','add_data','add_data_online','full_loop','event_loop']
+
+DEFAULTS = {'interval':'1Min',
+            'source':'csv', # 'csv' = database/<interval>/<SYMBOL>.csv layout, 'memory' = in-memory frames
+            'warm_up':0.25,
+            'signal_bars':200, # bars timed for calculate_signals / full_loop (the optimizer is slow)
+            'periods':[10,20], # add_data periods
+            'workers':None, # add_data process pool size, None = serial
+            'seed':0}
+
+
+#---------------------------------SYNTHETIC DATA--------------------------------#
+
+def generate_stamps(n_bars, interval='1Min', start='2010-01-04'):
+    # int64 epoch ns stamps: business days, and 9:30-15:59 minutes for intraday intervals
+    if interval[-1].upper() == 'D':
+        return pd.bdate_range(start,periods=n_bars).values.astype(np.int64)
+    step = pd.Timedelta(interval).value
+    per_day = int(pd.Timedelta('390Min').value//step)
+    days = pd.bdate_range(start,periods=int(np.ceil(n_bars/per_day))).values.astype(np.int64)
+    offsets = pd.Timedelta('9h30min').value + step*np.arange(per_day)
+    return (days[:,None] + offsets[None,:]).ravel()[:n_bars]
+
+def generate_panel(n_symbols, n_bars, interval='1Min', seed=0):
+    # random walk OHLCV frames ({symbol: DataFrame}) indexed by the engine's string stamps
+    rng = np.random.default_rng(seed)
+    index = stamps_to_index(generate_stamps(n_bars,interval),daily=(interval[-1].upper() == 'D'))
+    drift = rng.normal(0.0,1e-5,n_symbols)
+    vol = rng.uniform(5e-4,2e-3,n_symbols)
+    closes = 100*np.exp(np.cumsum(rng.normal(drift,vol,(n_bars,n_symbols)),axis=0))
+    opens = closes*np.exp(rng.normal(0.0,vol/2,(n_bars,n_symbols)))
+    highs = np.maximum(opens,closes)*np.exp(np.abs(rng.normal(0.0,vol/2,(n_bars,n_symbols))))
+    lows = np.minimum(opens,closes)*np.exp(-np.abs(rng.normal(0.0,vol/2,(n_bars,n_symbols))))
+    volumes = rng.integers(100,100000,(n_bars,n_symbols)).astype(np.float64)
+    panel = {}
+    for j in range(n_symbols):
+        panel['SYN'+str(j)] = pd.DataFrame({'open':opens[:,j],'high':highs[:,j],'low':lows[:,j],
+                                           'close':closes[:,j],'volume':volumes[:,j]},index=index)
+    return panel
+
+def write_panel(panel, csv_path, interval='1Min'):
+    # same layout and headers as the csvs written by AlpacaDataFrame.update_database
+    folder = os.path.join(csv_path,interval.lower())
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for s,df in panel.items():
+        out = df.copy()
+        out.columns = ['1. open','2. high','3. low','4. close','5. volume']
+        out.index.name = 'date'
+        out.to_csv(os.path.join(folder,'{file_name}.{file_extension}'.format(file_name=s,file_extension='csv')))
+    return csv_path
+
+
+#---------------------------------STAGES--------------------------------#
+
+def build_frame(params, warm_up=None):
+    from data import AlpacaDataFrame
+    Events = event.EventQueue()
+    symbols = ['SYN'+str(j) for j in range(params['symbols'])]
+    warm_up = params['warm_up'] if warm_up is None else warm_up
+    if params['source'] == 'memory':
+        panel = generate_panel(params['symbols'],params['bars'],params['interval'],params['seed'])
+        return AlpacaDataFrame(events = Events, csv_path = '', symbols = symbols, interval = params['interval'],
+                            warm_up = warm_up, symbol_data = panel)
+    return AlpacaDataFrame(events = Events, csv_path = params['csv_path'], symbols = symbols,
+                        interval = params['interval'], warm_up = warm_up, update = False)
+
+def timed_bars(DataFrame, step):
+    # advance the cursor bar by bar to the end, calling step() after each update
+    # returns (seconds, bars)
+    start_bar = DataFrame.cursor
+    start = time.perf_counter()
+    while DataFrame.continue_backtest:
+        DataFrame.update_bars()
+        DataFrame.events.clear()
+        step()
+    return time.perf_counter() - start, DataFrame.cursor - start_bar
+
+def stage_initialize_df(params):
+    if params['source'] == 'memory':
+        panel = generate_panel(params['symbols'],params['bars'],params['interval'],params['seed'])
+        from data import AlpacaDataFrame
+        start = time.perf_counter()
+        AlpacaDataFrame(events = event.EventQueue(), csv_path = '', interval = params['interval'],
+                        symbols = list(panel), warm_up = params['warm_up'], symbol_data = panel)
+        return time.perf_counter() - start, params['bars']
+    start = time.perf_counter()
+    build_frame(params)
+    return time.perf_counter() - start, params['bars']
+
+def stage_initialize_df_cold(params):
+    # first run over the csvs, binary cache (bar_cache.py) built from scratch
+    if params['source'] == 'csv':
+        shutil.rmtree(os.path.join(params['csv_path'],params['interval'].lower(),'.cache'),ignore_errors=True)
+    return stage_initialize_df(params)
+
+def stage_load_warm_up(params):
+    DataFrame = build_frame(params)
+    start = time.perf_counter()
+    DataFrame.load_warm_up(params['warm_up'])
+    return time.perf_counter() - start, DataFrame.cursor
+
+def stage_update_bars(params):
+    DataFrame = build_frame(params)
+    return timed_bars(DataFrame,lambda: None)
+
+def stage_update_holdings(params):
+    from portfolio import SamplePortfolio
+    DataFrame = build_frame(params)
+    Portfolio = SamplePortfolio(bars = DataFrame, events = DataFrame.events)
+    return timed_bars(DataFrame,lambda: Portfolio.update_holdings(
+                        event.MarketEvent(DataFrame.timestamps[DataFrame.cursor-1],DataFrame.cursor-1)))
+
+def stage_update_portfolio(params):
+    # one BUY fill per symbol on every bar (holdings marks are not timed)
+    from portfolio import SamplePortfolio
+    DataFrame = build_frame(params)
+    Portfolio = SamplePortfolio(bars = DataFrame, events = DataFrame.events)
+    elapsed = [0.0]
+    def step():
+        bar = DataFrame.cursor-1
+        stamp = DataFrame.timestamps[bar]
+        Portfolio.update_holdings(event.MarketEvent(stamp,bar))
+        fills = [event.FillEvent(stamp,s,'BROKER',1,'BUY','MARKET',bar=bar) for s in DataFrame.symbols]
+        start = time.perf_counter()
+        for fill in fills:
+            Portfolio.update_portfolio(fill)
+        elapsed[0] += time.perf_counter() - start
+    seconds, bars = timed_bars(DataFrame,step)
+    return elapsed[0], bars
+
+def stage_calculate_signals(params):
+    from portfolio import SamplePortfolio
+    from strategy import PortfolioSharpeMaximization
+    DataFrame = build_frame(params,warm_up=signal_warm_up(params))
+    Portfolio = SamplePortfolio(bars = DataFrame, events = DataFrame.events)
+    Strategy = PortfolioSharpeMaximization(bars = DataFrame, events = DataFrame.events, portfolio = Portfolio)
+    elapsed = [0.0]
+    def step():
+        market = event.MarketEvent(DataFrame.timestamps[DataFrame.cursor-1],DataFrame.cursor-1)
+        Portfolio.update_holdings(market)
+        start = time.perf_counter()
+        Strategy.calculate_signals(market)
+        elapsed[0] += time.perf_counter() - start
+        DataFrame.events.clear()
+    seconds, bars = timed_bars(DataFrame,step)
+    return elapsed[0], bars
+
+def stage_add_data(params):
+    DataFrame = build_frame(params)
+    start = time.perf_counter()
+    DataFrame.add_data(DataFrame.symbols,periods=params['periods'],sma=True,ema=True,wma=True,
+                        rsi=True,natr=True,arith_ret=True,log_ret=True,d1close=True,workers=params['workers'])
+    return time.perf_counter() - start, params['bars']
+
+def stage_add_data_online(params):
+    # same indicators, updated bar by bar from the start of the history to the end
+    DataFrame = build_frame(params,warm_up=0)
+    start = time.perf_counter()
+    DataFrame.add_data(DataFrame.symbols,periods=params['periods'],sma=True,ema=True,wma=True,
+                        rsi=True,natr=True,arith_ret=True,log_ret=True,d1close=True,online=True)
+    while DataFrame.continue_backtest:
+        DataFrame.update_bars()
+        DataFrame.events.clear()
+    return time.perf_counter() - start, params['bars']
+
+def stage_full_loop(params):
+    from portfolio import SamplePortfolio
+    from strategy import PortfolioSharpeMaximization
+    DataFrame = build_frame(params,warm_up=signal_warm_up(params))
+    Portfolio = SamplePortfolio(bars = DataFrame, events = DataFrame.events)
+    Strategy = PortfolioSharpeMaximization(bars = DataFrame, events = DataFrame.events, portfolio = Portfolio)
+    Broker = BasicBroker(events = DataFrame.events)
+    start_bar = DataFrame.cursor
+    start = time.perf_counter()
+    run_event_loop(DataFrame,DataFrame.events,Portfolio,Strategy,Broker)
+    return time.perf_counter() - start, DataFrame.cursor - start_bar
+
+def stage_event_loop(params):
+    result = bench_event_loop(params['symbols'],min(params['bars'],params['signal_bars']))
+    return result['seconds'], result['bars']
+
+def signal_warm_up(params):
+    # warm up everything but the last signal_bars bars
+    return max(params['warm_up'],1 - params['signal_bars']/params['bars'])
+
+def peak_memory_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/(1024*1024) if sys.platform == 'darwin' else peak/1024 # bytes on mac, kilobytes on linux
+
+def run_stage(stage, params):
+    # executed in a fresh process
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds, bars = globals()['stage_'+stage](params)
+    return {'stage':stage,'symbols':params['symbols'],'bars':params['bars'],'source':params['source'],
+            'interval':params['interval'],'timed_bars':int(bars),'seconds':seconds,
+            'bars_per_sec':bars/seconds if seconds > 0 else np.nan,
+            'symbol_bars_per_sec':bars*params['symbols']/seconds if seconds > 0 else np.nan,
+            'peak_rss_mb':peak_memory_mb()}
+
+
+#---------------------------------SYNTHETIC EVENT LOOP--------------------------------#
+
+class SyntheticFeed(object):
+
+    # places one MarketEvent per bar, no data behind it
+
+    def __init__(self, events, n_bars):
+        self.events = events
+        self.n_bars = n_bars
+        self.bar = 0
+        self.continue_backtest = True
+
+    def update_bars(self):
+        if self.bar >= self.n_bars:
+            self.continue_backtest = False
+            return
+        self.events.put(event.MarketEvent(self.bar,self.bar))
+        self.bar += 1
+
+
+class SyntheticStrategy(object):
+
+    # trades every symbol on every bar: one SignalEvent per symbol
+
+    def __init__(self, events, symbols):
+        self.events = events
+        self.symbols = symbols
+
+    def calculate_signals(self, market_event):
+        for s in self.symbols:
+            self.events.put(event.SignalEvent(s,market_event.stamp,'MARKET','BUY',1,bar=market_event.bar))
+
+
+class SyntheticPortfolio(object):
+
+    # turns signals into orders (like SamplePortfolio.update_signal, without printing) and ignores the rest
+
+    def __init__(self, events):
+        self.events = events
+
+    def update_holdings(self, market_event):
+        pass
+
+    def update_signal(self, signal):
+        self.events.put(event.OrderEvent(signal.symbol,signal.stamp,signal.order_type,
+                                        signal.action,signal.shares,bar=signal.bar))
+
+    def update_portfolio(self, fill):
+        pass
+
+
+def bench_event_loop(n_symbols=500, n_bars=200):
+    # events per second through the backtest loop: every bar produces 1 market event
+    # plus one signal, order and fill event per symbol
+    Events = event.EventQueue()
+    Feed = SyntheticFeed(Events,n_bars)
+    Portfolio = SyntheticPortfolio(Events)
+    Strategy = SyntheticStrategy(Events,['S'+str(i) for i in range(n_symbols)])
+    Broker = BasicBroker(Events)
+    start = time.perf_counter()
+    event_counts = run_event_loop(Feed,Events,Portfolio,Strategy,Broker)
+    elapsed = time.perf_counter() - start
+    n_events = sum(event_counts.values())
+    return {'symbols':n_symbols,'bars':n_bars,'events':n_events,
+            'seconds':elapsed,'events_per_sec':n_events/elapsed}
+
+
+#---------------------------------SUITE--------------------------------#
+
+def run_suite(sizes, stages=None, **options):
+    # sizes: list of (n_symbols, n_bars), every stage is run once per size
+    params = dict(DEFAULTS,**options)
+    stages = STAGES if stages is None else stages
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for n_symbols,n_bars in sizes:
+        size_params = dict(params,symbols=n_symbols,bars=n_bars)
+        tmp = None
+        if size_params['source'] == 'csv':
+            tmp = tempfile.mkdtemp(prefix='bench_')
+            write_panel(generate_panel(n_symbols,n_bars,size_params['interval'],size_params['seed']),
+                        tmp,size_params['interval'])
+            size_params['csv_path'] = tmp
+        try:
+            for stage in stages:
+                if stage == 'add_data' and not has_module('talib'):
+                    print('---|',stage,'SKIPPED (talib not installed) |---')
+                    continue
+                # executor processes are not daemonic, so stages can start pools of their own (add_data workers)
+                with ProcessPoolExecutor(max_workers=1,mp_context=context) as executor:
+                    result = executor.submit(run_stage,stage,size_params).result()
+                results.append(result)
+                print('---|',str(n_symbols)+'x'+str(n_bars),stage.ljust(20),
+                      str(round(result['bars_per_sec'],1)).rjust(14),'bars/sec',
+                      str(round(result['peak_rss_mb'],1)).rjust(9),'MB |---')
+        finally:
+            if tmp is not None:
+                shutil.rmtree(tmp,ignore_errors=True)
+    return {'meta':{'created':time.strftime('%Y-%m-%d %H:%M:%S'),'python':platform.python_version(),
+                    'numpy':np.__version__,'pandas':pd.__version__,'machine':platform.machine(),
+                    'params':{k:v for k,v in params.items()}},
+            'results':results}
+
+def has_module(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+def compare(results, baseline, threshold=0.10):
+    # flags stages that got slower (bars/sec) or heavier (peak memory) than the baseline by more than threshold
+    key = lambda r: (r['stage'],r['symbols'],r['bars'],r['source'],r['interval'])
+    base = {key(r):r for r in baseline['results']}
+    rows = []
+    for r in results['results']:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        speed = r['bars_per_sec']/b['bars_per_sec'] - 1
+        memory = r['peak_rss_mb']/b['peak_rss_mb'] - 1
+        flags = []
+        if speed < -threshold:
+            flags.append('SLOWER')
+        if memory > threshold:
+            flags.append('MORE MEMORY')
+        rows.append({'stage':r['stage'],'size':str(r['symbols'])+'x'+str(r['bars']),
+                     'bars_per_sec':r['bars_per_sec'],'baseline_bars_per_sec':b['bars_per_sec'],
+                     'speed_change':speed,'memory_change':memory,'flag':' '.join(flags)})
+    return pd.DataFrame(rows)
+
+def parse_size(size):
+    n_symbols, n_bars = size.lower().split('x')
+    return int(n_symbols), int(n_bars)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the engine\'s hot paths on synthetic data')
+    parser.add_argument('--sizes',nargs='+',default=['10x10000'],help='SYMBOLSxBARS, e.g. 10x10000 2000x5000000')
+    parser.add_argument('--stages',nargs='+',default=None,choices=STAGES)
+    parser.add_argument('--source',default=DEFAULTS['source'],choices=['csv','memory'])
+    parser.add_argument('--interval',default=DEFAULTS['interval'])
+    parser.add_argument('--signal_bars',type=int,default=DEFAULTS['signal_bars'])
+    parser.add_argument('--workers',type=int,default=DEFAULTS['workers'],help='add_data process pool size')
+    parser.add_argument('--output',default=None,help='write results to this json file')
+    parser.add_argument('--results',default=None,help='load results from a json file instead of running')
+    parser.add_argument('--compare',default=None,help='baseline json file to compare against')
+    parser.add_argument('--threshold',type=float,default=0.10)
+    args = parser.parse_args()
+    if args.results is not None:
+        with open(args.results) as f:
+            results = json.load(f)
+    else:
+        results = run_suite([parse_size(s) for s in args.sizes],args.stages,source=args.source,
+                            interval=args.interval,signal_bars=args.signal_bars,workers=args.workers)
+    if args.output is not None:
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=2,default=float)
+    print(pd.DataFrame(results['results'])[['stage','symbols','bars','timed_bars','seconds',
+                                            'bars_per_sec','peak_rss_mb']].to_string(index=False))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            report = compare(results,json.load(f),args.threshold)
+        print('<<-------| COMPARED TO',args.compare,'|------->>')
+        print(report.to_string(index=False))
+        if (report['flag'] != '').any():
+            sys.exit(1)
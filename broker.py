@@ -1,8 +1,10 @@
 import datetime
 import queue
+import numpy as np
 
 from abc import ABCMeta, abstractmethod
-from event import FillEvent, OrderEvent
+from event import EventType, FillEvent, OrderEvent, BatchFillEvent
+from checkpoint import scalar
 
 class Broker(object):
 
@@ -11,16 +13,303 @@ class Broker(object):
     @abstractmethod
     def execute_order(self, event):
         raise NotImplementedError('Implement execute_order before proceeding')
-    
+
+    def check_orders(self, event):
+        # called on every MarketEvent (after the portfolio marked the new bar), for brokers holding resting orders
+        pass
+
+    def get_state(self):
+        # state carried from bar to bar, saved in checkpoints (checkpoint.py)
+        return {}
+
+    def set_state(self, state):
+        pass
+
 
 class BasicBroker(Broker):
 
     def __init__(self, events):
         self.events = events
-        
+
     def execute_order(self, event):
-        if event.type == 'ORDER':
+        if event.type is EventType.ORDER:
             fill_event = FillEvent(event.stamp,
                             event.symbol, 'BROKER', event.shares,
-                            event.action,event.order_type)
+                            event.action,event.order_type,bar=event.bar)
             self.events.put(fill_event)
+        elif event.type is EventType.BATCH_ORDER:
+            # the whole batch is filled at once
+            self.events.put(BatchFillEvent(event.stamp,event.symbols,'BROKER',event.shares,
+                                            event.actions,event.order_type,bar=event.bar))
+
+
+# ------------------------------------------------------------------------------------------------------
+# COMMISSION MODELS
+# commission(shares, prices) -> commission of every fill, computed over whole arrays of fills at once
+# ------------------------------------------------------------------------------------------------------
+class CommissionModel(object):
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def commission(self, shares, prices):
+        raise NotImplementedError('Implement commission() to continue')
+
+
+class NoCommission(CommissionModel):
+
+    def commission(self, shares, prices):
+        return np.zeros(len(shares))
+
+
+class PerShareCommission(CommissionModel):
+
+    # IB fixed pricing: rate per share, at least `minimum` per order, at most max_pct of the trade value
+
+    def __init__(self, rate=0.005, minimum=1.0, max_pct=0.01):
+        self.rate = rate
+        self.minimum = minimum
+        self.max_pct = max_pct
+
+    def commission(self, shares, prices):
+        shares = np.abs(shares)
+        return np.minimum(np.maximum(self.rate*shares,self.minimum),self.max_pct*shares*prices)
+
+
+class PercentCommission(CommissionModel):
+
+    def __init__(self, rate=0.001):
+        self.rate = rate # fraction of the trade value
+
+    def commission(self, shares, prices):
+        return self.rate*np.abs(shares)*prices
+
+
+# ------------------------------------------------------------------------------------------------------
+# SLIPPAGE MODELS
+# fill_prices(prices, sides, shares, volumes) -> prices actually paid/received (sides: +1 = BUY, -1 = SELL)
+# ------------------------------------------------------------------------------------------------------
+class SlippageModel(object):
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def fill_prices(self, prices, sides, shares, volumes):
+        raise NotImplementedError('Implement fill_prices() to continue')
+
+
+class NoSlippage(SlippageModel):
+
+    def fill_prices(self, prices, sides, shares, volumes):
+        return prices
+
+
+class FixedSlippage(SlippageModel):
+
+    # a fixed number of basis points against the order
+
+    def __init__(self, bps=5.0):
+        self.bps = bps
+
+    def fill_prices(self, prices, sides, shares, volumes):
+        return prices*(1 + sides*self.bps/1e4)
+
+
+class VolumeShareSlippage(SlippageModel):
+
+    # price impact growing with the square of the order's share of the bar's volume
+
+    def __init__(self, impact=0.1):
+        self.impact = impact
+
+    def fill_prices(self, prices, sides, shares, volumes):
+        with np.errstate(divide='ignore',invalid='ignore'):
+            share = np.where(volumes > 0,np.abs(shares)/volumes,0.0)
+        return prices*(1 + sides*self.impact*np.minimum(share,1.0)**2)
+
+
+# ------------------------------------------------------------------------------------------------------
+# SIMULATED BROKER
+# MARKET orders fill at the close of the bar they were placed on. LIMIT, STOP and STOP-LIMIT orders rest
+# in a book of arrays (one slot per order) and are checked from the next bar on against its open/high/low,
+# every resting order in one vectorized pass per bar:
+#   BUY LIMIT  fills when low <= limit at min(open, limit)   SELL LIMIT fills when high >= limit at max(open, limit)
+#   BUY STOP   fills when high >= stop at max(open, stop)    SELL STOP  fills when low <= stop at min(open, stop)
+#   STOP-LIMIT turns into its LIMIT once the stop is hit (and can fill on that same bar)
+# Fill prices go through the slippage model and commissions through the commission model in batch.
+# ------------------------------------------------------------------------------------------------------
+
+MARKET, LIMIT, STOP, STOP_LIMIT = 0, 1, 2, 3
+ORDER_TYPES = {'MARKET':MARKET,'LIMIT':LIMIT,'STOP':STOP,'STOP-LIMIT':STOP_LIMIT}
+ORDER_TYPE_NAMES = {code:name for name,code in ORDER_TYPES.items()}
+
+
+class SimulatedBroker(Broker):
+
+    BOOK = ['column','side','shares','order_type','limit','stop','triggered','placed'] # order book arrays
+
+    def __init__(self, bars, events, commission=None, slippage=None, max_age=None, capacity=1024):
+        self.bars = bars
+        self.events = events
+        self.commission_model = NoCommission() if commission is None else commission
+        self.slippage_model = NoSlippage() if slippage is None else slippage
+        self.max_age = max_age # bars an order rests before it is cancelled, None = good till cancelled
+        self.symbols = list(self.bars.symbols)
+        #-----Order book: slots [0, n_orders) hold the resting orders-----#
+        self.n_orders = 0
+        self.column = np.zeros(capacity,dtype=np.int64) # symbol index
+        self.side = np.zeros(capacity,dtype=np.int8) # +1 = BUY, -1 = SELL
+        self.shares = np.zeros(capacity,dtype=np.float64)
+        self.order_type = np.zeros(capacity,dtype=np.int8)
+        self.limit = np.full(capacity,np.nan)
+        self.stop = np.full(capacity,np.nan)
+        self.triggered = np.zeros(capacity,dtype=bool) # STOP-LIMIT whose stop was hit
+        self.placed = np.zeros(capacity,dtype=np.int64) # bar the order was placed on
+        self.stats = {'orders':0,'fills':0,'cancelled':0,'commission':0.0,'slippage':0.0}
+
+    def bar_fields(self, bar, columns, fields):
+        # (len(fields) x len(columns)) values of one bar
+        index = [self.bars.fields.index(f) for f in fields]
+        return self.bars.get_bar_window(bar,bar+1)[:,0][np.ix_(columns,index)].T
+
+    #---------------------------------ORDERS--------------------------------#
+
+    def execute_order(self, event):
+        if event.type is EventType.ORDER:
+            self.place(event,[event.symbol],np.array([event.shares],dtype=np.float64),[event.action],
+                       np.array([np.nan if event.limit_price is None else event.limit_price]),
+                       np.array([np.nan if event.stop_price is None else event.stop_price]),batch=False)
+        elif event.type is EventType.BATCH_ORDER:
+            n = len(event)
+            limits = np.full(n,np.nan) if event.limit_prices is None else np.asarray(event.limit_prices,dtype=np.float64)
+            stops = np.full(n,np.nan) if event.stop_prices is None else np.asarray(event.stop_prices,dtype=np.float64)
+            self.place(event,event.symbols,np.asarray(event.shares,dtype=np.float64),event.actions,limits,stops,batch=True)
+
+    def place(self, event, symbols, shares, actions, limits, stops, batch):
+        order_type = ORDER_TYPES[event.order_type]
+        bar = self.bars.event_bar(event)
+        columns = np.array([self.bars.symbol_index[s] for s in symbols],dtype=np.int64)
+        sides = np.where(np.asarray(actions) == 'BUY',1,-1).astype(np.int8)
+        self.stats['orders'] += len(columns)
+        if order_type == MARKET:
+            close, volume = self.bar_fields(bar,columns,['close','volume'])
+            self.fill(event.stamp,bar,columns,sides,shares,close,volume,'MARKET',batch)
+            return
+        self.book(columns,sides,shares,order_type,limits,stops,bar)
+
+    def book(self, columns, sides, shares, order_type, limits, stops, bar):
+        n = len(columns)
+        if self.n_orders + n > len(self.column):
+            self.grow(self.n_orders + n)
+        new = slice(self.n_orders,self.n_orders+n)
+        self.column[new] = columns
+        self.side[new] = sides
+        self.shares[new] = shares
+        self.order_type[new] = order_type
+        self.limit[new] = limits
+        self.stop[new] = stops
+        self.triggered[new] = False
+        self.placed[new] = bar
+        self.n_orders += n
+
+    def grow(self, n):
+        capacity = max(2*len(self.column),n)
+        for name in self.BOOK:
+            old = getattr(self,name)
+            grown = np.zeros(capacity,dtype=old.dtype)
+            grown[:len(old)] = old
+            setattr(self,name,grown)
+
+    def cancel_all(self):
+        self.stats['cancelled'] += self.n_orders
+        self.n_orders = 0
+
+    #---------------------------------MATCHING--------------------------------#
+
+    def check_orders(self, event):
+        # every resting order placed before this bar against its open/high/low, in one pass
+        n = self.n_orders
+        if n == 0:
+            return
+        bar = self.bars.event_bar(event)
+        live = slice(0,n)
+        column, side, order_type = self.column[live], self.side[live], self.order_type[live]
+        limit, stop, placed = self.limit[live], self.stop[live], self.placed[live]
+        bar_open, high, low, volume = self.bar_fields(bar,column,['open','high','low','volume'])
+        active = placed < bar
+        buy = side == 1
+        #---stops (STOP and not yet triggered STOP-LIMIT) hit on this bar---#
+        stopping = active & ((order_type == STOP) | ((order_type == STOP_LIMIT) & ~self.triggered[live]))
+        stop_hit = stopping & np.where(buy,high >= stop,low <= stop)
+        stop_price = np.where(buy,np.maximum(bar_open,stop),np.minimum(bar_open,stop))
+        self.triggered[live] |= stop_hit & (order_type == STOP_LIMIT)
+        #---limits (LIMIT and triggered STOP-LIMIT) reachable on this bar---#
+        limiting = active & ((order_type == LIMIT) | ((order_type == STOP_LIMIT) & self.triggered[live]))
+        limit_hit = limiting & np.where(buy,low <= limit,high >= limit)
+        # a STOP-LIMIT triggered on this bar starts from its stop price, a resting limit from the open
+        start = np.where((order_type == STOP_LIMIT) & stop_hit,stop_price,bar_open)
+        limit_price = np.where(buy,np.minimum(start,limit),np.maximum(start,limit))
+        filled = (stop_hit & (order_type == STOP)) | limit_hit
+        prices = np.where(order_type == STOP,stop_price,limit_price)
+        if filled.any():
+            for code in (LIMIT,STOP,STOP_LIMIT):
+                group = np.flatnonzero(filled & (order_type == code))
+                if len(group) > 0:
+                    self.fill(event.stamp,bar,column[group],side[group],self.shares[group],prices[group],
+                              volume[group],ORDER_TYPE_NAMES[code],True)
+        keep = ~filled # orders on symbols without a bar (NaN high/low) never match and keep resting
+        if self.max_age is not None:
+            expired = keep & (bar - placed >= self.max_age)
+            self.stats['cancelled'] += int(expired.sum())
+            keep &= ~expired
+        self.compact(keep)
+
+    def compact(self, keep):
+        # drop filled/cancelled orders, the resting ones move to the front keeping their order
+        m = int(keep.sum())
+        if m == self.n_orders:
+            return
+        for name in self.BOOK:
+            values = getattr(self,name)
+            values[:m] = values[:self.n_orders][keep]
+        self.n_orders = m
+
+    #---------------------------------FILLS--------------------------------#
+
+    def fill(self, stamp, bar, columns, sides, shares, prices, volumes, order_type, batch):
+        # slippage and commission over the whole batch, then one BatchFillEvent (or FillEvents for single orders)
+        fill_prices = self.slippage_model.fill_prices(prices,sides,shares,volumes)
+        commissions = self.commission_model.commission(shares,fill_prices)
+        self.stats['fills'] += len(columns)
+        self.stats['commission'] += float(np.nansum(commissions))
+        self.stats['slippage'] += float(np.nansum(np.abs(fill_prices-prices)*shares))
+        symbols = [self.symbols[j] for j in columns]
+        actions = np.where(sides == 1,'BUY','SELL').astype(object)
+        if batch:
+            self.events.put(BatchFillEvent(stamp,symbols,'SIMULATED',shares,actions,order_type,
+                                           commission=commissions,bar=bar,prices=fill_prices))
+        else:
+            for s,n,a,c,p in zip(symbols,shares,actions,commissions,fill_prices):
+                self.events.put(FillEvent(stamp,s,'SIMULATED',n,a,order_type,commission=c,bar=bar,price=p))
+
+    def get_state(self):
+        # the resting orders and the execution stats
+        state = {name:getattr(self,name)[:self.n_orders].copy() for name in self.BOOK}
+        state['stats'] = dict(self.stats)
+        return state
+
+    def set_state(self, state):
+        n = len(state['column'])
+        if n > len(self.column):
+            self.grow(n)
+        for name in self.BOOK:
+            getattr(self,name)[:n] = state[name]
+        self.n_orders = n
+        self.stats = {k:scalar(v) for k,v in state['stats'].items()}
+
+    def report(self):
+        stats = self.stats
+        print('<<-------| EXECUTION REPORT |------->>')
+        print('Orders:',stats['orders'],' Fills:',stats['fills'],' Cancelled:',stats['cancelled'],
+              ' Resting:',self.n_orders)
+        print('Commission:',round(stats['commission'],2),' Slippage Cost:',round(stats['slippage'],2))
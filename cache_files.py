@@ -0,0 +1,64 @@
+import os, os.path
+import tempfile
+import numpy as np
+
+
+# ------------------------------------------------------------------------------------------------------
+# CACHE FILES
+# file helpers shared by the on-disk caches (bar_cache, feature_cache, optimizer_cache) and checkpoints:
+#   atomic_write -> write(f) goes to a temporary file in the target folder, which is then moved into place,
+#                   so a reader (or a resume after a crash) only ever sees complete files
+#   npy_entries  -> [(path, size, last used)] of the .npy files in some folders
+#   evict_lru    -> removes the least recently used entries until the total fits in max_bytes
+# Several processes may share a folder, a file can vanish between listing it and touching it.
+# ------------------------------------------------------------------------------------------------------
+
+
+def atomic_write(path, write, mode='wb'):
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder,exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=folder or None,suffix='.tmp')
+    try:
+        with os.fdopen(fd,mode) as f:
+            write(f)
+        os.replace(tmp_file,path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+def save_npy(path, values):
+    atomic_write(path,lambda f: np.save(f,values,allow_pickle=False))
+
+def npy_entries(folders):
+    result = []
+    for folder in folders:
+        try:
+            files = os.listdir(folder)
+        except OSError:
+            continue
+        for f in files:
+            if f.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(folder,f))
+                except OSError:
+                    continue
+                result.append((os.path.join(folder,f),stat.st_size,stat.st_mtime_ns))
+    return result
+
+def evict_lru(entries, max_bytes):
+    # returns (bytes left, entries removed)
+    entries = sorted(entries,key=lambda e: e[2])
+    total = sum(e[1] for e in entries)
+    evicted = 0
+    for path,size,used in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        evicted += 1
+    return total, evicted
@@ -0,0 +1,331 @@
+import os, os.path
+import time
+import hashlib
+import threading
+import queue
+import numpy as np
+
+from event import (MarketEvent, SignalEvent, OrderEvent, FillEvent, RebalanceEvent, BatchOrderEvent,
+                   BatchFillEvent)
+from cache_files import atomic_write
+
+
+# ------------------------------------------------------------------------------------------------------
+# CHECKPOINTS
+# the state of a running backtest saved every `every` bars into one folder, so a crashed or pre-empted run
+# resumes from its latest checkpoint with the same results as an uninterrupted one:
+#   rows_<n>.npz  -> ledger rows (and online indicator columns) finished since checkpoint n-1
+#   state_<n>.npz -> everything else: feed cursor and buffers, portfolio scalars and daily aggregates,
+#                    strategy (weights, running moments), broker order book and the pending event queue
+#   LATEST        -> number of the last complete checkpoint, replaced once both files are in place
+# Every component gives its state as a (nested) dict of arrays and scalars (get_state/set_state), stored
+# with np.savez under 'component/key' names. The loop only copies that state (and the new rows), a
+# background thread compresses and writes it, so writing never stalls the loop.
+# Resuming rebuilds the components from the same config (bars are re-read from the csvs, checked against
+# the feed's data fingerprint, the config against the digest of its result keys), then restores their state.
+# Queued events are stored as typed arrays (pack_events), like the broker's order book: nothing is pickled.
+# ------------------------------------------------------------------------------------------------------
+
+LATEST = 'LATEST'
+
+
+def flatten(state, prefix=''):
+    # nested dicts -> {'a/b': value}
+    arrays = {}
+    for k,v in state.items():
+        if isinstance(v,dict):
+            arrays.update(flatten(v,prefix+k+'/'))
+        else:
+            arrays[prefix+k] = v
+    return arrays
+
+def unflatten(arrays):
+    state = {}
+    for name,v in arrays.items():
+        node = state
+        keys = name.split('/')
+        for k in keys[:-1]:
+            node = node.setdefault(k,{})
+        node[keys[-1]] = v
+    return state
+
+def scalar(value):
+    # 0-d array read back from a checkpoint -> python int/float/bool/str
+    return np.asarray(value).item()
+
+def attributes_state(obj, names):
+    # copies of the attributes of obj (arrays are copied, the loop keeps mutating them)
+    return {name:np.array(getattr(obj,name)) for name in names}
+
+def set_attributes(obj, state, names):
+    for name in names:
+        value = state[name]
+        setattr(obj,name,scalar(value) if np.ndim(value) == 0 else np.array(value))
+
+def config_fingerprint(config, keys):
+    # digest of the config keys a run's results depend on, models (commission, slippage) by class and attributes
+    def describe(value):
+        if hasattr(value,'__dict__'):
+            return (type(value).__name__,sorted((k,describe(v)) for k,v in vars(value).items()))
+        if isinstance(value,(list,tuple)):
+            return [describe(v) for v in value]
+        return value
+    text = repr([(k,describe(config.get(k))) for k in keys])
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+#---------------------------------QUEUED EVENTS--------------------------------#
+# one entry per event (class, bar, stamp, order type, ...) and one row per symbol of an event
+# (symbol index, shares, action, limit/stop/fill price, commission), single events have one row
+
+EVENT_CLASSES = [MarketEvent,SignalEvent,OrderEvent,FillEvent,RebalanceEvent,BatchOrderEvent,BatchFillEvent]
+EVENT_ORDER_TYPES = ['MARKET','LIMIT','STOP','STOP-LIMIT']
+EVENT_ACTIONS = {'BUY':1,'SELL':-1}
+
+def event_code(value, codes, what):
+    try:
+        return codes.index(value) if isinstance(codes,list) else codes[value]
+    except (ValueError, KeyError):
+        raise ValueError('queued event with an unknown '+what+' '+repr(value)+' cannot be checkpointed')
+
+def pack_events(events, symbols):
+    # queued events -> {'events': per event arrays, 'rows': per symbol arrays}
+    symbols = list(symbols)
+    entries = {'kind':[],'bar':[],'stamp':[],'order_type':[],'exchange':[],'rows':[],
+               'has_limit':[],'has_stop':[],'has_price':[],'integer_shares':[]}
+    rows = {'symbol':[],'shares':[],'action':[],'limit':[],'stop':[],'price':[],'commission':[]}
+    for event in events:
+        kind = event_code(type(event),EVENT_CLASSES,'type')
+        entries['kind'].append(kind)
+        entries['bar'].append(-1 if event.bar is None else event.bar)
+        entries['stamp'].append(str(event.stamp))
+        if isinstance(event,MarketEvent):
+            n = 0
+            entries['order_type'].append(-1)
+            entries['exchange'].append('')
+            entries['has_limit'].append(False)
+            entries['has_stop'].append(False)
+            entries['has_price'].append(False)
+            entries['integer_shares'].append(False)
+        else:
+            batch = isinstance(event,(RebalanceEvent,BatchFillEvent))
+            fill = isinstance(event,(FillEvent,BatchFillEvent))
+            names = event.symbols if batch else [event.symbol]
+            n = len(names)
+            shares = np.asarray(event.shares if batch else [event.shares])
+            actions = event.actions if batch else [event.action]
+            if fill:
+                limits = stops = None
+                prices = event.prices if batch else (None if event.price is None else [event.price])
+                commission = np.broadcast_to(np.asarray(event.commission,dtype=np.float64),n)
+            else:
+                limits = event.limit_prices if batch else (None if event.limit_price is None else [event.limit_price])
+                stops = event.stop_prices if batch else (None if event.stop_price is None else [event.stop_price])
+                prices = None
+                commission = np.zeros(n)
+            entries['order_type'].append(event_code(event.order_type,EVENT_ORDER_TYPES,'order type'))
+            entries['exchange'].append(event.exchange if fill else '')
+            entries['has_limit'].append(limits is not None)
+            entries['has_stop'].append(stops is not None)
+            entries['has_price'].append(prices is not None)
+            entries['integer_shares'].append(np.issubdtype(shares.dtype,np.integer))
+            rows['symbol'] += [event_code(s,symbols,'symbol') for s in names]
+            rows['shares'] += shares.astype(np.float64).tolist()
+            rows['action'] += [event_code(a,EVENT_ACTIONS,'action') for a in actions]
+            for name,values in (('limit',limits),('stop',stops),('price',prices)):
+                rows[name] += [np.nan]*n if values is None else np.asarray(values,dtype=np.float64).tolist()
+            rows['commission'] += commission.tolist()
+        entries['rows'].append(n)
+    dtypes = {'kind':np.int8,'bar':np.int64,'stamp':str,'order_type':np.int8,'exchange':str,'rows':np.int64,
+              'has_limit':bool,'has_stop':bool,'has_price':bool,'integer_shares':bool,
+              'symbol':np.int64,'shares':np.float64,'action':np.int8,'limit':np.float64,'stop':np.float64,
+              'price':np.float64,'commission':np.float64}
+    return {'events':{k:np.array(v,dtype=dtypes[k]) for k,v in entries.items()},
+            'rows':{k:np.array(v,dtype=dtypes[k]) for k,v in rows.items()}}
+
+def unpack_events(state, symbols):
+    # pack_events' arrays -> the queued events
+    entries, rows = state['events'], state['rows']
+    actions = {code:name for name,code in EVENT_ACTIONS.items()}
+    events = []
+    first = 0
+    for k in range(len(entries['kind'])):
+        cls = EVENT_CLASSES[int(entries['kind'][k])]
+        bar = None if entries['bar'][k] < 0 else int(entries['bar'][k])
+        stamp = str(entries['stamp'][k])
+        n = int(entries['rows'][k])
+        if cls is MarketEvent:
+            events.append(MarketEvent(stamp,bar))
+            continue
+        r = slice(first,first+n)
+        first += n
+        names = [symbols[j] for j in rows['symbol'][r]]
+        shares = rows['shares'][r].astype(np.int64) if entries['integer_shares'][k] else rows['shares'][r].copy()
+        side = np.array([actions[a] for a in rows['action'][r]],dtype=object)
+        order_type = EVENT_ORDER_TYPES[int(entries['order_type'][k])]
+        limits = rows['limit'][r].copy() if entries['has_limit'][k] else None
+        stops = rows['stop'][r].copy() if entries['has_stop'][k] else None
+        prices = rows['price'][r].copy() if entries['has_price'][k] else None
+        if cls is BatchFillEvent:
+            events.append(BatchFillEvent(stamp,names,str(entries['exchange'][k]),shares,side,order_type,
+                                         commission=rows['commission'][r].copy(),bar=bar,prices=prices))
+        elif cls is FillEvent:
+            events.append(FillEvent(stamp,names[0],str(entries['exchange'][k]),shares[0].item(),side[0],order_type,
+                                    commission=rows['commission'][r][0].item(),bar=bar,
+                                    price=None if prices is None else prices[0].item()))
+        elif cls in (RebalanceEvent,BatchOrderEvent):
+            events.append(cls(names,stamp,order_type,side,shares,limit_prices=limits,stop_prices=stops,bar=bar))
+        else:
+            events.append(cls(names[0],stamp,order_type,side[0],shares[0].item(),
+                              limit_price=None if limits is None else limits[0].item(),
+                              stop_price=None if stops is None else stops[0].item(),bar=bar))
+    return events
+
+def write_npz(path, arrays, compress=True):
+    atomic_write(path,lambda f: (np.savez_compressed if compress else np.savez)(f,**arrays))
+    return os.path.getsize(path)
+
+def latest_checkpoint(folder):
+    # number of the last complete checkpoint in folder, None if there is none
+    try:
+        with open(os.path.join(folder,LATEST)) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+class Checkpointer(object):
+
+    def __init__(self, folder, DataFrame, Events, Portfolio, Strategy, Broker, every=1000, keep=2, compress=True,
+                config_key=''):
+        self.folder = folder
+        self.components = {'feed':DataFrame,'portfolio':Portfolio,'strategy':Strategy,'broker':Broker}
+        self.bars = DataFrame
+        self.events = Events
+        self.ledger = Portfolio.ledger
+        self.every = every # bars between checkpoints
+        self.keep = keep # state files kept (the row files are all needed to resume)
+        self.compress = compress
+        self.data_key = DataFrame.data_fingerprint()
+        self.config_key = config_key # digest of the run's result keys (config_fingerprint), checked on resume
+        self.number = -1 # last checkpoint taken
+        self.ledger_rows = 0 # ledger rows already in a rows file
+        self.feed_bar = DataFrame.cursor # bars whose indicator columns are already in a rows file
+        self.last_bar = DataFrame.cursor
+        self.writes = queue.Queue(maxsize=2) # at most 2 checkpoints waiting, the loop waits beyond that
+        self.writer = None
+        self.error = None
+        self.stats = {'checkpoints':0,'snapshot_time':0.0,'write_time':0.0,'bytes':0}
+        if not os.path.exists(folder):
+            os.makedirs(folder,exist_ok=True)
+
+    #---------------------------------SAVING--------------------------------#
+
+    def tick(self):
+        # called by the event loop once every event of a bar was handled
+        if self.bars.cursor - self.last_bar >= self.every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        if self.error is not None:
+            raise self.error
+        start = time.perf_counter()
+        self.number += 1
+        state, rows = self.snapshot()
+        self.last_bar = self.bars.cursor
+        self.stats['snapshot_time'] += time.perf_counter() - start
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_loop,daemon=True)
+            self.writer.start()
+        self.writes.put((self.number,state,rows))
+
+    def snapshot(self):
+        # (state, rows) of the checkpoint, copied so the loop can carry on while they are written
+        state = {name:component.get_state() for name,component in self.components.items()}
+        state['events'] = pack_events(self.events,self.bars.symbols)
+        state['checkpoint'] = {'number':self.number,'data_key':self.data_key,'config_key':self.config_key,
+                               'cursor':self.bars.cursor}
+        rows = {'ledger':self.ledger.rows_state(self.ledger_rows),
+                'feed':self.bars.fields_state(self.feed_bar)}
+        self.ledger_rows = self.ledger.n_rows
+        self.feed_bar = self.bars.cursor
+        return flatten(state), flatten(rows)
+
+    def write_loop(self):
+        while True:
+            item = self.writes.get()
+            if item is None:
+                return
+            number, state, rows = item
+            start = time.perf_counter()
+            try:
+                self.stats['bytes'] += write_npz(self.path('rows',number),rows,self.compress)
+                self.stats['bytes'] += write_npz(self.path('state',number),state,self.compress)
+                atomic_write(os.path.join(self.folder,LATEST),lambda f: f.write(str(number)),mode='w')
+                old = self.path('state',number-self.keep)
+                if os.path.exists(old):
+                    os.remove(old)
+            except BaseException as e:
+                self.error = e
+                return
+            self.stats['checkpoints'] += 1
+            self.stats['write_time'] += time.perf_counter() - start
+
+    def close(self):
+        # wait for the checkpoints still being written
+        if self.writer is not None:
+            self.writes.put(None)
+            self.writer.join()
+            self.writer = None
+        if self.error is not None:
+            raise self.error
+
+    def path(self, kind, number):
+        return os.path.join(self.folder,'{kind}_{number:06d}.npz'.format(kind=kind,number=number))
+
+    def clear(self):
+        # a fresh run: the files of an earlier run in the folder are removed, LATEST first,
+        # so they can never be resumed (or mixed with this run's checkpoints)
+        latest = os.path.join(self.folder,LATEST)
+        if os.path.exists(latest):
+            os.remove(latest)
+        for name in os.listdir(self.folder):
+            if name.startswith(('rows_','state_')) and name.endswith('.npz'):
+                os.remove(os.path.join(self.folder,name))
+
+    #---------------------------------RESUMING--------------------------------#
+
+    def restore(self):
+        # state of the latest checkpoint put back into the components, returns its number (None = nothing to resume)
+        number = latest_checkpoint(self.folder)
+        if number is None:
+            return None
+        with np.load(self.path('state',number),allow_pickle=False) as f:
+            state = unflatten(dict(f))
+        if scalar(state['checkpoint']['data_key']) != self.data_key:
+            raise ValueError('checkpoint '+str(number)+' in '+self.folder+' was taken over other bars '
+                             '(csvs or timeline changed), it cannot be resumed')
+        if scalar(state['checkpoint'].get('config_key','')) != self.config_key:
+            raise ValueError('checkpoint '+str(number)+' in '+self.folder+' was taken with another config '
+                             '(symbols, strategy or broker settings changed), it cannot be resumed')
+        # the ledger rows and indicator columns, in the order they were written
+        for n in range(number+1):
+            with np.load(self.path('rows',n),allow_pickle=False) as f:
+                rows = unflatten(dict(f))
+            self.ledger.set_rows(rows.get('ledger',{}))
+            self.bars.set_fields(rows.get('feed',{}))
+        for name,component in self.components.items():
+            component.set_state(state.get(name,{}))
+        self.events.clear()
+        self.events.extend(unpack_events(state['events'],self.bars.symbols))
+        self.number = number
+        self.ledger_rows = self.ledger.n_rows
+        self.feed_bar = self.last_bar = self.bars.cursor
+        print('---|RESUMING FROM CHECKPOINT',number,'AT BAR',self.bars.cursor,'|---')
+        return number
+
+    def report(self):
+        stats = self.stats
+        print('<<-------| CHECKPOINT REPORT |------->>')
+        print('Checkpoints:',stats['checkpoints'],' Size (MB):',round(stats['bytes']/1024**2,2))
+        print('Snapshot Time (s):',round(stats['snapshot_time'],4),' Write Time (s, background):',
+              round(stats['write_time'],4))
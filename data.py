@@ -10,10 +10,22 @@ import pandas as pd
 import numpy as np
 import datetime
 import time
+import hashlib
 from abc import ABCMeta, abstractmethod
 from event import MarketEvent
+from bar_cache import NS_PER_DAY, load_bars, stamps_to_index, source_fingerprint
+from feature_cache import frame_digest, timeline_digest
+from indicators import OnlineIndicators, batch_features, batch_features_parallel
+from downloader import BarDownloader
+from checkpoint import scalar
 import talib
 
+def widest_lookback(a, b):
+    # None = every bar
+    if a is None or b is None:
+        return None
+    return max(a,b)
+
 class DataFrame(object):
 
     __metaclass__ = ABCMeta
@@ -39,18 +51,38 @@ class DataFrame(object):
    
 class AlpacaDataFrame(DataFrame):
 
-    def __init__(self, events, csv_path, symbols,interval):
+    def __init__(self, events, csv_path, symbols,interval,use_cache=True,warm_up=0.25,update=None,symbol_data=None,
+                lookback=None,feature_cache=None,downloader=None):
         #-----Initialize params-----#
         self.events = events
         self.csv_path = csv_path +'/'+interval.lower()
         self.symbols = symbols
         self.interval = interval
+        self.use_cache = use_cache # load csvs through the binary memory-mapped cache (bar_cache.py)
+        self.update = update # None = ask before updating existing data, True/False = update/skip without asking
+        self.downloader = downloader # BarDownloader used by update_database (downloader.py), None = default one
         #---------------------------#
         self.symbol_data = {}
-        self.bars_generator = {}
+        self.sources = {} # symbol -> csv file its data was loaded from
+        self.feature_cache = feature_cache # FeatureCache for add_data's columns (feature_cache.py), None = off
         self.timestamps = None #timestamp will be set after load.csv() is run
-        self.latest_stamps = None #use to track our current time index
-        self.latest_symbol_data = {}
+        #-----Typed timeline (build_timeline)-----#
+        # int64 epoch-ns stamp of every bar, bar number lookups and the bars each trading day starts on
+        self.stamps = None
+        self.bar_lookup = None
+        self.new_day = None
+        self.day_starts = None
+        #-----Preallocated bar store-----#
+        # symbols x time x fields array allocated once at load, with a cursor
+        # marking how many bars have been updated onto the dataframe so far
+        self.fields = None
+        self.symbol_index = {}
+        self.bar_data = None
+        self.cursor = 0
+        self.lookback = lookback # most bars any component looks back over, None = all of them (set_lookback)
+        self.shared = False # several strategies on this feed: set_lookback keeps the widest lookback
+        self.latest_symbol_data = LatestSymbolData(self)
+        self.indicators = [] # online indicator engines updated with every new bar (add_data(online=True))
         self.continue_backtest = True
         '''
         self.alpaca_api_keys = {'key_id':[YOUR KEY ID],
@@ -59,15 +91,44 @@ class AlpacaDataFrame(DataFrame):
         # After initializing all variables, we load all symbols' csv files (OHLCV) into symbol_data as generators
         self.market_calendar = self.alpaca_api.get_calendar()
         '''
-        self.initialize_df(interval=self.interval)
-        self.load_warm_up(0.25)
+        if symbol_data is None:
+            self.initialize_df(interval=self.interval)
+        else:
+            # in-memory OHLCV frames per symbol ({symbol: DataFrame}) instead of the csv database
+            for s in self.symbols:
+                self.symbol_data[s] = symbol_data[s][['open','high','low','close','volume']].sort_index()
+            self.align_symbol_data()
+        self.load_warm_up(warm_up)
 
     #***
     def initialize_df(self,interval):
         #IMPORTANT: THE ORIGINAL DATA VETTED IN update_database
         #           NEED TO BE FIXED TO ['open','high','low','close','volume']
-        indexes = None
         columns = ['open','high','low','close','volume']
+        self.check_database()
+        print('Initializing DataFrame...')
+        for i in self.symbols:
+            csv_file = os.path.join(self.csv_path,
+                                    '{file_name}.{file_extension}'.format(file_name=i,
+                                    file_extension='csv'))
+            self.sources[i] = csv_file
+            if self.use_cache:
+                # compiled once into int64 stamps + float64 columns, memory-mapped afterwards
+                stamps, ohlcv = load_bars(csv_file)
+                self.symbol_data[i] = pd.DataFrame(ohlcv.T,columns=columns,
+                                                index=stamps_to_index(stamps,daily=(interval[-1] == 'D')))
+            else:
+                self.symbol_data[i] = pd.read_csv(csv_file,header = 0, index_col = 0)
+                self.symbol_data[i].columns = columns # clean up columns
+                self.symbol_data[i] = self.symbol_data[i].sort_index() #sort index to make sure it's monotonic
+                # IF WE'RE DATAFRAME INTERVAL IS DAILY, WE'LL JUST GET RID OF TIME FOR THE INDEXES
+                if interval[-1] == 'D':
+                    stamps = self.parse_stamps(self.symbol_data[i].index).values.astype(np.int64)
+                    self.symbol_data[i].index = stamps_to_index(stamps,daily=True)
+        self.align_symbol_data()
+
+    def check_database(self):
+        # csvs missing from the database are downloaded, existing ones are updated on request
         not_seen = []
         for i in self.symbols:
             path_check = os.path.exists(self.csv_path+'/'+i+'.csv') # checking for filled data
@@ -79,9 +140,12 @@ class AlpacaDataFrame(DataFrame):
         if len(not_seen) == 0:
             print('Data available for the requested symbol(s)')
             answers = ['y','n']
-            db_check = input('Perform update (requires internet) for potential new data? (Y/N): ')
-            while str(db_check).lower() not in answers:
-                db_check = input('Invalid Input. Please enter \'Y\' for YES and \'Y\' for NO (Y/N): ')
+            if self.update is None:
+                db_check = input('Perform update (requires internet) for potential new data? (Y/N): ')
+                while str(db_check).lower() not in answers:
+                    db_check = input('Invalid Input. Please enter \'Y\' for YES and \'Y\' for NO (Y/N): ')
+            else:
+                db_check = 'y' if self.update else 'n'
 
             if str(db_check).lower() == 'y':
                 self.update_database(symbols=self.symbols,interval=self.interval)
@@ -95,19 +159,11 @@ class AlpacaDataFrame(DataFrame):
             print('------------------------')
             print('Commencing Automatic Database Update...')
             self.update_database(symbols = self.symbols,interval=self.interval)
-        print('Initializing DataFrame...')
+
+    def align_symbol_data(self):
+        # timestamps follow the symbols' indexes, every symbol is reindexed onto them
+        indexes = None
         for i in self.symbols:
-            self.symbol_data[i] = pd.read_csv(
-                                        os.path.join(self.csv_path,
-                                        '{file_name}.{file_extension}'.format(file_name=i,
-                                        file_extension='csv')),
-                                        header = 0, index_col = 0)
-            
-            self.symbol_data[i].columns = columns # clean up columns
-            self.symbol_data[i] = self.symbol_data[i].sort_index() #sort index to make sure it's monotonic
-            # IF WE'RE DATAFRAME INTERVAL IS DAILY, WE'LL JUST GET RID OF TIME FOR THE INDEXES
-            if interval[-1] == 'D':
-                self.symbol_data[i].index = [d.split(' ')[0] for d in self.symbol_data[i].index]
             if indexes is None:
                 indexes = self.symbol_data[i].index
             else:
@@ -115,43 +171,23 @@ class AlpacaDataFrame(DataFrame):
         self.timestamps = indexes
         for i in self.symbols:
             self.symbol_data[i] = self.symbol_data[i].reindex(index=indexes)
-            self.bars_generator[i] = self.symbol_data[i].iterrows()
+        self.build_bar_store()
     
     #***
     def update_database(self,symbols, interval):
-        for i in symbols:
-            check = os.path.exists(self.csv_path+'/'+i+'.csv')
-            if check == True: #if data file exists
-                csv_data = pd.read_csv(os.path.join(self.csv_path,
-                                                '{file_name}.{file_extension}'.format(file_name = i,
-                                                file_extension = 'csv')),header = 0, index_col = 0)
-                if (((datetime.date.today().day) > (datetime.datetime.strptime(csv_data.index[-1],'%Y-%m-%d %H:%M:%S').day)) or ((datetime.date.today().month) > (datetime.datetime.strptime(csv_data.index[-1], '%Y-%m-%d %H:%M:%S').month))) and (datetime.date.today().weekday() < 5):
-                    # if today's day or month is later/more than csv's latest day or month (respectively)
-                    # AND that today isn't Saturday or Sunday
-                    # we will download new data and update
-                    print(i+ '\'s ' + 'OHLCV data is outdated. Updating...')
-                    result = self.get_alpaca_historic(i,interval)
-                    result = self.clean_symbol_data(result)
-                    result = result.drop(result.index.intersection(csv_data.index)) #resetting result data by dropping existing ones if there are any
-                    csv_data = csv_data.append(result)
-                    csv_data.to_csv(os.path.join(self.csv_path,
-                                '{file_name}.{file_extension}'.format(file_name = i,
-                                file_extension = 'csv')))
+        # all symbols are refreshed concurrently, each csv only gets the bars after its last stamp (downloader.py)
+        if self.downloader is None:
+            self.downloader = BarDownloader()
+        self.downloader.update(self.csv_path,symbols,interval,clean=self.clean_new_bars)
 
-                else:
-                    print(i+ '\'s ' + 'OHLCV data is up to date. No update needed.')
-                    pass
-            elif check == False: # if no data file exists
-                print(i+ '\'s ' + 'OHLCV data not found in database. Downloading and saving latest data...')
-                if os.path.exists(self.csv_path):
-                    pass
-                else:
-                    os.makedirs(self.csv_path)
-                result = self.get_alpaca_historic(i,interval)
-                result = self.clean_symbol_data(result)
-                result.to_csv(os.path.join(self.csv_path,
-                            '{file_name}.{file_extension}'.format(file_name = i,
-                             file_extension = 'csv'))) 
+    def clean_new_bars(self,symbol_data,last_stamp=None):
+        # downloaded bars -> rows to append: intraday bars go onto the session grid (the first day is only
+        # dropped for a new csv), without the empty bars at the end, i.e. not traded yet
+        if ((self.interval.lower() == 'day') or (self.interval[-1].lower() == 'd')) or len(symbol_data) == 0:
+            return symbol_data
+        symbol_data = self.fill_intraday(symbol_data,drop_first_day=(last_stamp is None))
+        traded = np.flatnonzero(symbol_data.notna().any(axis=1).values)
+        return symbol_data.iloc[:traded[-1]+1] if len(traded) > 0 else symbol_data.iloc[:0]
     
     #*
     def get_market_hours(self,y=None,m=None,d=None,mode = 'custom'):
@@ -230,53 +266,45 @@ class AlpacaDataFrame(DataFrame):
         if ((self.interval.lower() == 'day') or (self.interval[-1].lower() == 'd')):
             return symbol_data
         else:
-            df = pd.DataFrame().append(symbol_data)
-            df = self.fill_intraday(df)
-            return df
+            return self.fill_intraday(symbol_data)
     #***
-    def fill_intraday(self,symbol_data,interval=None):
+    def fill_intraday(self,symbol_data,interval=None,session_open='9:30',session_close='15:59',drop_first_day=True):
         # fill interval for symbol_data (for raw data downloaded)
-        #---First we will split our df into day by day---#
-        all_dfs = []
-        df = pd.DataFrame().append(symbol_data)
-        for group in df.groupby(pd.to_datetime(df.index).date):
-	        all_dfs.append(group[1])
-
-        all_dfs = all_dfs[1:]
-        
-        #---we will make a df_m with the consistent time interval to reindex---#
-        #--- open = 9am, close = 5pm ---#
-        df_m = pd.DataFrame(index=pd.Index(['2019-01-18 9:30:00', '2019-01-18 15:59:00'])) #string here is arbitrary as long as format fulfills frequency propagation and datetime conversion
-        df_m.index = pd.to_datetime(df_m.index)
-        if interval is None:
-            df_m = df_m.asfreq(self.interval)
-        else:
-            df_m = df_m.asfreq(interval)
-        df_m.index = pd.Index([str(dt) for dt in df_m.index])
-
-        #---Now we will use df_m's time index to "frequencize" our whole df day by day
-        new_dfs = []
-        for df in all_dfs:
-            date_str = df.index[0].split(' ')[0]
-            new_indexes = pd.Index([(date_str+' '+dt.split(' ')[1]) for dt in df_m.index])
-            new_df = df.reindex(new_indexes)  
-            new_dfs.append(new_df)
-
-        return pd.concat(new_dfs)
-    
-    def utc_to_est(self,symbol_data):
-        # convert stamps in symbol_data from UTC -> EST
-        df = pd.DataFrame().append(symbol_data)
-        df.index = pd.to_datetime(df.index)
-        df = df.tz_localize('UTC').tz_convert('EST')
-        df.index = pd.Index([str(dt).split('-05:00')[0] for dt in df.index])
+        # every trading day in the data (except the first, unless drop_first_day=False) gets the full session grid,
+        # session_open -> session_close every `interval`, missing bars are left as NaN
+        #---the grid is built with datetime64 arithmetic: days x session offsets---#
+        stamps = self.parse_stamps(symbol_data.index)
+        days = stamps.normalize().unique().sort_values()[1 if drop_first_day else 0:]
+        offsets = pd.timedelta_range(start=pd.Timedelta(session_open+':00'),end=pd.Timedelta(session_close+':00'),
+                                     freq=self.interval if interval is None else interval)
+        grid = (days.values[:,None] + offsets.values[None,:]).ravel()
+        #---Now we reindex the whole df onto the grid in one go---#
+        df = symbol_data.set_axis(stamps,axis=0).reindex(grid)
+        df.index = stamps_to_index(grid.astype(np.int64))
         return df
 
+    def parse_stamps(self,stamps):
+        # 'YYYY-mm-dd HH:MM:SS' (as written by get_alpaca_historic) or 'YYYY-mm-dd' strings -> DatetimeIndex
+        for stamp_format in ('%Y-%m-%d %H:%M:%S','%Y-%m-%d'):
+            try:
+                return pd.DatetimeIndex(pd.to_datetime(stamps,format=stamp_format))
+            except (ValueError, TypeError):
+                pass
+        return pd.DatetimeIndex(pd.to_datetime(stamps))
+
+    def utc_to_est(self,symbol_data,tz='EST'):
+        # convert stamps in symbol_data from UTC -> EST (or any other timezone, e.g. 'America/New_York')
+        stamps = self.parse_stamps(symbol_data.index).tz_localize('UTC').tz_convert(tz).tz_localize(None)
+        return symbol_data.set_axis(stamps_to_index(stamps.values.astype(np.int64)),axis=0)
+
     def add_data(self,symbols,periods=None,sma=False,ema=False,
                 arith_ret=False,hpfilter=False,log_ret=False,d1close=False,d2close=False,
-                rsi=False,ewma=False,wma=False,natr=False):
+                rsi=False,ewma=False,wma=False,natr=False,online=False,workers=None):
         #use to add any additional calculations for backtesting data
         #all calculations are performed on close price
+        #online = True updates the indicators bar by bar as update_bars moves forward (indicators.py)
+        #         instead of computing the whole history up front, the timeline is left untouched
+        #workers > 1 spreads the symbols over that many processes (same columns as the serial path)
         print('--------------------------------------------------------')
         print('----------ADDING REQUESTED DATA FROM STRATEGY-----------')
         print('--------------------------------------------------------')
@@ -303,88 +331,528 @@ class AlpacaDataFrame(DataFrame):
         if d2close == True:
             print('-> Second-Order Difference')
         print('--------------------------------------------------------')
+        if online:
+            if hpfilter:
+                raise ValueError('hpfilter needs the whole series, it is only available with online=False')
+            engine = OnlineIndicators(self,symbols,periods=periods,sma=sma,ema=ema,wma=wma,ewma=ewma,
+                                      rsi=rsi,natr=natr,arith_ret=arith_ret,log_ret=log_ret,
+                                      d1close=d1close,d2close=d2close)
+            engine.update() # bars already updated onto the dataframe (warm-up)
+            self.indicators.append(engine)
+            return engine
         new_stamps = None
         df = {}
         for i in self.symbol_data:
             df[i] = pd.DataFrame().append(self.symbol_data[i]).ffill()
+        source_keys = {}
+        if self.feature_cache is not None:
+            source_keys = {i:self.feature_source_key(i) for i in symbols}
+            lookups = self.feature_cache.stats['hits'] + self.feature_cache.stats['misses']
+            hits = self.feature_cache.stats['hits']
+        flags = {'sma':sma,'wma':wma,'ema':ema,'ewma':ewma,'arith_ret':arith_ret,'hpfilter':hpfilter,
+                 'log_ret':log_ret,'d1close':d1close,'d2close':d2close,'rsi':rsi,'natr':natr}
+        parallel = workers is not None and workers > 1 and len(symbols) > 1
+        if parallel:
+            # symbols spread over a process pool, prices and columns go through shared memory
+            columns = batch_features_parallel({i:df[i] for i in symbols},periods,flags,workers,
+                                              cache=self.feature_cache,source_keys=source_keys or None)
         for i in symbols:
-            if sma == True:
-                for p in periods:
-                    self.symbol_data[i]['sma'+str(p)] = talib.SMA(df[i]['close'],p)
-            if wma == True:
-                for p in periods:
-                    self.symbol_data[i]['wma'+str(p)] = talib.WMA(df[i]['close'],p)
-            if ema == True:
-                for p in periods:
-                    self.symbol_data[i]['ema'+str(p)] = talib.EMA(df[i]['close'],p)
-            if ewma == True:
-                for p in periods:
-                    self.symbol_data[i]['ewma'+str(p)] = talib.EMA(talib.WMA(df[i]['close'],p),p)
-            if arith_ret == True:
-                self.symbol_data[i]['arith_ret'] = (df[i]['close']/df[i]['close'].shift(1)) - 1
-            if hpfilter == True:
-                hpfilter = sm.tsa.filters.hpfilter(df[i]['close'])
-                self.symbol_data[i]['hptrend'] = hpfilter[1]
-                self.symbol_data[i]['hpnoise'] = hpfilter[0]
-            if log_ret == True:
-                self.symbol_data[i]['log_ret'] = np.log(df[i]['close']/df[i]['close'].shift(1))
-            if d1close == True:
-                self.symbol_data[i]['d1close'] = df[i]['close'] - df[i]['close'].shift(1)
-            if d2close == True:
-                self.symbol_data[i]['d2close'] = df[i]['close'] - df[i]['close'].shift(1)
-            if rsi == True:
-                for p in periods:
-                    self.symbol_data[i]['rsi'+str(p)] = talib.RSI(df[i]['close'],p)
-            if natr == True:
-                for p in periods:
-                    self.symbol_data[i]['natr'+str(p)] = talib.NATR(df[i]['high'],df[i]['low'],df[i]['close'],p)
+            if parallel:
+                symbol_columns = columns[i]
+            else:
+                feature = None
+                if self.feature_cache is not None:
+                    # indicator columns through the feature cache (feature_cache.py)
+                    feature = lambda name,params,compute: self.feature_cache.column(source_keys[i],name,params,compute)
+                symbol_columns = batch_features(df[i],periods,flags,feature)
+            for name,values in symbol_columns.items():
+                self.symbol_data[i][name] = np.asarray(values) # same index as df[i], no alignment needed
             
             self.symbol_data[i] = self.symbol_data[i].drop(self.symbol_data[i].head(max(periods)+10).drop(self.symbol_data[i].head(max(periods)+10).dropna().index).index)
             if new_stamps is None:
                 new_stamps = self.symbol_data[i].index
             else:
                 new_stamps.union(self.symbol_data[i].index)
+        if self.feature_cache is not None:
+            self.feature_cache.evict()
+            lookups = self.feature_cache.stats['hits'] + self.feature_cache.stats['misses'] - lookups
+            print('-> Feature cache:',self.feature_cache.stats['hits']-hits,'of',lookups,'columns loaded from cache')
+        latest_stamp = None
+        if self.cursor > 0:
+            latest_stamp = self.timestamps[self.cursor-1]
         self.timestamps = new_stamps
         for i in self.symbols:
             self.symbol_data[i] = self.symbol_data[i].reindex(index=new_stamps)
-            self.bars_generator[i] = self.symbol_data[i].iterrows()
+        self.build_bar_store(latest_stamp)
+
+    def build_bar_store(self,latest_stamp=None):
+        # copy symbol_data into one preallocated float64 array (symbols x time x fields)
+        # bars are never appended afterwards, update_bars only moves the cursor forward
+        # online indicator columns are not in symbol_data, they are carried over (reattach_indicators)
+        previous = (self.stamps,self.fields,self.bar_data) if len(self.indicators) > 0 else None
+        fields = []
+        for s in self.symbols:
+            for c in self.symbol_data[s].columns:
+                if c not in fields:
+                    fields.append(c)
+        self.fields = fields
+        self.symbol_index = {s:i for i,s in enumerate(self.symbols)}
+        self.build_timeline()
+        self.bar_data = np.empty((len(self.symbols),len(self.timestamps),len(self.fields)),dtype=np.float64)
+        for s,i in self.symbol_index.items():
+            self.bar_data[i] = self.symbol_data[s].reindex(columns=self.fields).to_numpy(dtype=np.float64)
+        # keep the cursor on the same stamp if the timeline was rebuilt mid-run (add_data)
+        if latest_stamp is not None and latest_stamp in self.timestamps:
+            self.cursor = self.timestamps.get_loc(latest_stamp) + 1
+        else:
+            self.cursor = 0
+        if previous is not None:
+            self.reattach_indicators(*previous)
+
+    def reattach_indicators(self,stamps,fields,bar_data):
+        # after a rebuild of the bar store: the online engines' fields are added back, their values copied
+        # over by stamp, and every engine carries on after the same stamp in the new timeline
+        rows = self.bar_lookup.get_indexer(stamps) # old bar -> new bar, -1 = not in the new timeline
+        kept = rows >= 0
+        for engine in self.indicators:
+            old_fields = [fields.index(f) for f in engine.output_names]
+            engine.attach()
+            for old,new in zip(old_fields,engine.field_index):
+                self.bar_data[:,rows[kept],new] = bar_data[:,kept,old]
+            engine.last_bar = int(rows[engine.last_bar-1]) + 1 if engine.last_bar > 0 else 0
+
+    def build_timeline(self):
+        # parse self.timestamps once into int64 epoch ns, everything per bar works on bar numbers afterwards
+        self.stamps = self.parse_stamps(self.timestamps).values.astype(np.int64)
+        self.bar_lookup = pd.Index(self.stamps) # hashed stamp -> bar number
+        day = self.stamps // NS_PER_DAY
+        self.new_day = np.ones(len(day),dtype=bool) # True on the first bar of every trading day
+        self.new_day[1:] = day[1:] != day[:-1]
+        self.day_starts = np.flatnonzero(self.new_day)
+
+    def get_bar_index(self, stamp):
+        # bar number of a stamp (epoch ns, datetime64, Timestamp or the 'YYYY-mm-dd ...' string)
+        if isinstance(stamp,str):
+            return self.timestamps.get_loc(stamp)
+        return self.bar_lookup.get_loc(pd.Timestamp(stamp).value)
+
+    def event_bar(self, event):
+        # bar number of an event: event.bar, or looked up from its stamp for events created without one
+        return event.bar if event.bar is not None else self.get_bar_index(event.stamp)
+
+    def feature_source_key(self, symbol):
+        # what add_data's columns of a symbol are computed from: its csv (path, mtime, size),
+        # or its OHLCV values for in-memory frames, plus its current timeline
+        return self.symbol_source(symbol)+'|'+timeline_digest(self.symbol_data[symbol].index)
+
+    def data_fingerprint(self):
+        # what the bar store is built from: every symbol's source and the merged timeline (optimizer_cache.py)
+        parts = [self.interval]
+        for s in self.symbols:
+            parts.append(self.symbol_source(s))
+        parts.append(hashlib.sha1(np.ascontiguousarray(self.stamps).tobytes()).hexdigest())
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+    def symbol_source(self, symbol):
+        if symbol in self.sources:
+            return '%s:%d:%d' % source_fingerprint(self.sources[symbol])
+        return frame_digest(self.symbol_data[symbol][['open','high','low','close','volume']])
+
+    def add_fields(self, names):
+        # extra per-bar fields in the bar store (NaN until written), returns their indexes in self.fields
+        new_fields = [f for f in names if f not in self.fields]
+        if len(new_fields) > 0:
+            grown = np.full(self.bar_data.shape[:2]+(len(self.fields)+len(new_fields),),np.nan)
+            grown[:,:,:len(self.fields)] = self.bar_data
+            self.bar_data = grown
+            self.fields = self.fields + new_fields
+        return [self.fields.index(f) for f in names]
+
+    def set_bar_values(self, bar, rows, fields, values):
+        # values: len(rows) x len(fields) written into one bar of the store
+        self.bar_data[:,bar][np.ix_(rows,fields)] = values
+
+    #---------------------------------CHECKPOINTS (checkpoint.py)--------------------------------#
+
+    def get_state(self):
+        # the bars themselves are rebuilt from the csvs when resuming, only the position in them is saved
+        return {'cursor':self.cursor,'continue_backtest':self.continue_backtest,
+                'lookback':-1 if self.lookback is None else self.lookback,
+                'indicators':{str(k):engine.get_state() for k,engine in enumerate(self.indicators)}}
+
+    def set_state(self, state):
+        self.cursor = scalar(state['cursor'])
+        self.continue_backtest = scalar(state['continue_backtest'])
+        self.lookback = None if scalar(state['lookback']) < 0 else scalar(state['lookback'])
+        for k,engine in enumerate(self.indicators):
+            engine.set_state(state['indicators'][str(k)])
+
+    def indicator_fields(self):
+        # bar store fields written bar by bar by the online indicator engines
+        return sorted(set(f for engine in self.indicators for f in engine.field_index))
+
+    def fields_state(self, first):
+        # online indicator values of bars [first, cursor), final once written
+        fields = self.indicator_fields()
+        if len(fields) == 0:
+            return {}
+        return {'first':first,'values':self.bar_data[:,first:self.cursor][:,:,fields]}
+
+    def set_fields(self, state):
+        if 'first' not in state:
+            return
+        first = scalar(state['first'])
+        bars = np.arange(first,first+state['values'].shape[1])
+        self.bar_data[np.ix_(np.arange(len(self.symbols)),bars,self.indicator_fields())] = state['values']
+
+    def set_lookback(self, lookback):
+        # strategies declare how many past bars (including the latest) they read, None = all of them
+        # with a lookback declared, N = 0 / latest_symbol_data only reach back that many bars
+        if self.shared:
+            lookback = widest_lookback(self.lookback,lookback)
+        self.lookback = lookback
+
+    @property
+    def first_bar(self):
+        # earliest bar that can still be read back
+        if self.lookback is None:
+            return 0
+        return max(self.cursor-self.lookback,0)
+
+    def get_bar_window(self, start, stop):
+        # bars [start, stop) of every symbol as one (symbols x bars x fields) view of the store
+        return self.bar_data[:,start:stop]
+
+    @property
+    def latest_stamps(self):
+        # stamps of bars that have been updated onto the dataframe
+        return self.timestamps[:self.cursor]
 
     def load_warm_up(self,percent):
         count = int(percent*len(self.timestamps))
         print('---|LOADING',str(count),'WARM-UP BARS AS',str(percent*100)+'%',' OF AVAILABLE HISTORICAL DATA|---')
-        self.latest_stamps = self.timestamps[:count]
-        for s in self.symbols:
-            self.latest_symbol_data[s] = self.symbol_data[s].loc[self.latest_stamps]
-            self.bars_generator[s] = self.symbol_data[s].drop(self.latest_symbol_data[s].index).iterrows()
-
-    def get_new_bar(self,symbol):
-        new_bar = next(self.bars_generator[symbol])
-        return new_bar[1] #return a pandas series to be appended to latest_symbol_data
+        self.cursor = count
 
     def update_bars(self):
-        #before updating bars, we need to grab the next timestamp and delete it from our existing ones
-        try:
-            for s in self.symbols:
-                bar = self.get_new_bar(s)
-                if bar.name not in list(self.latest_stamps):
-                    self.latest_stamps = self.latest_stamps.append(pd.Index([bar.name]))
-                self.latest_symbol_data[s] = self.latest_symbol_data[s].append(bar)
-            self.events.put(MarketEvent(self.latest_stamps[-1])) #FIRST START, IMPORTANT
-        except StopIteration:
+        # a new bar is just the next row of the preallocated store, constant cost per bar
+        if self.cursor >= len(self.timestamps):
             self.continue_backtest = False
             print('BACKTEST COMPLETE.')
-            
+            return
+        self.cursor += 1
+        for engine in self.indicators:
+            engine.update()
+        self.events.put(MarketEvent(self.timestamps[self.cursor-1],self.cursor-1)) #FIRST START, IMPORTANT
+
     def get_latest_bars(self, symbol, N=1):
+        # returns zero-copy views into the bar store, up to the cursor
         try:
-            bars_list = self.latest_symbol_data[symbol]
+            i = self.symbol_index[symbol]
         except KeyError:
             return 'Symbol is not available from historical data'
         else:
-            if N == 0: #N = 0 is set to return ALL bars updated on the dataframe
-                return bars_list
+            if N == 0: #N = 0 is set to return ALL bars updated on the dataframe (within the lookback)
+                start = self.first_bar
             elif N == 1:
-                return bars_list.iloc[-N]
+                return pd.Series(self.get_bar_window(self.cursor-1,self.cursor)[i,0],index=self.fields,
+                                name=self.timestamps[self.cursor-1])
             elif N < 0:
                 print('N needs to be an integer >= 0')
+                return None
             elif N > 0:
-                return bars_list.iloc[-N:]
\ No newline at end of file
+                start = max(self.cursor-N,self.first_bar)
+            return pd.DataFrame(self.get_bar_window(start,self.cursor)[i],
+                                index=self.timestamps[start:self.cursor],
+                                columns=self.fields,copy=False)
+
+    def get_latest_values(self, field='close'):
+        # latest value of one field across all symbols (ordered as self.symbols), as a view
+        return self.get_bar_window(self.cursor-1,self.cursor)[:,0,self.fields.index(field)]
+
+
+# ------------------------------------------------------------------------------------------------------
+# STREAMING DATAFRAME
+# same interface as AlpacaDataFrame for csv databases larger than memory: every symbol's csv is read
+# in chunks of chunk_size rows, merged with the other symbols on timestamp and written into a
+# ring buffer as update_bars reaches them. Only the bars inside the lookback (set_lookback) plus the
+# current chunk are held in memory, without a lookback every bar is kept (the buffer grows).
+# csv rows need to be in time order.
+# ------------------------------------------------------------------------------------------------------
+class StreamingAlpacaDataFrame(AlpacaDataFrame):
+
+    def __init__(self, events, csv_path, symbols, interval, chunk_size=10000, lookback=None,
+                warm_up=0.25, update=None, downloader=None):
+        self.chunk_size = chunk_size
+        self.readers = {} # symbol -> csv chunk iterator
+        self.pending = {} # symbol -> rows read from its csv, not written into the buffer yet
+        self.rows_read = {} # symbol -> csv rows read so far (readers reopen past them when resuming)
+        self.loaded = 0 # bars before this one have been written into the buffer
+        # lookback is needed before the warm-up bars are streamed through, so it can be passed here
+        super().__init__(events, csv_path, symbols, interval, use_cache=False, warm_up=warm_up, update=update,
+                        lookback=lookback, downloader=downloader)
+
+    def initialize_df(self,interval):
+        self.ohlcv = ['open','high','low','close','volume'] # csv columns, fields can grow (add_fields)
+        self.fields = list(self.ohlcv)
+        self.symbol_index = {s:i for i,s in enumerate(self.symbols)}
+        self.check_database()
+        print('Initializing Streaming DataFrame...')
+        self.scan_timeline()
+        for s in self.symbols:
+            self.open_reader(s)
+            self.pending[s] = pd.DataFrame(columns=self.ohlcv,dtype=np.float64)
+        # no full history store here (bar_data), bars are read back through get_bar_window
+        self.ring = RingBuffer(len(self.symbols),self.buffer_capacity(self.lookback),len(self.fields))
+
+    def open_reader(self,symbol,skip=0):
+        # csv chunk iterator of a symbol, past its first `skip` rows
+        self.readers[symbol] = pd.read_csv(self.symbol_csv(symbol),header = 0, index_col = 0,
+                                           chunksize = self.chunk_size,
+                                           skiprows = range(1,skip+1) if skip > 0 else None)
+        self.rows_read[symbol] = skip
+
+    def buffer_capacity(self,lookback):
+        # the next chunk is written while the lookback bars before the cursor are still read
+        if lookback is None:
+            return 2*self.chunk_size
+        return lookback + self.chunk_size
+
+    def symbol_csv(self,symbol):
+        return os.path.join(self.csv_path,'{file_name}.{file_extension}'.format(file_name=symbol,
+                                                                             file_extension='csv'))
+
+    def symbol_source(self, symbol):
+        return '%s:%d:%d' % source_fingerprint(self.symbol_csv(symbol))
+
+    def clean_stamps(self,stamps):
+        # IF WE'RE DATAFRAME INTERVAL IS DAILY, WE'LL JUST GET RID OF TIME FOR THE INDEXES
+        if self.interval[-1] == 'D':
+            return stamps.str.split(' ').str[0]
+        return stamps
+
+    def clean_chunk(self,chunk):
+        chunk.columns = self.ohlcv
+        chunk.index = self.clean_stamps(chunk.index)
+        return chunk
+
+    def scan_timeline(self):
+        # the merged timeline is the union of every symbol's stamps, read one chunk at a time
+        # (stamps only, the bars themselves are not loaded here)
+        timeline = None
+        for s in self.symbols:
+            stamps = pd.Index(np.concatenate([self.clean_stamps(chunk.index).to_numpy(dtype=object)
+                                              for chunk in pd.read_csv(self.symbol_csv(s),header = 0, index_col = 0,
+                                                                       usecols = [0], chunksize = self.chunk_size)]))
+            if timeline is None:
+                timeline = stamps.unique().sort_values()
+            elif not timeline.equals(stamps):
+                timeline = timeline.union(stamps) # sorted merge, the csvs are in time order
+        self.timestamps = timeline
+        self.build_timeline()
+
+    def read_rows(self,symbol,last_stamp):
+        # rows of symbol up to last_stamp, reading more chunks from its csv when needed
+        frames = [self.pending[symbol]]
+        while len(frames[-1]) == 0 or frames[-1].index[-1] <= last_stamp:
+            chunk = next(self.readers[symbol],None)
+            if chunk is None:
+                break
+            self.rows_read[symbol] += len(chunk)
+            frames.append(self.clean_chunk(chunk))
+        rows = pd.concat(frames) if len(frames) > 1 else frames[0]
+        if not rows.index.is_monotonic_increasing:
+            raise ValueError(symbol+'.csv rows are not in time order, streaming needs sorted csvs')
+        split = rows.index.searchsorted(last_stamp,side='right')
+        self.pending[symbol] = rows.iloc[split:]
+        return rows.iloc[:split]
+
+    def load_chunk(self):
+        # merge the next chunk_size stamps of every symbol into the buffer
+        stamps = self.timestamps[self.loaded:self.loaded+self.chunk_size]
+        if len(stamps) == 0:
+            return
+        block = np.empty((len(self.symbols),len(stamps),len(self.fields)),dtype=np.float64)
+        for s,i in self.symbol_index.items():
+            block[i] = self.read_rows(s,stamps[-1]).reindex(index=stamps,columns=self.fields).to_numpy(dtype=np.float64)
+        if self.lookback is None and self.ring.count + len(stamps) > self.ring.capacity:
+            self.ring.resize(max(2*self.ring.capacity,self.ring.count+len(stamps))) # every bar is kept
+        self.ring.write(block)
+        self.loaded += len(stamps)
+
+    @property
+    def first_bar(self):
+        return max(self.ring.first,0 if self.lookback is None else self.cursor-self.lookback)
+
+    def get_bar_window(self, start, stop):
+        return self.ring.view(start,stop)
+
+    def set_lookback(self, lookback):
+        # bars already dropped cannot be brought back: a larger lookback has to be passed to the constructor
+        if self.shared:
+            lookback = widest_lookback(self.lookback,lookback)
+        if self.ring.first > 0 and (lookback is None or lookback > self.cursor - self.ring.first):
+            raise ValueError('lookback of '+str(lookback)+' bars needs bars already dropped from the stream, '
+                             'pass lookback='+str(lookback)+' when creating the StreamingAlpacaDataFrame')
+        self.lookback = lookback
+        if lookback is not None:
+            self.ring.resize(self.buffer_capacity(lookback))
+
+    def load_warm_up(self,percent):
+        count = int(percent*len(self.timestamps))
+        print('---|STREAMING',str(count),'WARM-UP BARS AS',str(percent*100)+'%',' OF AVAILABLE HISTORICAL DATA|---')
+        while self.loaded < count:
+            self.cursor = self.loaded
+            self.load_chunk()
+        self.cursor = count
+
+    def update_bars(self):
+        if self.cursor >= len(self.timestamps):
+            self.continue_backtest = False
+            print('BACKTEST COMPLETE.')
+            return
+        if self.cursor >= self.loaded:
+            self.load_chunk()
+        self.cursor += 1
+        for engine in self.indicators:
+            engine.update()
+        self.events.put(MarketEvent(self.timestamps[self.cursor-1],self.cursor-1))
+
+    def add_data(self,symbols,periods=None,online=True,**indicators):
+        # the batch pass needs the whole history in memory, here the same columns always come from the
+        # online engine (talib's values bar by bar) and online=False is accepted for the same call:
+        # the leading rows are not trimmed and hpfilter (whole series) is not available
+        if indicators.get('hpfilter'):
+            raise ValueError('hpfilter needs the whole series, it is only available on AlpacaDataFrame')
+        return super().add_data(symbols,periods=periods,online=True,**indicators)
+
+    def add_fields(self, names):
+        new_fields = [f for f in names if f not in self.fields]
+        if len(new_fields) > 0:
+            self.ring.add_fields(len(new_fields))
+            self.fields = self.fields + new_fields
+        return [self.fields.index(f) for f in names]
+
+    def set_bar_values(self, bar, rows, fields, values):
+        self.ring.set(bar,rows,fields,values)
+
+    def get_state(self):
+        # the buffered bars (lookback + current chunk, indicator values included) and the csv rows
+        # read ahead of them, plus how far every csv was read
+        state = super().get_state()
+        state['loaded'] = self.loaded
+        state['ring'] = {'count':self.ring.count,'capacity':self.ring.capacity,
+                         'bars':self.ring.view(self.ring.first,self.ring.count).copy()}
+        state['pending'] = {s:{'stamps':self.pending[s].index.to_numpy(dtype=str),
+                               'values':self.pending[s].to_numpy(dtype=np.float64)} for s in self.symbols}
+        state['rows_read'] = {s:self.rows_read[s] for s in self.symbols}
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.loaded = scalar(state['loaded'])
+        ring = state['ring']
+        self.ring = RingBuffer(len(self.symbols),scalar(ring['capacity']),len(self.fields))
+        self.ring.count = self.ring.first = scalar(ring['count']) - ring['bars'].shape[1]
+        self.ring.write(ring['bars'])
+        for s in self.symbols:
+            pending = state['pending'][s]
+            self.pending[s] = pd.DataFrame(pending['values'],index=pd.Index(pending['stamps'].tolist(),dtype=object),
+                                           columns=self.ohlcv)
+            self.open_reader(s,scalar(state['rows_read'][s]))
+
+    def fields_state(self, first):
+        return {} # indicator values are in the saved buffer
+
+    def set_fields(self, state):
+        pass
+
+
+
+# ------------------------------------------------------------------------------------------------------
+# RING BUFFER
+# fixed-capacity circular store of bars (symbols x capacity x fields). Every bar is written twice,
+# at its slot and at slot + capacity, so the latest `capacity` bars always form one contiguous
+# slice: views of the last N bars never need re-copying, and memory stays flat however long the run.
+# ------------------------------------------------------------------------------------------------------
+class RingBuffer(object):
+
+    def __init__(self, n_symbols, capacity, n_fields):
+        self.capacity = capacity
+        self.data = np.full((n_symbols,2*capacity,n_fields),np.nan,dtype=np.float64)
+        self.count = 0 # bars written so far
+        self.first = 0 # earliest bar still held
+
+    def write(self, bars):
+        # bars: symbols x n x fields, appended after the last bar written
+        n = bars.shape[1]
+        if n > self.capacity:
+            self.count += n-self.capacity
+            bars = bars[:,n-self.capacity:]
+            n = self.capacity
+        slots = (self.count + np.arange(n)) % self.capacity
+        self.data[:,slots] = bars
+        self.data[:,slots+self.capacity] = bars
+        self.count += n
+        self.first = max(self.first,self.count-self.capacity)
+
+    def view(self, start, stop):
+        # bars [start, stop) as a contiguous view
+        if start < self.first or stop > self.count or start > stop:
+            raise IndexError('bars '+str(start)+' to '+str(stop)+' are not in the buffer (holds '
+                             +str(self.first)+' to '+str(self.count)+')')
+        if stop == start:
+            return self.data[:,:0]
+        end = (stop-1) % self.capacity + self.capacity + 1
+        return self.data[:,end-(stop-start):end]
+
+    def set(self, bar, rows, fields, values):
+        # values: len(rows) x len(fields) written into both copies of one bar
+        if bar < self.first or bar >= self.count:
+            raise IndexError('bar '+str(bar)+' is not in the buffer')
+        slot = bar % self.capacity
+        for s in (slot,slot+self.capacity):
+            self.data[:,s][np.ix_(rows,fields)] = values
+
+    def add_fields(self, n_fields):
+        # n_fields more fields (NaN) for every bar held
+        grown = np.full(self.data.shape[:2]+(self.data.shape[2]+n_fields,),np.nan)
+        grown[:,:,:self.data.shape[2]] = self.data
+        self.data = grown
+
+    def resize(self, capacity):
+        # new capacity, keeping the latest bars that still fit
+        kept = self.view(max(self.first,self.count-capacity),self.count).copy()
+        count = self.count
+        self.capacity = capacity
+        self.data = np.full((self.data.shape[0],2*capacity,self.data.shape[2]),np.nan,dtype=np.float64)
+        self.count = self.first = count - kept.shape[1]
+        self.write(kept)
+
+
+class LatestSymbolData(object):
+
+    # dict-like access to latest_symbol_data, backed by the dataframe's bar store
+    # each lookup is a zero-copy DataFrame view of the bars updated so far
+
+    def __init__(self, bars):
+        self.bars = bars
+
+    def __getitem__(self, symbol):
+        if symbol not in self.bars.symbol_index:
+            raise KeyError(symbol)
+        return self.bars.get_latest_bars(symbol,N=0)
+
+    def __contains__(self, symbol):
+        return symbol in self.bars.symbol_index
+
+    def __iter__(self):
+        return iter(self.bars.symbol_index)
+
+    def __len__(self):
+        return len(self.bars.symbol_index)
+
+    def keys(self):
+        return list(self.bars.symbol_index)
+
+    def items(self):
+        return [(s,self[s]) for s in self.bars.symbol_index]
\ No newline at end of file
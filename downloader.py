@@ -0,0 +1,331 @@
+import os, os.path
+import json
+import time
+import asyncio
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import numpy as np
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+from bar_cache import stamps_to_index
+
+
+# ------------------------------------------------------------------------------------------------------
+# MARKET DATA DOWNLOADER
+# refreshes the csv database concurrently: every symbol only fetches the bars after its csv's last stamp
+# (read from the end of the file) and appends just the new rows. Requests go through asyncio with a
+# bounded connection pool (semaphore + thread executor for the blocking http calls) and a token bucket
+# per provider, bars are decoded into numpy arrays one page at a time.
+# Speaks the Alpaca v1 bars endpoint, base_url can point anywhere serving the same payloads (StubBarServer)
+# ------------------------------------------------------------------------------------------------------
+
+BASE_URL = 'https://data.alpaca.markets'
+TIMEZONE = 'America/New_York' # csv stamps are exchange time
+FIELDS = ['open','high','low','close','volume']
+BAR_KEYS = ['t','o','h','l','c','v'] # epoch seconds + OHLCV in the v1 payload
+
+
+class TokenBucket(object):
+
+    # at most `rate` requests per second on average, bursts of up to `capacity`
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(capacity or rate,1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,self.tokens + (now-self.updated)*self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1-self.tokens)/self.rate)
+
+
+class BarDownloader(object):
+
+    def __init__(self, key_id=None, secret_key=None, base_url=None, max_connections=8, rate=200/60,
+                burst=None, limit=1000, years_ago=10, retries=3, timeout=30, backoff=1.0):
+        # keys default to the same environment variables alpaca_trade_api reads
+        self.key_id = key_id or os.environ.get('APCA_API_KEY_ID','')
+        self.secret_key = secret_key or os.environ.get('APCA_API_SECRET_KEY','')
+        self.base_url = (base_url or os.environ.get('APCA_API_DATA_URL',BASE_URL)).rstrip('/')
+        self.max_connections = max_connections
+        self.rate = rate # requests per second (Alpaca: 200 per minute)
+        self.burst = burst
+        self.limit = limit # bars per request
+        self.years_ago = years_ago # history fetched for a symbol without a csv
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff # seconds before the first retry, doubled on every further one
+        self.stats = {'requests':0,'retries':0,'bars':0,'rows_written':0,'seconds':0.0}
+        self.connections = None # created with the event loop (update_all)
+        self.bucket = None
+        self.executor = None
+
+    #---------------------------------HTTP--------------------------------#
+
+    def http_get(self, url):
+        # blocking, runs in the executor
+        request = urllib.request.Request(url,headers={'APCA-API-KEY-ID':self.key_id,
+                                                      'APCA-API-SECRET-KEY':self.secret_key})
+        with urllib.request.urlopen(request,timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    async def request(self, timeframe, symbol, after, before=None):
+        params = {'symbols':symbol,'limit':self.limit,'after':after}
+        if before is not None:
+            params['before'] = before
+        url = self.base_url+'/v1/bars/'+timeframe+'?'+urllib.parse.urlencode(params)
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries+1):
+            await self.bucket.acquire()
+            async with self.connections:
+                try:
+                    self.stats['requests'] += 1
+                    payload = await loop.run_in_executor(self.executor,self.http_get,url)
+                    return payload.get(symbol,[])
+                except urllib.error.HTTPError as e:
+                    if (e.code != 429 and e.code < 500) or attempt == self.retries:
+                        raise
+                except urllib.error.URLError:
+                    if attempt == self.retries:
+                        raise
+            self.stats['retries'] += 1
+            await asyncio.sleep(self.backoff*2**attempt) # rate limited or server error: back off and retry
+
+    #---------------------------------BARS--------------------------------#
+
+    def decode(self, bars):
+        # one page of bar dicts -> (int64 epoch seconds, float64 n x 5 OHLCV) in bulk
+        if len(bars) == 0:
+            return np.zeros(0,dtype=np.int64), np.zeros((0,len(FIELDS)),dtype=np.float64)
+        values = pd.DataFrame.from_records(bars,columns=BAR_KEYS).to_numpy(dtype=np.float64)
+        return values[:,0].astype(np.int64), values[:,1:]
+
+    async def fetch_bars(self, symbol, timeframe, after):
+        # every bar after `after`: the endpoint returns the latest `limit` bars of the range,
+        # so pages are walked backwards until one comes back short
+        pages = []
+        before = None
+        while True:
+            seconds, ohlcv = self.decode(await self.request(timeframe,symbol,after,before))
+            if len(seconds) > 0:
+                pages.append((seconds,ohlcv))
+            if len(seconds) < self.limit:
+                break
+            before = pd.Timestamp(int(seconds[0]),unit='s',tz='UTC').isoformat()
+        if len(pages) == 0:
+            return self.decode([])
+        pages.reverse()
+        seconds = np.concatenate([p[0] for p in pages])
+        ohlcv = np.concatenate([p[1] for p in pages])
+        order = np.argsort(seconds,kind='stable')
+        seconds, first = np.unique(seconds[order],return_index=True) # pages can share their edge bar
+        self.stats['bars'] += len(seconds)
+        return seconds, ohlcv[order][first]
+
+    def to_frame(self, seconds, ohlcv):
+        # exchange time stamps, same 'YYYY-mm-dd HH:MM:SS' strings as the rest of the database
+        stamps = pd.DatetimeIndex(seconds.astype('datetime64[s]')).tz_localize('UTC').tz_convert(TIMEZONE).tz_localize(None)
+        return pd.DataFrame(ohlcv,columns=FIELDS,index=stamps_to_index(stamps.values.astype(np.int64)))
+
+    #---------------------------------CSV--------------------------------#
+
+    def last_stamp(self, csv_file):
+        # last stamp of a csv, read from its tail only
+        with open(csv_file,'rb') as f:
+            f.seek(0,os.SEEK_END)
+            size = f.tell()
+            block = 4096
+            while True:
+                f.seek(max(size-block,0))
+                lines = f.read().splitlines()
+                lines = [l for l in lines if l.strip()]
+                if len(lines) > 1 or block >= size:
+                    break
+                block *= 2
+        if len(lines) < 2: # header only
+            return None
+        return lines[-1].split(b',')[0].decode('utf-8')
+
+    def append_rows(self, csv_file, rows):
+        # new rows at the end of the csv, the existing ones are never re-read or rewritten
+        exists = os.path.exists(csv_file)
+        if exists and os.path.getsize(csv_file) > 0:
+            with open(csv_file,'rb+') as f:
+                f.seek(-1,os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+        rows.to_csv(csv_file,mode='a' if exists else 'w',header=not exists)
+        self.stats['rows_written'] += len(rows)
+
+    #---------------------------------UPDATES--------------------------------#
+
+    async def update_symbol(self, csv_path, symbol, timeframe, clean=None):
+        csv_file = os.path.join(csv_path,'{file_name}.{file_extension}'.format(file_name=symbol,file_extension='csv'))
+        last = self.last_stamp(csv_file) if os.path.exists(csv_file) else None
+        if last is None:
+            print(symbol+ '\'s ' + 'OHLCV data not found in database. Downloading and saving latest data...')
+            after = pd.Timestamp(year=pd.Timestamp.today().year-self.years_ago,month=1,day=1,tz='UTC').isoformat()
+        else:
+            after = pd.Timestamp(last).tz_localize(TIMEZONE).isoformat()
+        rows = self.to_frame(*(await self.fetch_bars(symbol,timeframe,after)))
+        if clean is not None:
+            rows = clean(rows,last)
+        if last is not None:
+            rows = rows[rows.index > last]
+        if len(rows) == 0:
+            print(symbol+ '\'s ' + 'OHLCV data is up to date. No update needed.')
+        else:
+            self.append_rows(csv_file,rows)
+            print(symbol+ '\'s ' + 'OHLCV data updated with',len(rows),'new bars.')
+        return len(rows)
+
+    async def update_all(self, csv_path, symbols, timeframe, clean=None):
+        self.connections = asyncio.Semaphore(self.max_connections)
+        self.bucket = TokenBucket(self.rate,self.burst)
+        with ThreadPoolExecutor(max_workers=self.max_connections) as self.executor:
+            results = await asyncio.gather(*[self.update_symbol(csv_path,s,timeframe,clean) for s in symbols],
+                                           return_exceptions=True)
+        updated = {}
+        for s,r in zip(symbols,results):
+            if isinstance(r,BaseException):
+                print(s+'\'s update failed:',repr(r))
+            updated[s] = r
+        return updated
+
+    def update(self, csv_path, symbols, timeframe, clean=None):
+        # {symbol: new rows written (or the exception it failed with)}
+        # clean(rows, last_stamp) can reshape the downloaded rows before they are written
+        if not os.path.exists(csv_path):
+            os.makedirs(csv_path)
+        start = time.perf_counter()
+        updated = asyncio.run(self.update_all(csv_path,list(symbols),timeframe,clean))
+        self.stats['seconds'] += time.perf_counter() - start
+        return updated
+
+    def report(self):
+        stats = self.stats
+        print('<<-------| DOWNLOADER REPORT |------->>')
+        print('Requests:',stats['requests'],' Retries:',stats['retries'],' Bars:',stats['bars'],
+              ' Rows Written:',stats['rows_written'])
+        print('Time (s):',round(stats['seconds'],4),' Requests/s:',round(stats['requests']/max(stats['seconds'],1e-9),2))
+
+
+# ------------------------------------------------------------------------------------------------------
+# STUB BAR SERVER
+# local http server answering /v1/bars/<timeframe> from recorded payloads ({timeframe: {symbol: [bars]}},
+# the same bar dicts the endpoint returns), with the endpoint's after/before/limit semantics.
+# Point BarDownloader(base_url=server.url) at it to exercise the downloader offline.
+# errors -> http status codes answered to the next requests, in order (e.g. [429, 500] to test retries)
+# ------------------------------------------------------------------------------------------------------
+class StubBarServer(object):
+
+    def __init__(self, payloads, host='127.0.0.1', port=0, delay=0.0, errors=None):
+        if isinstance(payloads,str):
+            with open(payloads) as f:
+                payloads = json.load(f)
+        self.payloads = {tf:{s:sorted(bars,key=lambda b: b['t']) for s,bars in symbols.items()}
+                         for tf,symbols in payloads.items()}
+        self.delay = delay # seconds added to every response, to simulate latency
+        self.errors = list(errors or [])
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host,port),self.handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host,port)
+
+    def bars(self, timeframe, symbols, after=None, before=None, limit=1000):
+        result = {}
+        for s in symbols:
+            bars = self.payloads.get(timeframe,{}).get(s,[])
+            if after is not None:
+                bars = [b for b in bars if b['t'] > after]
+            if before is not None:
+                bars = [b for b in bars if b['t'] < before]
+            result[s] = bars[-limit:] # latest bars of the range
+        return result
+
+    def handler(self):
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                parts = url.path.strip('/').split('/')
+                if len(parts) != 3 or parts[:2] != ['v1','bars']:
+                    self.send_error(404)
+                    return
+                query = urllib.parse.parse_qs(url.query)
+                seconds = lambda k: pd.Timestamp(query[k][0]).timestamp() if k in query else None
+                with stub.lock:
+                    stub.requests += 1
+                    error = stub.errors.pop(0) if len(stub.errors) > 0 else None
+                if error is not None:
+                    self.send_error(error)
+                    return
+                if stub.delay > 0:
+                    time.sleep(stub.delay)
+                body = json.dumps(stub.bars(parts[2],query.get('symbols',[''])[0].split(','),seconds('after'),
+                                            seconds('before'),int(query.get('limit',['1000'])[0]))).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type','application/json')
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    # python downloader.py --interval 1Min SPY AAPL MSFT
+    # python downloader.py --serve recorded_bars.json --port 8080   (stub server for offline runs)
+    parser = argparse.ArgumentParser(description='Incrementally update the csv database, or serve recorded bars')
+    parser.add_argument('symbols',nargs='*')
+    parser.add_argument('--csv_path',default=os.path.join(os.getcwd(),'database'))
+    parser.add_argument('--interval',default='1D')
+    parser.add_argument('--base_url',default=None)
+    parser.add_argument('--max_connections',type=int,default=8)
+    parser.add_argument('--rate',type=float,default=200/60,help='requests per second')
+    parser.add_argument('--serve',default=None,help='recorded payloads json to serve instead')
+    parser.add_argument('--port',type=int,default=8080)
+    args = parser.parse_args()
+    if args.serve is not None:
+        server = StubBarServer(args.serve,port=args.port)
+        print('Serving recorded bars ->',server.url)
+        server.server.serve_forever()
+    else:
+        downloader = BarDownloader(base_url=args.base_url,max_connections=args.max_connections,rate=args.rate)
+        downloader.update(os.path.join(args.csv_path,args.interval.lower()),args.symbols,args.interval)
+        downloader.report()
@@ -1,22 +1,66 @@
+import queue
+import numpy as np
+from enum import Enum
+from collections import deque
+
+
+# EVENT TYPE CODES, used as keys of the backtest loop's handler registry
+# (a str enum, so comparing against the old 'MARKET'/'SIGNAL'/... strings still works)
+class EventType(str, Enum):
+    MARKET = 'MARKET'
+    SIGNAL = 'SIGNAL'
+    ORDER = 'ORDER'
+    FILL = 'FILL'
+    REBALANCE = 'REBALANCE'
+    BATCH_ORDER = 'BATCH_ORDER'
+    BATCH_FILL = 'BATCH_FILL'
+
+
+# EVENT QUEUE: lock-free FIFO for single-threaded backtests
+# keeps queue.Queue's put()/get()/empty() so components can place events the same way
+class EventQueue(deque):
+
+    __slots__ = ()
+
+    put = deque.append
+
+    def get(self, block=False):
+        if not self:
+            raise queue.Empty
+        return self.popleft()
+
+    def empty(self):
+        return not self
+
+    def qsize(self):
+        return len(self)
+
+
 class Event(object):
-    pass
+    __slots__ = ()
 
 
-# ALL EVENTS CONTAIN TIMESTAMP
+# ALL EVENTS CONTAIN TIMESTAMP, AND THE BAR NUMBER (integer index into the dataframe's timeline) IT BELONGS TO
+# event classes use __slots__ and a class-level type code, so every event is a compact fixed-layout object
 
 
 # MARKET EVENT = NEW DATAPOINT IS RELEASED/NEW TICK APPEARED ON SCREEN
 class MarketEvent(Event):
 
-    def __init__(self, stamp):
-        self.type = 'MARKET'
+    __slots__ = ('stamp','bar')
+    type = EventType.MARKET
+
+    def __init__(self, stamp, bar=None):
         self.stamp = stamp
+        self.bar = bar
 
-# SIGNAL EVENT: NEW SIGNAL AVAILABLE FROM STRATEGY, TELLING PORTFOLIO TO BUY OR SELL, with stamp of when signal released       
+# SIGNAL EVENT: NEW SIGNAL AVAILABLE FROM STRATEGY, TELLING PORTFOLIO TO BUY OR SELL, with stamp of when signal released
 class SignalEvent(Event):
 
-    def __init__(self,symbol,stamp,order_type,action,shares,limit_price=None,stop_price=None):
-        self.type = 'SIGNAL'
+    __slots__ = ('symbol','shares','action','order_type','limit_price','stop_price','stamp','bar')
+    type = EventType.SIGNAL
+
+    def __init__(self,symbol,stamp,order_type,action,shares,limit_price=None,stop_price=None,bar=None):
         self.symbol = symbol
         self.shares= shares
         self.action = action # BUY, SELL
@@ -24,12 +68,15 @@ class SignalEvent(Event):
         self.limit_price = limit_price
         self.stop_price = stop_price
         self.stamp = stamp
+        self.bar = bar
 
 # ORDER EVENT: NEW ORDER PLACED BY PORTFOLIO
 class OrderEvent(Event):
 
-    def __init__(self,symbol,stamp,order_type,action,shares,limit_price=None,stop_price=None):
-        self.type = 'ORDER'
+    __slots__ = ('symbol','shares','action','order_type','limit_price','stop_price','stamp','bar')
+    type = EventType.ORDER
+
+    def __init__(self,symbol,stamp,order_type,action,shares,limit_price=None,stop_price=None,bar=None):
         self.symbol = symbol
         self.shares = shares # int64
         self.action = action # 'BUY','SELL'
@@ -37,6 +84,7 @@ class OrderEvent(Event):
         self.limit_price = limit_price
         self.stop_price = stop_price
         self.stamp = stamp
+        self.bar = bar
 
     def __repr__(self):
         return '''ORDER[-type=%s]: %s],
@@ -45,10 +93,15 @@ class OrderEvent(Event):
 
 # FILL EVENT: AN ORDER WAS PLACED
 class FillEvent(Event):
+
+    __slots__ = ('stamp','symbol','exchange','shares','action','order_type','commission','bar','price')
+    type = EventType.FILL
+
     def __init__(self,stamp,symbol,exchange,
-                shares,action,order_type,commission=None):
-                self.type = 'FILL'
+                shares,action,order_type,commission=None,bar=None,price=None):
                 self.stamp = stamp
+                self.bar = bar
+                self.price = price # None = the bar's close
                 self.symbol = symbol
                 self.exchange = exchange
                 self.shares = shares
@@ -62,3 +115,58 @@ class FillEvent(Event):
 
     def calculate_ib_commission(self):
             return 0.0
+
+
+# BATCHED EVENTS: A WHOLE REBALANCE IN ONE EVENT PER STAGE (strategy -> portfolio -> broker -> portfolio)
+# symbols is a list, shares and actions are arrays lined up with it, one order type for the batch
+
+
+# REBALANCE EVENT: ALL TRADES OF ONE REBALANCE FROM STRATEGY (the batched SignalEvents)
+class RebalanceEvent(Event):
+
+    __slots__ = ('symbols','shares','actions','order_type','limit_prices','stop_prices','stamp','bar')
+    type = EventType.REBALANCE
+
+    def __init__(self,symbols,stamp,order_type,actions,shares,limit_prices=None,stop_prices=None,bar=None):
+        self.symbols = symbols
+        self.shares = shares # float64 array
+        self.actions = actions # array of 'BUY','SELL'
+        self.order_type = order_type
+        self.limit_prices = limit_prices # float64 arrays for LIMIT/STOP/STOP-LIMIT batches
+        self.stop_prices = stop_prices
+        self.stamp = stamp
+        self.bar = bar
+
+    def __len__(self):
+        return len(self.symbols)
+
+# BATCH ORDER EVENT: THE ORDERS OF A REBALANCE PLACED BY PORTFOLIO
+class BatchOrderEvent(RebalanceEvent):
+
+    __slots__ = ()
+    type = EventType.BATCH_ORDER
+
+    def __repr__(self):
+        # same text as one OrderEvent per symbol
+        return '\n'.join(repr(OrderEvent(s,self.stamp,self.order_type,a,n))
+                         for s,a,n in zip(self.symbols,self.actions,self.shares))
+
+# BATCH FILL EVENT: THE ORDERS OF A REBALANCE WERE EXECUTED
+class BatchFillEvent(Event):
+
+    __slots__ = ('stamp','symbols','exchange','shares','actions','order_type','commission','bar','prices')
+    type = EventType.BATCH_FILL
+
+    def __init__(self,stamp,symbols,exchange,shares,actions,order_type,commission=None,bar=None,prices=None):
+        self.stamp = stamp
+        self.symbols = symbols
+        self.exchange = exchange
+        self.shares = shares
+        self.actions = actions
+        self.order_type = order_type
+        self.commission = np.zeros(len(symbols)) if commission is None else commission
+        self.bar = bar
+        self.prices = prices # None = the bar's closes
+
+    def __len__(self):
+        return len(self.symbols)
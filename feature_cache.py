@@ -0,0 +1,111 @@
+import os, os.path
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+from cache_files import save_npy, npy_entries, evict_lru
+
+
+# ------------------------------------------------------------------------------------------------------
+# FEATURE CACHE
+# indicator columns computed by AlpacaDataFrame.add_data, stored one column per .npy file and keyed by
+#   sha1(source fingerprint | timeline digest | indicator name | parameters)
+# the source fingerprint is the symbol's csv (path, mtime, size), or a digest of its OHLCV frame when
+# it was passed in memory, so a changed csv or timeline never hits a stale column.
+# Entries are evicted least recently used first once the folder grows past max_bytes.
+# ------------------------------------------------------------------------------------------------------
+
+VERSION = 1 # bumped whenever the indicator definitions in add_data change
+CACHE_FOLDER = os.path.join('.cache','features')
+
+
+def frame_digest(data):
+    # content digest of a pandas object (values and index)
+    return hashlib.sha1(pd.util.hash_pandas_object(data).values.tobytes()).hexdigest()
+
+def timeline_digest(stamps):
+    return hashlib.sha1(pd.util.hash_pandas_object(pd.Index(stamps),index=False).values.tobytes()).hexdigest()
+
+
+class FeatureCache(object):
+
+    def __init__(self, cache_dir, max_bytes=2*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stats = {'hits':0,'misses':0,'bytes_read':0,'bytes_written':0,'evictions':0,
+                      'compute_time':0.0,'load_time':0.0}
+
+    def entry_path(self, source_key, name, params=()):
+        key = '|'.join([str(VERSION),source_key,name,','.join(str(p) for p in params)])
+        return os.path.join(self.cache_dir,'{name}_{key}.npy'.format(
+                            name=name,key=hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]))
+
+    def get(self, path):
+        # cached column, or None
+        start = time.perf_counter()
+        try:
+            values = np.load(path,allow_pickle=False)
+            os.utime(path) # most recently used
+        except (OSError, ValueError):
+            return None # missing, or evicted by another process meanwhile
+        self.stats['hits'] += 1
+        self.stats['bytes_read'] += values.nbytes
+        self.stats['load_time'] += time.perf_counter() - start
+        return values
+
+    def put(self, path, values):
+        values = np.ascontiguousarray(values,dtype=np.float64)
+        save_npy(path,values)
+        self.stats['bytes_written'] += values.nbytes
+
+    def column(self, source_key, name, params, compute):
+        # column from the cache when available, otherwise compute() and store it
+        path = self.entry_path(source_key,name,params)
+        values = self.get(path)
+        if values is not None:
+            return values
+        self.stats['misses'] += 1
+        start = time.perf_counter()
+        values = np.asarray(compute(),dtype=np.float64)
+        self.stats['compute_time'] += time.perf_counter() - start
+        self.put(path,values)
+        return values
+
+    def entries(self):
+        # [(path, size, last used)] of every cached column
+        return npy_entries([self.cache_dir])
+
+    def evict(self, max_bytes=None):
+        # drop least recently used columns until the cache fits in max_bytes
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        total, evicted = evict_lru(self.entries(),max_bytes)
+        self.stats['evictions'] += evicted
+        return total
+
+    def report(self):
+        stats = self.stats
+        lookups = max(stats['hits']+stats['misses'],1)
+        entries = self.entries()
+        print('<<-------| FEATURE CACHE REPORT |------->>')
+        print('Hits:',stats['hits'],' Misses:',stats['misses'],
+              ' Hit Rate (%):',round(100*stats['hits']/lookups,2))
+        print('Read (MB):',round(stats['bytes_read']/1024**2,2),
+              ' Written (MB):',round(stats['bytes_written']/1024**2,2),' Evictions:',stats['evictions'])
+        print('Load Time (s):',round(stats['load_time'],4),' Compute Time (s):',round(stats['compute_time'],4))
+        print('Entries:',len(entries),' Size (MB):',round(sum(e[1] for e in entries)/1024**2,2),
+              'of',round(self.max_bytes/1024**2,2))
+
+
+if __name__ == '__main__':
+    # python feature_cache.py database/1min/.cache/features --max_mb 512
+    parser = argparse.ArgumentParser(description='Report on (and trim) a feature cache folder')
+    parser.add_argument('cache_dir')
+    parser.add_argument('--max_mb',type=float,default=None)
+    args = parser.parse_args()
+    cache = FeatureCache(args.cache_dir)
+    if args.max_mb is not None:
+        cache.max_bytes = int(args.max_mb*1024**2)
+        cache.evict()
+    cache.report()
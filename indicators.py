@@ -0,0 +1,340 @@
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm #HPFilter
+import talib
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from checkpoint import attributes_state, set_attributes
+
+
+# ------------------------------------------------------------------------------------------------------
+# ONLINE INDICATOR ENGINE
+# incremental SMA/WMA/EMA/EWMA/RSI/NATR, returns and differences of close prices, updated once per bar
+# as the dataframe's cursor moves, for all requested symbols at once.
+# Values follow talib's definitions (same seeds, same smoothing) on forward-filled prices, and are
+# written into the dataframe's bar store as extra fields ('sma10','rsi14','log_ret',...), so
+# get_latest_bars / latest_symbol_data return them next to OHLCV.
+# ------------------------------------------------------------------------------------------------------
+class OnlineIndicators(object):
+
+    '''
+    State is shared across periods: one history of the last max(periods)+1 closes feeds every
+    SMA/WMA window (running sums), and one gain/loss and true range per bar feeds every RSI/NATR.
+    Each bar costs O(periods x symbols), whatever the length of the history.
+
+    -- sma/wma: running window sums (talib SMA/WMA)
+    -- ema: seeded with the SMA of the first `period` closes (talib EMA)
+    -- ewma: EMA of the WMA, seeded with the SMA of the first `period` WMA values (talib EMA(WMA))
+    -- rsi/natr: Wilder smoothing, seeded with the mean of the first `period` gains/losses or true ranges
+    -- arith_ret/log_ret/d1close: close vs previous close, d2close: second-order difference
+    '''
+
+    def __init__(self, bars, symbols, periods=None, sma=False, ema=False, wma=False, ewma=False,
+                rsi=False, natr=False, arith_ret=False, log_ret=False, d1close=False, d2close=False):
+        self.bars = bars
+        self.symbols = list(symbols)
+        self.rows = np.array([self.bars.symbol_index[s] for s in self.symbols])
+        self.periods = np.array(sorted(set(periods or [])),dtype=np.int64)
+        if (sma or ema or wma or ewma or rsi or natr) and len(self.periods) == 0:
+            raise ValueError('moving averages, rsi and natr need periods')
+        self.flags = {'sma':sma,'wma':wma,'ema':ema,'ewma':ewma,'rsi':rsi,'natr':natr}
+        self.single = {'arith_ret':arith_ret,'log_ret':log_ret,'d1close':d1close,'d2close':d2close}
+        self.output_names = []
+        for name,on in self.flags.items():
+            if on:
+                self.output_names += [name+str(p) for p in self.periods]
+        self.output_names += [name for name,on in self.single.items() if on]
+        self.attach()
+        n_periods,n_symbols = len(self.periods),len(self.symbols)
+        shape = (n_periods,n_symbols)
+        self.period_col = self.periods[:,None].astype(np.float64)
+        self.alpha = 2/(self.period_col+1) # ema smoothing
+        #-----SHARED STATE-----#
+        self.history = np.full((int(self.periods.max(initial=0))+1,n_symbols),np.nan) # last closes, ring
+        self.slot = -1
+        self.count = np.zeros(n_symbols,dtype=np.int64) # valid closes seen per symbol
+        self.last = np.full((3,n_symbols),np.nan) # forward-filled high, low, close
+        self.last_d1 = np.full(n_symbols,np.nan)
+        #-----PER PERIOD STATE-----#
+        self.window_sum = np.zeros(shape)
+        self.weighted_sum = np.zeros(shape)
+        self.ema = np.full(shape,np.nan)
+        self.ewma = np.full(shape,np.nan)
+        self.ewma_seed = np.zeros(shape)
+        self.avg_gain = np.zeros(shape)
+        self.avg_loss = np.zeros(shape)
+        self.atr = np.zeros(shape)
+        self.steady = False # every symbol past the seeding of every period, masks no longer needed
+        self.weights_total = self.period_col*(self.period_col+1)/2
+        # bars older than the earliest bar still held by the dataframe cannot be replayed
+        self.last_bar = self.bars.first_bar
+
+    # everything step() carries from bar to bar, saved in checkpoints (checkpoint.py)
+    STATE = ['history','slot','count','last','window_sum','weighted_sum','ema','ewma','ewma_seed',
+             'avg_gain','avg_loss','atr','steady','last_bar']
+
+    def get_state(self):
+        return attributes_state(self,self.STATE)
+
+    def set_state(self, state):
+        set_attributes(self,state,self.STATE)
+
+    def attach(self):
+        # output fields registered on the dataframe, again whenever it rebuilds its bar store
+        self.field_index = self.bars.add_fields(self.output_names)
+        self.price_index = [self.bars.fields.index(f) for f in ('high','low','close')]
+
+    def update(self):
+        # consume every bar between the last update and the dataframe's cursor, once per bar
+        cursor = self.bars.cursor
+        if cursor <= self.last_bar:
+            return
+        window = self.bars.get_bar_window(self.last_bar,cursor)[self.rows][:,:,self.price_index]
+        for k in range(window.shape[1]):
+            values = self.step(window[:,k].T)
+            self.bars.set_bar_values(self.last_bar+k,self.rows,self.field_index,values.T)
+        self.last_bar = cursor
+
+    def step(self, prices):
+        # prices: (high, low, close) x symbols of one bar -> outputs x symbols
+        prices = np.where(np.isnan(prices),self.last,prices) # forward fill
+        high,low,close = prices
+        prev_close = self.last[2]
+        self.last = prices
+        valid = ~np.isnan(close)
+        self.count += valid
+        n = self.count[None,:]
+        p = self.periods[:,None]
+        # close leaving each period's window (p bars ago)
+        self.slot = (self.slot+1) % len(self.history)
+        dropped = self.history[(self.slot-self.periods) % len(self.history)]
+        self.history[self.slot] = close
+        if self.steady:
+            return self.steady_step(high,low,close,prev_close,dropped)
+        self.steady = len(self.periods) > 0 and self.count.min() > 2*self.periods.max()
+        with np.errstate(invalid='ignore',divide='ignore'):
+            # SMA / WMA running sums, the WMA sum is exact once the window first fills
+            previous_sum = self.window_sum
+            full_before = n > p
+            self.window_sum = np.where(valid,self.window_sum+close-np.where(full_before,dropped,0.0),self.window_sum)
+            self.weighted_sum = np.where(full_before,self.weighted_sum+p*close-previous_sum,self.weighted_sum)
+            just_full = (n == p) & valid
+            if just_full.any():
+                self.weighted_sum = np.where(just_full,self.window_weighted_sum(),self.weighted_sum)
+            ready = n >= p
+            sma = np.where(ready,self.window_sum/self.period_col,np.nan)
+            wma = np.where(ready,self.weighted_sum/(self.period_col*(self.period_col+1)/2),np.nan)
+            # EMA seeded with the first SMA
+            self.ema = np.where(n == p,sma,np.where(n > p,self.ema+self.alpha*(close-self.ema),self.ema))
+            ema = np.where(ready,self.ema,np.nan)
+            # EWMA = EMA of the WMA, seeded with the mean of the first p WMA values
+            m = n - p + 1 # wma values seen
+            self.ewma_seed = np.where(ready & (m <= p),self.ewma_seed+wma,self.ewma_seed)
+            self.ewma = np.where(m == p,self.ewma_seed/self.period_col,
+                                 np.where(m > p,self.ewma+self.alpha*(wma-self.ewma),self.ewma))
+            ewma = np.where(m >= p,self.ewma,np.nan)
+            # RSI / NATR, Wilder smoothing seeded with the mean of the first p gains, losses, true ranges
+            has_prev = n >= 2
+            diff = close - prev_close
+            gain = np.where(has_prev,np.maximum(diff,0.0),0.0)
+            loss = np.where(has_prev,np.maximum(-diff,0.0),0.0)
+            true_range = np.where(has_prev,np.fmax(high-low,np.fmax(np.abs(high-prev_close),np.abs(low-prev_close))),0.0)
+            d = n - 1 # differences seen
+            seeding = has_prev & (d <= p)
+            smoothing = d > p
+            seeded = d == p
+            self.avg_gain = self.wilder(self.avg_gain,gain,seeding,seeded,smoothing)
+            self.avg_loss = self.wilder(self.avg_loss,loss,seeding,seeded,smoothing)
+            self.atr = self.wilder(self.atr,true_range,seeding,seeded,smoothing)
+            rsi_ready = d >= p
+            total = self.avg_gain + self.avg_loss
+            rsi = np.where(rsi_ready,np.where(np.abs(total) < 1e-8,0.0,100*self.avg_gain/total),np.nan)
+            natr = np.where(rsi_ready,np.where(np.abs(close) < 1e-8,0.0,100*self.atr/close),np.nan)
+            # returns and differences
+            d1 = close - prev_close
+            outputs = {'sma':sma,'wma':wma,'ema':ema,'ewma':ewma,'rsi':rsi,'natr':natr,
+                       'arith_ret':close/prev_close - 1,'log_ret':np.log(close/prev_close),
+                       'd1close':d1,'d2close':d1 - self.last_d1}
+        self.last_d1 = np.where(valid,d1,self.last_d1)
+        return self.collect(outputs)
+
+    def steady_step(self, high, low, close, prev_close, dropped):
+        # same updates once every symbol has a full history, only for the outputs requested
+        flags,p = self.flags,self.period_col
+        outputs = {}
+        previous_sum = self.window_sum
+        self.window_sum = previous_sum + close - dropped
+        outputs['sma'] = self.window_sum/p
+        if flags['wma'] or flags['ewma']:
+            self.weighted_sum = self.weighted_sum + p*close - previous_sum
+            outputs['wma'] = self.weighted_sum/self.weights_total
+        if flags['ema']:
+            self.ema = self.ema + self.alpha*(close-self.ema)
+            outputs['ema'] = self.ema
+        if flags['ewma']:
+            self.ewma = self.ewma + self.alpha*(outputs['wma']-self.ewma)
+            outputs['ewma'] = self.ewma
+        d1 = close - prev_close
+        if flags['rsi']:
+            self.avg_gain = (self.avg_gain*(p-1) + np.maximum(d1,0.0))/p
+            self.avg_loss = (self.avg_loss*(p-1) + np.maximum(-d1,0.0))/p
+            total = self.avg_gain + self.avg_loss
+            with np.errstate(invalid='ignore',divide='ignore'):
+                outputs['rsi'] = np.where(np.abs(total) < 1e-8,0.0,100*self.avg_gain/total)
+        if flags['natr']:
+            true_range = np.fmax(high-low,np.fmax(np.abs(high-prev_close),np.abs(low-prev_close)))
+            self.atr = (self.atr*(p-1) + true_range)/p
+            with np.errstate(invalid='ignore',divide='ignore'):
+                outputs['natr'] = np.where(np.abs(close) < 1e-8,0.0,100*self.atr/close)
+        single = self.single
+        if single['arith_ret']:
+            outputs['arith_ret'] = close/prev_close - 1
+        if single['log_ret']:
+            outputs['log_ret'] = np.log(close/prev_close)
+        outputs['d1close'] = d1
+        outputs['d2close'] = d1 - self.last_d1
+        self.last_d1 = d1
+        return self.collect(outputs)
+
+    def collect(self, outputs):
+        # requested outputs, in the order of self.output_names
+        values = [outputs[name] for name,on in self.flags.items() if on]
+        values += [outputs[name][None,:] for name,on in self.single.items() if on]
+        return np.concatenate(values) if values else np.empty((0,len(self.symbols)))
+
+    def wilder(self, average, value, seeding, seeded, smoothing):
+        # sum of the first p values, their mean once the p-th arrives, then (avg*(p-1) + value)/p
+        average = np.where(seeding,average+value,average)
+        average = np.where(seeded,average/self.period_col,average)
+        return np.where(smoothing,(average*(self.period_col-1)+value)/self.period_col,average)
+
+    def window_weighted_sum(self):
+        # exact sum of k*close over each period's window (weights 1..p, latest close weighted p)
+        size = len(self.history)
+        result = np.zeros((len(self.periods),len(self.symbols)))
+        for j,p in enumerate(self.periods):
+            lags = np.arange(p) # lag 0 = latest close
+            result[j] = ((p-lags)[:,None]*self.history[(self.slot-lags) % size]).sum(axis=0)
+        return result
+
+
+# ------------------------------------------------------------------------------------------------------
+# BATCH INDICATORS (add_data)
+# whole-history columns of one symbol, computed with talib / statsmodels. add_data runs them symbol
+# by symbol, or spreads the symbols over a process pool that reads prices from and writes columns
+# into shared memory, so no DataFrame is pickled either way. Both paths run the same code.
+# ------------------------------------------------------------------------------------------------------
+
+def batch_feature_names(periods, flags):
+    # column names in the order batch_features adds them
+    names = []
+    for name in ('sma','wma','ema','ewma'):
+        if flags.get(name):
+            names += [name+str(p) for p in periods]
+    for name in ('arith_ret','hpfilter','log_ret','d1close','d2close'):
+        if flags.get(name):
+            names += ['hptrend','hpnoise'] if name == 'hpfilter' else [name]
+    for name in ('rsi','natr'):
+        if flags.get(name):
+            names += [name+str(p) for p in periods]
+    return names
+
+def batch_features(df, periods, flags, feature=None):
+    # df: forward-filled OHLCV of one symbol -> {column name: values}
+    # feature(name, params, compute) can serve a column from somewhere else (feature cache)
+    if feature is None:
+        feature = lambda name,params,compute: compute()
+    close = df['close']
+    columns = {}
+    if flags.get('sma'):
+        for p in periods:
+            columns['sma'+str(p)] = feature('sma',(p,),lambda: talib.SMA(close,p))
+    if flags.get('wma'):
+        for p in periods:
+            columns['wma'+str(p)] = feature('wma',(p,),lambda: talib.WMA(close,p))
+    if flags.get('ema'):
+        for p in periods:
+            columns['ema'+str(p)] = feature('ema',(p,),lambda: talib.EMA(close,p))
+    if flags.get('ewma'):
+        for p in periods:
+            columns['ewma'+str(p)] = feature('ewma',(p,),lambda: talib.EMA(talib.WMA(close,p),p))
+    if flags.get('arith_ret'):
+        columns['arith_ret'] = feature('arith_ret',(),lambda: (close/close.shift(1)) - 1)
+    if flags.get('hpfilter'):
+        hp = [] # (noise, trend), computed once for both columns
+        def hp_part(k):
+            if len(hp) == 0:
+                hp.extend(sm.tsa.filters.hpfilter(close))
+            return hp[k]
+        columns['hptrend'] = feature('hptrend',(),lambda: hp_part(1))
+        columns['hpnoise'] = feature('hpnoise',(),lambda: hp_part(0))
+    if flags.get('log_ret'):
+        columns['log_ret'] = feature('log_ret',(),lambda: np.log(close/close.shift(1)))
+    if flags.get('d1close'):
+        columns['d1close'] = feature('d1close',(),lambda: close - close.shift(1))
+    if flags.get('d2close'):
+        columns['d2close'] = feature('d2close',(),lambda: close.diff().diff())
+    if flags.get('rsi'):
+        for p in periods:
+            columns['rsi'+str(p)] = feature('rsi',(p,),lambda: talib.RSI(close,p))
+    if flags.get('natr'):
+        for p in periods:
+            columns['natr'+str(p)] = feature('natr',(p,),lambda: talib.NATR(df['high'],df['low'],close,p))
+    return columns
+
+def batch_features_parallel(frames, periods, flags, workers, cache=None, source_keys=None):
+    # frames: {symbol: forward-filled OHLCV frame}, all on the same timeline -> {symbol: {column: values}}
+    symbols = list(frames)
+    names = batch_feature_names(periods,flags)
+    n_stamps = len(frames[symbols[0]])
+    prices_shape = (len(symbols),3,n_stamps)
+    output_shape = (len(symbols),len(names),n_stamps)
+    prices_memory = shared_memory.SharedMemory(create=True,size=max(8*int(np.prod(prices_shape)),1))
+    output_memory = shared_memory.SharedMemory(create=True,size=max(8*int(np.prod(output_shape)),1))
+    try:
+        prices = np.ndarray(prices_shape,dtype=np.float64,buffer=prices_memory.buf)
+        for j,s in enumerate(symbols):
+            prices[j] = frames[s][['high','low','close']].to_numpy(dtype=np.float64).T
+        tasks = [rows for rows in np.array_split(np.arange(len(symbols)),4*workers) if len(rows) > 0]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(batch_features_worker,prices_memory.name,output_memory.name,
+                                       prices_shape,output_shape,rows,periods,flags,cache,
+                                       None if source_keys is None else [source_keys[symbols[j]] for j in rows])
+                       for rows in tasks]
+            for future in futures:
+                stats = future.result()
+                if cache is not None:
+                    for k,v in stats.items():
+                        cache.stats[k] += v
+        output = np.ndarray(output_shape,dtype=np.float64,buffer=output_memory.buf)
+        result = {s:{name:output[j,k].copy() for k,name in enumerate(names)} for j,s in enumerate(symbols)}
+        del prices, output # release the buffers before closing the shared memory
+    finally:
+        for memory in (prices_memory,output_memory):
+            memory.close()
+            memory.unlink()
+    return result
+
+def batch_features_worker(prices_name, output_name, prices_shape, output_shape, rows, periods, flags,
+                          cache=None, source_keys=None):
+    # runs in a pool process: computes the columns of some symbols straight into the shared output
+    prices_memory = shared_memory.SharedMemory(name=prices_name)
+    output_memory = shared_memory.SharedMemory(name=output_name)
+    if cache is not None:
+        cache.stats = dict.fromkeys(cache.stats,0) # only this worker's lookups are sent back
+    try:
+        prices = np.ndarray(prices_shape,dtype=np.float64,buffer=prices_memory.buf)
+        output = np.ndarray(output_shape,dtype=np.float64,buffer=output_memory.buf)
+        for n,j in enumerate(rows):
+            df = pd.DataFrame({'high':prices[j,0],'low':prices[j,1],'close':prices[j,2]})
+            feature = None
+            if cache is not None:
+                source_key = source_keys[n]
+                feature = lambda name,params,compute: cache.column(source_key,name,params,compute)
+            for k,values in enumerate(batch_features(df,periods,flags,feature).values()):
+                output[j,k] = values
+        del prices, output
+    finally:
+        prices_memory.close()
+        output_memory.close()
+    return {} if cache is None else cache.stats
@@ -0,0 +1,165 @@
+import json
+import time
+import numpy as np
+
+
+# ------------------------------------------------------------------------------------------------------
+# BACKTEST INSTRUMENTATION (opt-in)
+# per-call latency histograms for update_bars and every registered event handler, event counts by type,
+# queue depth histograms per bar, a summary table and a trace file (chrome://tracing / Perfetto json format).
+# backtest.run_event_loop hands its calls to wrap_loop, which returns timed closures around them: the
+# loop itself is the same one. When no Instrumentation is passed nothing is wrapped.
+# ------------------------------------------------------------------------------------------------------
+
+class Log2Histogram(object):
+
+    # log2 buckets: bucket k holds values in [2^(k-1), 2^k) (nanoseconds for latencies, events for queues)
+
+    def __init__(self):
+        self.buckets = [0]*64
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[min(value.bit_length(),63)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.total/max(self.count,1)
+
+    def percentile(self, q):
+        # q-th percentile value, interpolated inside its bucket
+        if self.count == 0:
+            return 0
+        target = q/100*self.count
+        seen = 0
+        for k,n in enumerate(self.buckets):
+            if n and seen + n >= target:
+                low = 2**(k-1) if k > 0 else 0
+                estimate = low + (2**k - low)*(target - seen)/n
+                return min(max(estimate,self.min),self.max)
+            seen += n
+        return self.max
+
+
+class Instrumentation(object):
+
+    def __init__(self, trace_file=None, max_trace_events=1000000):
+        self.trace_file = trace_file
+        self.max_trace_events = max_trace_events # bounds the memory used by the trace
+        self.latencies = {}
+        self.event_counts = {}
+        # per bar: events queued after update_bars, max queue length, events processed
+        self.queued = Log2Histogram()
+        self.max_depth = Log2Histogram()
+        self.processed = Log2Histogram()
+        self.trace = []
+        self.depth_trace = [] # (update_bars start, queued, max queue length) per bar, bounded like the trace
+        self.origin_ns = time.perf_counter_ns()
+        self.run_ns = 0
+        self.run_start = None
+
+    def record(self, name, start_ns, end_ns):
+        if name not in self.latencies:
+            self.latencies[name] = Log2Histogram()
+        self.latencies[name].add(end_ns - start_ns)
+        if len(self.trace) < self.max_trace_events:
+            self.trace.append((name,start_ns,end_ns))
+
+    def wrap(self, name, func):
+        perf_counter_ns = time.perf_counter_ns
+        record = self.record
+        def timed(*args):
+            start = perf_counter_ns()
+            result = func(*args)
+            record(name,start,perf_counter_ns())
+            return result
+        return timed
+
+    def wrap_handlers(self, handlers):
+        return {event_type:tuple(self.wrap(handler_name(h),h) for h in funcs)
+                for event_type,funcs in handlers.items()}
+
+    def wrap_loop(self, update_bars, popleft, handlers, after_bar, Events):
+        # timed versions of the event loop's calls (backtest.run_event_loop) and a watch on its queue:
+        # returns (update_bars, popleft, handlers, after_bar) for the loop to call instead
+        perf_counter_ns = time.perf_counter_ns
+        size = Events.qsize if hasattr(Events,'qsize') else Events.__len__
+        timed_update = self.wrap(handler_name(update_bars),update_bars)
+        bar = [0,0,0,0] # update_bars start, queued, max queue length, processed
+        def update():
+            bar[0] = perf_counter_ns()
+            timed_update()
+            bar[1] = bar[2] = size()
+            bar[3] = 0
+        def pop():
+            # the queue's length before every pop covers its length after every event's handlers
+            depth = size()
+            if depth > bar[2]:
+                bar[2] = depth
+            event = popleft()
+            bar[3] += 1
+            return event
+        def close_bar():
+            self.queued.add(bar[1])
+            self.max_depth.add(bar[2])
+            self.processed.add(bar[3])
+            if len(self.depth_trace) < self.max_trace_events:
+                self.depth_trace.append((bar[0],bar[1],bar[2]))
+        after_bar = [self.wrap(handler_name(hook),hook) for hook in after_bar] + [close_bar]
+        self.run_start = perf_counter_ns()
+        return update, pop, self.wrap_handlers(handlers), after_bar
+
+    def finish_loop(self, event_counts):
+        # called by the loop once the backtest is complete
+        self.run_ns += time.perf_counter_ns() - self.run_start
+        for event_type,n in event_counts.items():
+            self.event_counts[event_type.value] = self.event_counts.get(event_type.value,0) + n
+
+    def summary(self):
+        print('<<-------| BACKTEST INSTRUMENTATION |------->>')
+        print('Run time (s):',round(self.run_ns/1e9,4))
+        print('Events:',', '.join(k+'='+str(v) for k,v in self.event_counts.items()))
+        if self.processed.count > 0:
+            print('Bars:',self.processed.count,' Max queue depth:',self.max_depth.max,
+                  ' P99 queue depth:',round(self.max_depth.percentile(99),2),
+                  ' Avg events per bar:',round(self.processed.mean(),2))
+        rows = []
+        for name,h in sorted(self.latencies.items(),key=lambda x: -x[1].total):
+            rows.append((name,h.count,h.total/1e9,100*h.total/max(self.run_ns,1),
+                         h.mean()/1e3,h.percentile(50)/1e3,h.percentile(99)/1e3,h.max/1e3))
+        header = ('COMPONENT','CALLS','TOTAL s','% RUN','MEAN us','P50 us','P99 us','MAX us')
+        print(header[0].ljust(45)+''.join(h.rjust(12) for h in header[1:]))
+        for r in rows:
+            print(r[0].ljust(45)+str(r[1]).rjust(12)+''.join(('%.3f' % v).rjust(12) for v in r[2:]))
+
+    def export_trace(self, trace_file=None):
+        # chrome trace event format: one complete ('X') event per call, one counter ('C') sample per bar
+        trace_file = self.trace_file if trace_file is None else trace_file
+        if trace_file is None:
+            return None
+        events = [{'name':name,'ph':'X','pid':0,'tid':0,
+                   'ts':(start-self.origin_ns)/1e3,'dur':(end-start)/1e3}
+                  for name,start,end in self.trace]
+        for start,queued,max_depth in self.depth_trace:
+            events.append({'name':'queue depth','ph':'C','pid':0,'ts':(start-self.origin_ns)/1e3,
+                           'args':{'queued':queued,'max':max_depth}})
+        with open(trace_file,'w') as f:
+            json.dump({'traceEvents':events,'displayTimeUnit':'ns'},f)
+        print('Trace exported ->',trace_file)
+        return trace_file
+
+
+def handler_name(func):
+    # 'SamplePortfolio.update_holdings' for bound methods
+    owner = getattr(func,'__self__',None)
+    if owner is not None:
+        return type(owner).__name__+'.'+func.__name__
+    return getattr(func,'__qualname__',repr(func))
@@ -0,0 +1,182 @@
+import numpy as np
+from collections import deque
+from checkpoint import attributes_state, set_attributes, scalar
+
+
+# ------------------------------------------------------------------------------------------------------
+# ONLINE RETURN MOMENTS
+# running mean vector and covariance matrix of log returns, updated as the dataframe's cursor moves
+# ------------------------------------------------------------------------------------------------------
+class ReturnMomentsEstimator(object):
+
+    '''
+    Keeps the mean and covariance of close-to-close log returns for a set of symbols
+    without rebuilding them from the whole history on every bar.
+
+    -- tail_count = None: expanding window over every bar updated so far (Welford updates,
+       with pending bars merged in as one batch, e.g. the warm-up bars on the first update)
+    -- tail_count = n: fixed window over the last n closes, i.e. the last n-1 returns,
+       matching latest_symbol_data[s].tail(n) (add/remove updates, re-computed exactly
+       once every window to keep rounding errors from building up)
+
+    Missing returns (no close on the bar or the one before) are handled pairwise, like
+    pd.DataFrame.mean()/cov(): a symbol's mean uses every return it has, a covariance the bars
+    where both symbols have one. Counts, means and comoments are kept per pair of symbols, on a
+    panel without gaps every pair sees the same bars and the updates are the plain ones.
+    '''
+
+    def __init__(self, bars, symbols, tail_count=None):
+        self.bars = bars
+        self.symbols = list(symbols)
+        self.columns = [self.bars.symbol_index[s] for s in self.symbols]
+        self.close_field = self.bars.fields.index('close')
+        self.tail_count = tail_count
+        self.window = None if tail_count is None else tail_count-1
+        self.last_bar = 0 # bars before this one have been consumed
+        n_symbols = len(self.symbols)
+        self.count = np.zeros((n_symbols,n_symbols),dtype=np.int64) # returns both symbols have
+        self.pair_mean = np.zeros((n_symbols,n_symbols),dtype=np.float64) # [i,j]: mean of i over those returns
+        self.comoment = np.zeros((n_symbols,n_symbols),dtype=np.float64) # sum of products of deviations
+        self.window_returns = deque() # (bar, returns) currently inside the fixed window
+        self.updates_since_exact = 0
+
+    @property
+    def mean(self):
+        # mean of every symbol's returns (pd.DataFrame.mean()), NaN for a symbol without any
+        mean = np.diagonal(self.pair_mean).copy()
+        mean[np.diagonal(self.count) == 0] = np.nan
+        return mean
+
+    def update(self):
+        # consume every bar between the last update and the dataframe's cursor, once per bar
+        cursor = self.bars.cursor
+        if cursor <= self.last_bar:
+            return
+        first = max(self.last_bar,1)
+        if self.window is not None:
+            first = max(first,cursor-self.window) # older returns would leave the window right away
+        closes = self.bars.get_bar_window(first-1,cursor)[self.columns,:,self.close_field]
+        log_ret = np.log(closes[:,1:]/closes[:,:-1]).T
+        bars_index = np.arange(first,cursor)
+        present = ~np.isnan(log_ret).all(axis=1)
+        log_ret = log_ret[present]
+        bars_index = bars_index[present]
+        self.last_bar = cursor
+        if self.window is None:
+            self.merge_batch(log_ret)
+        else:
+            self.update_window(log_ret,bars_index,cursor)
+
+    def merge_batch(self,log_ret):
+        n_new = len(log_ret)
+        if n_new == 0:
+            return
+        if n_new == 1 or np.isnan(log_ret).any():
+            # every pair of symbols sees its own bars here, added one at a time
+            for x in log_ret:
+                self.add(x)
+            return
+        # combine running moments with the batch moments (parallel form of Welford)
+        batch_mean = log_ret.mean(axis=0)
+        deviations = log_ret - batch_mean
+        batch_comoment = deviations.T.dot(deviations)
+        total = self.count + n_new
+        delta = batch_mean[:,None] - self.pair_mean
+        self.pair_mean = self.pair_mean + delta*(n_new/total)
+        self.comoment = self.comoment + batch_comoment + delta*delta.T*(self.count*n_new/total)
+        self.count = total
+
+    def pairs(self,x):
+        # pairs of symbols that both have a return in x
+        valid = ~np.isnan(x)
+        return valid[:,None] & valid[None,:]
+
+    def add(self,x):
+        pairs = self.pairs(x)
+        self.count += pairs
+        delta = np.where(pairs,x[:,None] - self.pair_mean,0.0)
+        self.pair_mean += delta/np.maximum(self.count,1)
+        self.comoment += np.where(pairs,delta*(x[None,:] - self.pair_mean.T),0.0)
+
+    def remove(self,x):
+        pairs = self.pairs(x)
+        self.count -= pairs
+        left = pairs & (self.count > 0)
+        delta = np.where(left,x[:,None] - self.pair_mean,0.0)
+        self.pair_mean -= delta/np.maximum(self.count,1)
+        self.comoment -= np.where(left,delta*(x[None,:] - self.pair_mean.T),0.0)
+        emptied = pairs & (self.count == 0)
+        self.pair_mean[emptied] = 0.0
+        self.comoment[emptied] = 0.0
+
+    def reset(self):
+        self.count[:] = 0
+        self.pair_mean[:] = 0.0
+        self.comoment[:] = 0.0
+
+    def update_window(self,log_ret,bars_index,cursor):
+        oldest = cursor - self.window # first bar whose return is still inside the window
+        added = []
+        for b,x in zip(bars_index,log_ret):
+            if b >= oldest:
+                self.window_returns.append((b,x))
+                added.append(x)
+        removed = []
+        while self.window_returns and self.window_returns[0][0] < oldest:
+            removed.append(self.window_returns.popleft()[1])
+        self.updates_since_exact += len(added) + len(removed)
+        if self.updates_since_exact >= max(self.window,1) or len(added) > 1:
+            self.recompute()
+            return
+        for x in added:
+            self.add(x)
+        for x in removed:
+            self.remove(x)
+
+    def recompute(self):
+        # exact moments of the returns currently inside the window
+        self.reset()
+        self.updates_since_exact = 0
+        if len(self.window_returns) == 0:
+            return
+        self.merge_batch(np.array([x for b,x in self.window_returns]))
+
+    def cov(self):
+        # sample covariance (ddof=1), same as pd.DataFrame.cov(): NaN for pairs with less than 2 returns
+        return np.where(self.count >= 2,self.comoment/np.maximum(self.count-1,1),np.nan)
+
+    STATE = ['last_bar','count','pair_mean','comoment','updates_since_exact']
+
+    def get_state(self):
+        # checkpoint.py
+        state = attributes_state(self,self.STATE)
+        n_symbols = len(self.symbols)
+        state['window_bars'] = np.array([b for b,x in self.window_returns],dtype=np.int64)
+        state['window_returns'] = np.array([x for b,x in self.window_returns]).reshape(-1,n_symbols)
+        return state
+
+    def set_state(self, state):
+        set_attributes(self,state,self.STATE)
+        self.window_returns = deque(zip(state['window_bars'].tolist(),np.array(state['window_returns'])))
+
+
+# ------------------------------------------------------------------------------------------------------
+# MOMENTS REGISTRY
+# one estimator per (symbols, tail_count) over a dataframe, handed to every strategy driven by that feed
+# (backtest.run_multi_backtest): update() only consumes new bars, so each window is updated once per bar
+# however many strategies read it
+# ------------------------------------------------------------------------------------------------------
+class MomentsRegistry(object):
+
+    def __init__(self, bars):
+        self.bars = bars
+        self.estimators = {}
+
+    def estimator(self, symbols, tail_count=None):
+        key = (tuple(symbols),tail_count)
+        if key not in self.estimators:
+            self.estimators[key] = ReturnMomentsEstimator(self.bars,symbols,tail_count)
+        return self.estimators[key]
+
+    def __len__(self):
+        return len(self.estimators)
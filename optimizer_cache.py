@@ -0,0 +1,137 @@
+import os, os.path
+import time
+import hashlib
+import argparse
+import numpy as np
+from collections import OrderedDict
+
+from cache_files import save_npy, npy_entries, evict_lru
+
+
+# ------------------------------------------------------------------------------------------------------
+# OPTIMIZER CACHE
+# results of PortfolioSharpeMaximization.calculate_optimal_allocations shared across runs (sweeps,
+# repeated research runs), content-addressed by
+#   sha1(symbols | mode, tail_count | window bounds | data fingerprint [| optimizer inputs])
+# the data fingerprint covers every symbol's source and the merged timeline (AlpacaDataFrame.data_fingerprint).
+# exact=True also keys on the optimizer's inputs (mean vector, covariance matrix, initial guess), so a hit
+# gives the very weights solving would: the running moments carry rounding that depends on how the bars
+# were fed (warm-up size), and warm-started solves depend on the previous weights.
+# exact=False keys on the window only, runs with another warm-up or warm start chain share the entries
+# (weights equal within the solver's tolerance).
+# Entries live in an in-memory LRU and on disk, one small .npy per entry written atomically, so several
+# worker processes can read and write the same folder.
+# Disk entries are evicted least recently used first once the folder grows past max_bytes.
+# ------------------------------------------------------------------------------------------------------
+
+VERSION = 1 # bumped whenever the optimizer or the moments estimator change
+
+
+class OptimizerCache(object):
+
+    def __init__(self, cache_dir, capacity=4096, max_bytes=256*1024**2, exact=True):
+        self.cache_dir = cache_dir # None = in-memory only
+        self.capacity = capacity # entries kept in memory
+        self.max_bytes = max_bytes
+        self.exact = exact
+        self.memory = OrderedDict() # key -> entry, least recently used first
+        self.stats = {'memory_hits':0,'disk_hits':0,'misses':0,'writes':0,'evictions':0,
+                      'load_time':0.0,'saved_time':0.0}
+
+    def key(self, symbols, mode, tail_count, window, data_key, mean=None, cov=None, init_guess=None):
+        parts = [str(VERSION),','.join(symbols),mode,str(tail_count),'%d:%d' % window,data_key]
+        digest = hashlib.sha1('|'.join(parts).encode('utf-8'))
+        if self.exact:
+            for values in (mean,cov,init_guess):
+                digest.update(np.ascontiguousarray(values,dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        # entries are spread over 256 sub-folders
+        return os.path.join(self.cache_dir,key[:2],key[2:]+'.npy')
+
+    def get(self, key):
+        # (weights, [returns, volatility, sharpe], [iterations, evaluations, solve_time]) or None
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            self.stats['memory_hits'] += 1
+        elif self.cache_dir is not None:
+            entry = self.load(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['saved_time'] += entry[-1]
+        return entry[:-6], entry[-6:-3], entry[-3:]
+
+    def load(self, key):
+        start = time.perf_counter()
+        path = self.entry_path(key)
+        try:
+            entry = np.load(path,allow_pickle=False)
+            os.utime(path) # most recently used
+        except (OSError, ValueError):
+            return None # missing, or evicted by another process meanwhile
+        self.stats['disk_hits'] += 1
+        self.stats['load_time'] += time.perf_counter() - start
+        self.remember(key,entry)
+        return entry
+
+    def put(self, key, weights, report, stats):
+        entry = np.concatenate([weights,report,stats]).astype(np.float64)
+        self.remember(key,entry)
+        if self.cache_dir is None:
+            return
+        save_npy(self.entry_path(key),entry)
+        self.stats['writes'] += 1
+
+    def remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def entries(self):
+        # [(path, size, last used)] of every entry on disk
+        if self.cache_dir is None or not os.path.exists(self.cache_dir):
+            return []
+        folders = [os.path.join(self.cache_dir,folder) for folder in os.listdir(self.cache_dir)]
+        return npy_entries(folder for folder in folders if os.path.isdir(folder))
+
+    def evict(self, max_bytes=None):
+        # drop least recently used entries until the disk cache fits in max_bytes
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        total, evicted = evict_lru(self.entries(),max_bytes)
+        self.stats['evictions'] += evicted
+        return total
+
+    @property
+    def hit_rate(self):
+        stats = self.stats
+        hits = stats['memory_hits'] + stats['disk_hits']
+        return hits/max(hits+stats['misses'],1)
+
+    def report(self):
+        stats = self.stats
+        print('<<-------| OPTIMIZER CACHE REPORT |------->>')
+        print('Memory Hits:',stats['memory_hits'],' Disk Hits:',stats['disk_hits'],' Misses:',stats['misses'],
+              ' Hit Rate (%):',round(100*self.hit_rate,2))
+        print('Writes:',stats['writes'],' Evictions:',stats['evictions'],' In Memory:',len(self.memory))
+        print('Load Time (s):',round(stats['load_time'],4),' Solve Time Saved (s):',round(stats['saved_time'],4))
+        if self.cache_dir is not None:
+            entries = self.entries()
+            print('Entries:',len(entries),' Size (MB):',round(sum(e[1] for e in entries)/1024**2,2),
+                  'of',round(self.max_bytes/1024**2,2))
+
+
+if __name__ == '__main__':
+    # python optimizer_cache.py .cache/optimizer --max_mb 64
+    parser = argparse.ArgumentParser(description='Report on (and trim) an optimizer cache folder')
+    parser.add_argument('cache_dir')
+    parser.add_argument('--max_mb',type=float,default=None)
+    args = parser.parse_args()
+    cache = OptimizerCache(args.cache_dir)
+    if args.max_mb is not None:
+        cache.max_bytes = int(args.max_mb*1024**2)
+        cache.evict()
+    cache.report()
@@ -1,11 +1,15 @@
 import pandas as pd
 import numpy as np
 import datetime
+import tempfile
+import bisect
 
 from math import floor
 from abc import ABCMeta, abstractmethod
 
-from event import FillEvent, OrderEvent
+from event import EventType, FillEvent, OrderEvent, BatchOrderEvent
+from bar_cache import NS_PER_DAY
+from checkpoint import scalar
 
 class Portfolio(object):
 
@@ -30,128 +34,487 @@ class Portfolio(object):
 # ------------------------------------------------------------------------------------------------------
 class SamplePortfolio(Portfolio):
 
-    def __init__(self, bars, events, initial_balance = 100000.0):
+    def __init__(self, bars, events, initial_balance = 100000.0, ledger_rows = None):
         self.bars = bars
         self.events = events
         self.symbols = self.bars.symbols
         self.initial_balance = initial_balance
-        self.cash_balance = initial_balance
-        self.daily_logged_stamps = {} # for logging to drop when performing analysis for logging
-        self.portfolio_value = pd.DataFrame(columns =self.symbols+['Cash Balance','Total Value']) # indexed over time
-        self.holdings = {} # holdings tracks all holdings, indexed over time
-        initial_value = pd.Series(data = float(0),index=list(self.portfolio_value.columns),name=self.bars.latest_stamps[-1])
-        initial_value['Cash Balance'] = self.cash_balance
-        initial_value['Total Value'] = self.cash_balance
-        self.portfolio_value = self.portfolio_value.append(initial_value)
-        for s in self.symbols:
-            self.holdings[s] = pd.DataFrame(columns = ['close','position','value'])
-            self.holdings[s] = self.holdings[s].append(pd.Series(data=float(0),index=['close','position','value'],name=self.bars.latest_stamps[-1]))
-            self.holdings[s].at[self.holdings[s].index[-1],'close'] = self.bars.get_latest_bars(s).close
+        # ledger rows start at the latest warm-up bar, one row per bar to be updated afterwards
+        # ledger_rows bounds the rows held in memory, older rows are spilled to disk (None = all in memory)
+        start = self.bars.cursor-1
+        self.ledger = PortfolioLedger(self.symbols,self.bars.timestamps[start:],initial_balance,start,
+                                      capacity = ledger_rows)
+        self.ledger.mark(0,self.bars.get_latest_values('close'))
+        self.holdings = HoldingsView(self.ledger) # holdings tracks all holdings, indexed over time
+        self.daily = DailyAggregator('Total Value') # intraday: one row of Total Value statistics per day
+        self.daily_row = 0 # ledger rows (counted from the first one) before this one are in the daily aggregates
+        self.fill_count = 0 # fills received, per symbol (batched fills count every symbol)
+
+    @property
+    def cash_balance(self):
+        return self.ledger.cash[self.ledger.row]
+
+    @property
+    def portfolio_value(self):
+        # indexed over time, built from the ledger on request (for analysis after the run)
+        return self.ledger.portfolio_frame()
+
+    def get_row(self,bar):
+        # in-memory ledger row of a bar number (event.bar)
+        return bar - self.ledger.start
+
+    def event_row(self,event):
+        return self.get_row(self.bars.event_bar(event))
 
     def update_portfolio(self,event):
         # updating portfolio after order was executed
         # position---> (-) = SELL, (+) = BUY, 0 = No position
-        if event.order_type == 'MARKET':
+        if event.type is EventType.BATCH_FILL:
+            self.update_portfolio_batch(event)
+            return
+        self.fill_count += 1
+        if event.order_type == 'MARKET' or event.price is not None:
+            row = self.event_row(event)
+            # filled at the price the broker reports, or at the bar's close
+            price = self.ledger.close[row,self.ledger.symbol_index[event.symbol]] if event.price is None else event.price
             if event.action == 'BUY':
-                close = self.bars.get_latest_bars(event.symbol,N=1).close
-                new_position = self.holdings[event.symbol].at[event.stamp,'position'] + event.shares
-                new_value = new_position*close
-                new_cash = self.cash_balance - (event.shares*close + event.commission)
-                self.holdings[event.symbol].at[event.stamp,'position'] = new_position
-                self.holdings[event.symbol].at[event.stamp,'value'] = new_value
-                self.cash_balance = new_cash
+                self.ledger.fill(row,event.symbol,event.shares,price,event.commission)
             elif event.action == 'SELL':
-                close = self.holdings[event.symbol].at[event.stamp,'close']
-                new_position = self.holdings[event.symbol].at[event.stamp,'position'] - event.shares
-                new_value = new_position*close
-                new_cash = self.cash_balance + (event.shares*close + event.commission)
-                self.holdings[event.symbol].at[event.stamp,'position'] = new_position
-                self.holdings[event.symbol].at[event.stamp,'value'] = new_value
-                self.cash_balance = new_cash
+                self.ledger.fill(row,event.symbol,-event.shares,price,event.commission)
             else:
                 pass # NO BUY OR SELL WAS MADE AND WE ALREADY UPDATED HOLDINGS VALUES, THROUGH UPDATE_HOLDINGS(), AS SOON AS THE NEW BAR WAS LAUNCH,
-            self.update_portfolio_value(event)
-
-    def update_portfolio_value(self,event):
-        # called for MarketEvent and FillEvent
-        if event.stamp in self.portfolio_value.index:
-            new_value = self.holdings[event.symbol].at[event.stamp,'value']
-            self.portfolio_value.at[event.stamp,event.symbol] = new_value
-            self.portfolio_value.at[event.stamp,'Cash Balance'] = self.cash_balance
-            total_value = self.portfolio_value.loc[event.stamp].drop('Total Value').sum()
-            self.portfolio_value.at[event.stamp,'Total Value'] = total_value
-        else:
-            # if event stamp isn't in portfolio_value, meaning it's new so we'll craft a new data row to append
-            values = []
-            for s in self.symbols:
-                values.append(self.holdings[s].at[event.stamp,'value'])
-            data = pd.Series(data = values,index = self.symbols,name=event.stamp) # set new index as event stamp
-            data['Cash Balance'] = self.cash_balance
-            data['Total Value'] = data.sum()
-            self.portfolio_value = self.portfolio_value.append(data)
 
+    def update_portfolio_batch(self,event):
+        # a whole rebalance applied to the ledger row in one vectorized update
+        self.fill_count += len(event)
+        if event.order_type == 'MARKET' or event.prices is not None:
+            row = self.event_row(event)
+            columns = np.array([self.ledger.symbol_index[s] for s in event.symbols],dtype=np.int64)
+            actions = np.asarray(event.actions)
+            shares = np.where(actions == 'BUY',event.shares,np.where(actions == 'SELL',-np.asarray(event.shares),0.0))
+            prices = self.ledger.close[row,columns] if event.prices is None else event.prices
+            self.ledger.fill_batch(row,columns,shares,prices,event.commission)
 
     def generate_order(self,event):
         # Strategy has access to all components except execution
         order = OrderEvent(event.symbol,shares = event.shares, action = event.action,
                             order_type = event.order_type,limit_price = event.limit_price,
-                            stop_price = event.stop_price, stamp = event.stamp)
+                            stop_price = event.stop_price, stamp = event.stamp, bar = self.bars.event_bar(event))
         print(order)
         return order
 
     def update_signal(self,event):
-        if event.type == 'SIGNAL':
+        if event.type is EventType.SIGNAL:
             order = self.generate_order(event)
             self.events.put(order)
+        elif event.type is EventType.REBALANCE:
+            # one order event for the whole rebalance
+            order = BatchOrderEvent(event.symbols,event.stamp,event.order_type,event.actions,event.shares,
+                                    limit_prices=event.limit_prices,stop_prices=event.stop_prices,
+                                    bar=self.bars.event_bar(event))
+            print(order)
+            self.events.put(order)
 
     def update_holdings(self,event):
-        # Method accounts for more than one bar missing
-        # PURPOSE: add missing stamps between our current holdings and dataframe
-        if event.type == 'MARKET':
-            new_stamp = event.stamp
-            for s in self.symbols:
-                new_bar = self.bars.latest_symbol_data[s].loc[new_stamp]
-                if self.holdings[s].empty:
-                    to_update = pd.Series(data=float(0), index=['close','position'])
-                else:
-                    to_update = self.holdings[s].loc[self.holdings[s].index[-1]].drop('value') #set as the last holding and modify next
-                to_update.name = new_bar.name
-                to_update.close = new_bar.close
-                to_update['value'] = to_update.prod()
-                self.holdings[s] = self.holdings[s].append(to_update)
-            self.update_portfolio_value(event)
+        # PURPOSE: carry positions from the last ledger row over to the new bar and revalue them at its closes
+        if event.type is EventType.MARKET:
+            bar = self.bars.event_bar(event)
             if (self.bars.interval[-1].lower() != 'd'):
-                self.daily_portfolio_logging()
-
-    def daily_portfolio_logging(self):
-        # serve as a function to analyze latest stamps to determine whether to spit out a printed report or not
-        # saves logs to daily_logged_stamps
-        stamps = self.bars.latest_stamps
-        dstamps = pd.to_datetime(stamps)
-        if len(dstamps) == 1: # first bar
-            pass
-        elif dstamps[-1].date() == dstamps[-2].date():
-            # if we're still in the same day, we won't do anything
-            pass
-        elif dstamps[-1].date() != dstamps[-2].date():
-            # if we're in the next day, we'll print our report
-            if len(self.daily_logged_stamps) == 0:
-                stamps_to_log = stamps[:-1] # exclude latest stamp since it's in the next day
-            else:
-                to_drop = None
-                for i in self.daily_logged_stamps:
-                    if type(to_drop) != pd.Index:
-                        to_drop = self.daily_logged_stamps[i]
-                    else:
-                        to_drop = to_drop.append(self.daily_logged_stamps[i])
-                stamps_to_log = stamps[:-1].drop(to_drop)
-            self.daily_logged_stamps[dstamps[-2].date()] = stamps_to_log # update logged_stamps for future updates
-            pfolio_value = self.portfolio_value.loc[stamps_to_log]
-            total_value = pfolio_value['Total Value'].describe()
-            stamp_header = dstamps[-2].strftime("%B %d, %Y")
+                self.daily_portfolio_logging(bar) # before the mark, which may spill the finished rows
+            self.ledger.mark(self.get_row(bar),self.bars.get_latest_values('close'))
+
+    def daily_portfolio_logging(self,bar):
+        # bars finished since the last call go into the running daily aggregates of Total Value,
+        # on the first bar of a new day the previous day's report is printed and stored (self.daily)
+        row = bar - self.ledger.origin
+        if row > self.daily_row: # a row is final once the next bar comes in (after its fills)
+            self.add_daily_rows(row)
+        if self.bars.new_day[bar] and self.daily.count > 0:
+            stamp_header = pd.Timestamp(self.bars.stamps[bar-1]).strftime("%B %d, %Y")
+            total_value = self.daily.close_day()
             print('<<-------| PORTFOLIO VALUE REPORT:',stamp_header,'|------->>')
             print(total_value)
 
+    def daily_value(self):
+        # per-day Total Value statistics (self.daily), called after the run: the remaining rows are final
+        if self.ledger.n_rows > self.daily_row:
+            self.add_daily_rows(self.ledger.n_rows)
+        return self.daily.frame()
+
+    def add_daily_rows(self,stop):
+        # ledger rows [daily_row, stop) into the daily aggregates
+        origin = self.ledger.origin
+        days = self.bars.stamps[origin+self.daily_row:origin+stop]//NS_PER_DAY
+        for total,day in zip(self.ledger.read('total',self.daily_row,stop),days):
+            self.daily.add(total,day)
+        self.daily_row = stop
+
+    def get_state(self):
+        # checkpoint.py: the ledger rows themselves are saved incrementally (PortfolioLedger.rows_state)
+        return {'row':self.ledger.n_rows-1,'daily_row':self.daily_row,'fill_count':self.fill_count,
+                'daily':self.daily.get_state()}
+
+    def set_state(self, state):
+        self.ledger.seek(scalar(state['row']))
+        self.daily_row = scalar(state['daily_row'])
+        self.fill_count = scalar(state['fill_count'])
+        self.daily.set_state(state['daily'])
+
+
+# ------------------------------------------------------------------------------------------------------
+# PORTFOLIO LEDGER
+# preallocated position/close/value/cash arrays indexed by bar number (row),
+# so marks and fills are in-place updates instead of appending pandas rows
+# With a capacity only that many rows are held in memory: once they are full the finished rows are
+# spilled to a temporary file (one float64 record per row) and the latest row moves back to row 0,
+# so a run of any length holds at most `capacity` rows. Rows in memory are numbered from `start` (bar of row 0),
+# read() and the frames cover every row from the first one (`origin`), on disk or in memory.
+# ------------------------------------------------------------------------------------------------------
+class PortfolioLedger(object):
+
+    def __init__(self, symbols, stamps, initial_balance, start=0, capacity=None):
+        self.symbols = list(symbols)
+        self.symbol_index = {s:i for i,s in enumerate(self.symbols)}
+        self.stamps = stamps # one row per bar, starting at the first bar the portfolio sees
+        self.origin = start # bar number of the first row
+        self.start = start # bar number of row 0 in memory
+        self.first_row = 0 # rows before this one are spilled
+        n_bars = len(stamps)
+        if capacity is not None and capacity < n_bars:
+            n_bars = max(capacity,2)
+        self.spilling = n_bars < len(stamps)
+        self.spill = None # temporary file of the spilled rows
+        n_symbols = len(self.symbols)
+        self.position = np.zeros((n_bars,n_symbols),dtype=np.float64)
+        self.close = np.zeros((n_bars,n_symbols),dtype=np.float64)
+        self.value = np.zeros((n_bars,n_symbols),dtype=np.float64)
+        self.cash = np.zeros(n_bars,dtype=np.float64)
+        self.total = np.zeros(n_bars,dtype=np.float64)
+        self.row = 0 # latest marked row
+        self.cash[0] = initial_balance
+        self.total[0] = initial_balance
+
+    # record layout of a spilled row: position, close and value of every symbol, then cash and total
+    COLUMNS = ['position','close','value','cash','total']
+
+    @property
+    def n_rows(self):
+        # rows marked so far, spilled ones included
+        return self.first_row + self.row + 1
+
+    def mark(self,row,closes):
+        # called once per new bar: carry positions and cash from the last marked row,
+        # then revalue them at the new closes
+        if row >= len(self.cash):
+            row -= self.shift(self.row)
+        prev = self.row
+        self.close[row] = closes
+        if row != prev:
+            self.position[row] = self.position[prev]
+            self.cash[row] = self.cash[prev]
+        np.multiply(self.position[row],self.close[row],out=self.value[row])
+        self.total[row] = np.nansum(self.value[row]) + self.cash[row]
+        self.row = row
+
+    def fill(self,row,symbol,shares,price,commission=0.0):
+        # O(1) update of one symbol's position and the cash balance for an executed order
+        # shares are signed: (+) = BUY, (-) = SELL
+        j = self.symbol_index[symbol]
+        old_value = self.value[row,j]
+        old_cash = self.cash[row]
+        self.position[row,j] += shares
+        self.value[row,j] = self.position[row,j]*self.close[row,j]
+        self.cash[row] = old_cash - (shares*price + commission)
+        self.total[row] += (np.nan_to_num(self.value[row,j]) - np.nan_to_num(old_value)) + (self.cash[row] - old_cash)
+
+    def fill_batch(self,row,columns,shares,prices,commissions=0.0):
+        # many fills of one row at once (signed shares per column), with the same arithmetic and rounding
+        # as calling fill() for each of them in order: cash and total are folded in sequence (accumulate)
+        if len(np.unique(columns)) != len(columns):
+            for j,n,p,c in zip(columns,shares,prices,np.broadcast_to(commissions,len(columns))):
+                self.fill(row,self.symbols[j],n,p,c)
+            return
+        old_value = self.value[row,columns]
+        self.position[row,columns] += shares
+        self.value[row,columns] = self.position[row,columns]*self.close[row,columns]
+        cash = np.subtract.accumulate(np.concatenate([[self.cash[row]],shares*prices + commissions]))
+        self.cash[row] = cash[-1]
+        changes = (np.nan_to_num(self.value[row,columns]) - np.nan_to_num(old_value)) + np.diff(cash)
+        self.total[row] = np.add.accumulate(np.concatenate([[self.total[row]],changes]))[-1]
+
+    #---------------------------------SPILLING--------------------------------#
+
+    def shift(self,n):
+        # spill the first n rows in memory and move the others down to row 0, returns n
+        self.write_records(self.first_row,{name:getattr(self,name)[:n] for name in self.COLUMNS})
+        kept = slice(n,self.row+1)
+        for name in self.COLUMNS:
+            column = getattr(self,name)
+            column[:self.row+1-n] = column[kept]
+        self.first_row += n
+        self.start += n
+        self.row -= n
+        return n
+
+    def write_records(self,first,rows):
+        # rows (dict of columns) written to the spill file from row `first` on
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+        records = np.column_stack([rows[name] for name in self.COLUMNS])
+        self.spill.seek(first*records.shape[1]*records.itemsize)
+        self.spill.write(np.ascontiguousarray(records,dtype=np.float64).tobytes())
+        self.spill.flush()
+
+    def spilled(self,name,first,stop):
+        # one column of the spilled rows [first, stop)
+        n = len(self.symbols)
+        width = 3*n + 2
+        self.spill.seek(0,2) # rows written so far, from the size of the file
+        records = np.memmap(self.spill,dtype=np.float64,mode='r',shape=(self.spill.tell()//(8*width),width))
+        k = self.COLUMNS.index(name)
+        columns = slice(k*n,(k+1)*n) if k < 3 else 3*n + k - 3
+        return np.array(records[first:stop,columns])
+
+    def read(self,name,first=0,stop=None):
+        # column `name` of the rows [first, stop), counted from the first row (spilled ones included)
+        stop = self.n_rows if stop is None else stop
+        memory = getattr(self,name)
+        if first >= self.first_row:
+            return memory[first-self.first_row:stop-self.first_row]
+        on_disk = self.spilled(name,first,min(stop,self.first_row))
+        if stop <= self.first_row:
+            return on_disk
+        return np.concatenate([on_disk,memory[:stop-self.first_row]])
+
+    def seek(self,row):
+        # latest marked row (counted from the first one), after the rows were put back from a checkpoint
+        if not self.spilling:
+            self.row = row
+            return
+        # every row restored is in the spill file: the latest one is read back into row 0
+        for name in self.COLUMNS:
+            getattr(self,name)[0] = self.spilled(name,row,row+1)[0]
+        self.first_row = row
+        self.start = self.origin + row
+        self.row = 0
+
+    #---------------------------------CHECKPOINTS--------------------------------#
+
+    def rows_state(self,first):
+        # rows [first, n_rows) for a checkpoint: a row does not change anymore once every event of its bar was handled
+        state = {'first':first}
+        for name in self.COLUMNS:
+            state[name] = np.array(self.read(name,first))
+        return state
+
+    def set_rows(self,state):
+        if 'first' not in state:
+            return
+        first = scalar(state['first'])
+        if self.spilling:
+            self.write_records(first,state)
+        # the rows that fall in memory
+        lo = max(first,self.first_row)
+        hi = min(first+len(state['cash']),self.first_row+len(self.cash))
+        if hi > lo:
+            for name in self.COLUMNS:
+                getattr(self,name)[lo-self.first_row:hi-self.first_row] = state[name][lo-first:hi-first]
+
+    #---------------------------------FRAMES--------------------------------#
+
+    def holdings_frame(self,symbol):
+        j = self.symbol_index[symbol]
+        n = self.n_rows
+        return pd.DataFrame({'close':self.read('close')[:,j],
+                            'position':self.read('position')[:,j],
+                            'value':self.read('value')[:,j]},
+                            index=self.stamps[:n])
+
+    def portfolio_frame(self):
+        n = self.n_rows
+        result = pd.DataFrame(self.read('value'),index=self.stamps[:n],columns=self.symbols)
+        result['Cash Balance'] = self.read('cash')
+        result['Total Value'] = self.read('total')
+        return result
+
+
+class HoldingsView(object):
+
+    # dict-like holdings[symbol] -> DataFrame of close/position/value, built lazily from the ledger
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+
+    def __getitem__(self, symbol):
+        return self.ledger.holdings_frame(symbol)
+
+    def __contains__(self, symbol):
+        return symbol in self.ledger.symbol_index
+
+    def __iter__(self):
+        return iter(self.ledger.symbols)
+
+    def __len__(self):
+        return len(self.ledger.symbols)
+
+    def keys(self):
+        return list(self.ledger.symbols)
+
+
+# ------------------------------------------------------------------------------------------------------
+# P-SQUARE QUANTILE SKETCH
+# streaming estimate of one quantile with 5 markers (Jain & Chlamtac), constant memory and O(1) per value
+# ------------------------------------------------------------------------------------------------------
+class P2Quantile(object):
+
+    def __init__(self, q):
+        self.q = q # 0 < q < 1
+        self.reset()
+
+    def reset(self):
+        q = self.q
+        self.count = 0
+        self.heights = [] # the first 5 values (sorted), marker heights afterwards
+        self.positions = [1,2,3,4,5]
+        self.desired = [1,1+2*q,1+4*q,3+2*q,5]
+        self.increments = [0,q/2,q,(1+q)/2,1]
+
+    def add(self, x):
+        self.count += 1
+        h = self.heights
+        if self.count <= 5:
+            bisect.insort(h,x)
+            return
+        n = self.positions
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = bisect.bisect_right(h,x) - 1 # h[k] <= x < h[k+1]
+        for i in range(k+1,5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        # move the middle markers towards their desired positions
+        for i in (1,2,3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i+1]-n[i] > 1) or (d <= -1 and n[i-1]-n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = h[i] + d/(n[i+1]-n[i-1])*((n[i]-n[i-1]+d)*(h[i+1]-h[i])/(n[i+1]-n[i])
+                                                   + (n[i+1]-n[i]-d)*(h[i]-h[i-1])/(n[i]-n[i-1]))
+                if not h[i-1] < height < h[i+1]:
+                    height = h[i] + d*(h[i+d]-h[i])/(n[i+d]-n[i]) # parabolic step overshoots, linear step
+                h[i] = height
+                n[i] += d
+
+    def get_state(self):
+        return {'count':self.count,'heights':np.array(self.heights,dtype=np.float64),
+                'positions':np.array(self.positions,dtype=np.int64),'desired':np.array(self.desired,dtype=np.float64)}
+
+    def set_state(self, state):
+        self.count = scalar(state['count'])
+        self.heights = state['heights'].tolist()
+        self.positions = state['positions'].tolist()
+        self.desired = state['desired'].tolist()
+
+    def value(self):
+        if self.count == 0:
+            return np.nan
+        if self.count <= 5:
+            return float(np.percentile(self.heights,100*self.q)) # exact (linear), same as pandas
+        return self.heights[2]
+
+
+# ------------------------------------------------------------------------------------------------------
+# DAILY AGGREGATOR
+# running count/mean/std/min/max and quantile sketches (P2Quantile) of one value per bar for the
+# current session, closed into a compact per-day table at every day rollover
+# ------------------------------------------------------------------------------------------------------
+class DailyAggregator(object):
+
+    STATS = ['count','mean','std','min','25%','50%','75%','max'] # same rows as pd.Series.describe()
+
+    def __init__(self, name='Total Value', quantiles=(0.25,0.5,0.75), capacity=256):
+        self.name = name
+        self.sketches = [P2Quantile(q) for q in quantiles]
+        self.days = np.zeros(capacity,dtype=np.int64) # closed days, as days since epoch
+        self.table = np.zeros((capacity,len(self.STATS)),dtype=np.float64)
+        self.n_days = 0
+        self.reset()
+
+    def reset(self):
+        self.day = None # day of the current session
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0 # sum of squared deviations (Welford)
+        self.min = np.inf
+        self.max = -np.inf
+        for sketch in self.sketches:
+            sketch.reset()
+
+    def add(self, x, day):
+        self.day = day
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta/self.count
+        self.m2 += delta*(x - self.mean)
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        for sketch in self.sketches:
+            sketch.add(x)
+
+    def session_stats(self):
+        # describe() of the current session
+        if self.count == 0:
+            return np.array([0.0]+[np.nan]*(len(self.STATS)-1))
+        std = np.sqrt(self.m2/(self.count-1)) if self.count > 1 else np.nan
+        return np.array([self.count,self.mean,std,self.min]+[s.value() for s in self.sketches]+[self.max])
+
+    def close_day(self):
+        # store the session as one row of the table, start a new one; returns the row
+        if self.n_days == len(self.days):
+            self.days = np.concatenate([self.days,np.zeros_like(self.days)])
+            self.table = np.concatenate([self.table,np.zeros_like(self.table)])
+        row = self.session_stats()
+        self.days[self.n_days] = self.day
+        self.table[self.n_days] = row
+        self.n_days += 1
+        self.reset()
+        return pd.Series(row,index=self.STATS,name=self.name)
+
+    def frame(self, partial=True):
+        # one row per closed day (plus the session in progress when partial = True), for after the run
+        days = self.days[:self.n_days]
+        table = self.table[:self.n_days]
+        if partial and self.count > 0:
+            days = np.append(days,self.day)
+            table = np.vstack([table,self.session_stats()])
+        return pd.DataFrame(table,index=pd.to_datetime(days,unit='D').strftime('%Y-%m-%d'),columns=self.STATS)
+
+    def export(self, csv_file, partial=True):
+        self.frame(partial).to_csv(csv_file)
+        return csv_file
+
+    def get_state(self):
+        return {'days':self.days[:self.n_days].copy(),'table':self.table[:self.n_days].copy(),
+                'day':-1 if self.day is None else self.day,'count':self.count,'mean':self.mean,'m2':self.m2,
+                'min':self.min,'max':self.max,
+                'sketches':{str(k):sketch.get_state() for k,sketch in enumerate(self.sketches)}}
 
-        
-        
\ No newline at end of file
+    def set_state(self, state):
+        self.n_days = len(state['days'])
+        capacity = max(len(self.days),self.n_days)
+        self.days = np.zeros(capacity,dtype=np.int64)
+        self.table = np.zeros((capacity,len(self.STATS)),dtype=np.float64)
+        self.days[:self.n_days] = state['days']
+        self.table[:self.n_days] = state['table']
+        self.day = None if scalar(state['day']) < 0 else scalar(state['day'])
+        for name in ('count','mean','m2','min','max'):
+            setattr(self,name,scalar(state[name]))
+        for k,sketch in enumerate(self.sketches):
+            sketch.set_state(state['sketches'][str(k)])
@@ -1,4 +1,5 @@
 import datetime
+import time
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -6,12 +7,17 @@ import queue
 import statsmodels.api as sm
 from math import floor
 from abc import ABCMeta, abstractmethod
-from event import SignalEvent
+from event import EventType, SignalEvent, RebalanceEvent
 from event import MarketEvent
 from scipy.optimize import minimize
 import talib
+from moments import ReturnMomentsEstimator
+from checkpoint import scalar
 
-from nn_bbox import Stocks_BBox
+try:
+    from nn_bbox import Stocks_BBox
+except ImportError:
+    Stocks_BBox = None # optional, only the neural network strategies need it
 
 
 class Strategy(object):
@@ -22,6 +28,13 @@ class Strategy(object):
     def calculate_signals(self):
         raise NotImplementedError('implement calculate_signals() to proceed')
 
+    def get_state(self):
+        # state carried from bar to bar, saved in checkpoints (checkpoint.py)
+        return {}
+
+    def set_state(self, state):
+        pass
+
 
 
 class PortfolioSharpeMaximization(Strategy):
@@ -47,19 +60,55 @@ class PortfolioSharpeMaximization(Strategy):
 
     '''
 
-    def __init__(self,bars,events,portfolio):
+    def __init__(self,bars,events,portfolio,mode='full',tail_count=None,allocations_pct=1,warm_start=True,
+                schedule=None,batched=True,optimizer_cache=None,moments=None):
         self.bars = bars
         self.symbols = self.bars.symbols
         self.events = events
         self.portfolio = portfolio
+        self.mode = mode # 'full' = all bars updated so far, 'tail' = last tail_count bars
+        self.tail_count = tail_count
+        self.allocations_pct = allocations_pct # fraction of total portfolio value to allocate
+        self.warm_start = warm_start # start each solve from the previous bar's weights
+        self.batched = batched # one RebalanceEvent per bar instead of one SignalEvent per trade
+        self.last_weights = None
+        # solves run by this strategy, and the weights it took from the optimizer cache or the schedule instead
+        self.solver_stats = {'solves':0,'iterations':0,'evaluations':0,'solve_time':0.0,'cached':0,'scheduled':0}
+        # precomputed walk-forward weights (walkforward.AllocationSchedule), looked up instead of solving inline
+        self.schedule = None
+        if schedule is not None and schedule.matches(self.symbols,mode,tail_count):
+            self.schedule = schedule
+        # optimizer results shared across runs (optimizer_cache.OptimizerCache), None = always solve
+        self.optimizer_cache = optimizer_cache
+        self.data_key = self.bars.data_fingerprint() if optimizer_cache is not None else None
+        # running log return moments of our symbols, updated once per bar and read by the optimizer
+        # (shared with the other strategies on the feed when a moments.MomentsRegistry is given)
+        if moments is not None:
+            self.moments = moments.estimator(self.symbols,tail_count if mode == 'tail' else None)
+        else:
+            self.moments = ReturnMomentsEstimator(self.bars,self.symbols,
+                                                tail_count if mode == 'tail' else None)
+        # bars read back from the dataframe: the tail window, or all of them
+        self.bars.set_lookback(tail_count if mode == 'tail' else None)
 
 
     def calculate_signals(self, event):
-        if event.type == 'MARKET':
+        if event.type is EventType.MARKET:
+            if self.schedule is None or self.bars.event_bar(event) not in self.schedule:
+                self.moments.update()
+            if self.batched:
+                rebalance = self.allocations_optimization_rebalance(event,self.symbols,self.mode,
+                                                                    allocations_pct=self.allocations_pct,
+                                                                    tail_count=self.tail_count)
+                if rebalance is not None:
+                    self.events.put(rebalance)
+                return
             all_signals = []
             #----CHECK AND MODIFY EXISTING POSITIONS
             #----CONSTANTLY OPTIMIZING ALLOCATIONS AT 50% OF TOTAL PORTFOLIO VALUE
-            allocations_signals = self.allocations_optimization_signals(event,self.symbols,'full')
+            allocations_signals = self.allocations_optimization_signals(event,self.symbols,self.mode,
+                                                                        allocations_pct=self.allocations_pct,
+                                                                        tail_count=self.tail_count)
             for s in allocations_signals:
                 all_signals.append(s)
             #----PUT ALL SIGNALS INTO QUEUE----#
@@ -69,75 +118,139 @@ class PortfolioSharpeMaximization(Strategy):
             #----------------------------------#
 
     def allocations_optimization_signals(self,event,symbols,mode,allocations_pct=1,tail_count=None):
+        # one SignalEvent per trade
+        columns, actions, shares = self.allocations_optimization_trades(event,symbols,mode,allocations_pct,tail_count)
+        return [SignalEvent(symbols[j],shares = n,action = a, order_type = 'MARKET',
+                            stamp = event.stamp, bar = event.bar) for j,a,n in zip(columns,actions,shares)]
+
+    def allocations_optimization_rebalance(self,event,symbols,mode,allocations_pct=1,tail_count=None):
+        # every trade in one RebalanceEvent (None when there is nothing to trade)
+        columns, actions, shares = self.allocations_optimization_trades(event,symbols,mode,allocations_pct,tail_count)
+        if len(columns) == 0:
+            return None
+        return RebalanceEvent([symbols[j] for j in columns],stamp = event.stamp,order_type = 'MARKET',
+                              actions = actions,shares = shares,bar = event.bar)
+
+    def allocations_optimization_trades(self,event,symbols,mode,allocations_pct=1,tail_count=None):
         # WE UPDATE ASSETS_ALLOCATIONS EVERYTIME WE DO FULL OPTIMIZATIONS
-        allocations_plan = self.calculate_allocations_plan(event,symbols,mode,allocations_pct,tail_count)
+        # returns (symbol indexes, actions, shares) of the trades: all sells first, then all buys
+        allocations_plan = self.allocations_plan(event,symbols,mode,allocations_pct,tail_count)
         # ALLOCATIONS PLAN CREATED CONTAINS FRACTIONAL SHARE ALLOCATIONS
-        signals = []
-        buying_power = self.portfolio.cash_balance
-        # we'll start with cash balance as the buying power
-        # this will adjust as we adjust positions (hypothetically)
-        for s in symbols:
-            # First check if we can get back any buying power by selling part of our shares
-            if allocations_plan.current_positions[s] > allocations_plan.share_allocations[s]:
-                action = 'SELL'
-                shares = abs(allocations_plan.share_allocations[s]-allocations_plan.current_positions[s])
-                # since we're selling n shares, we're getting n*close of the assets back as buying power
-                buying_power += shares*allocations_plan.closes[s]
-                if (shares == 0) or (action == None):
-                    pass
-                else:
-                    signals.append(SignalEvent(s,shares = shares,action = action, order_type = 'MARKET',
-                                                stamp = event.stamp))
-        for s in symbols:
-            # Now we supposedly have an atleast equal or higher amount of buying power due to adjustment we'll do everything else
-            if buying_power < abs(allocations_plan.value_allocations[s]):
-                action = 0
-                shares = 0
-            elif allocations_plan.current_positions[s] < allocations_plan.share_allocations[s]:
-                action = 'BUY'
-                shares = abs(allocations_plan.share_allocations[s]-allocations_plan.current_positions[s])
-            else:
-                action = None
-                shares = 0
-            if (shares == 0) or (action == None):
-                pass
-            else:
-                signals.append(SignalEvent(s,shares = shares,action = action, order_type = 'MARKET',
-                                            stamp = event.stamp))
-        return signals
+        current = allocations_plan['current_positions']
+        target = allocations_plan['share_allocations']
+        closes = allocations_plan['closes']
+        shares = np.abs(target-current)
+        # First check if we can get back any buying power by selling part of our shares
+        sells = np.flatnonzero((current > target) & (shares != 0))
+        # we'll start with cash balance as the buying power, since we're selling n shares,
+        # we're getting n*close of the assets back (summed in symbol order)
+        buying_power = np.add.accumulate(np.concatenate([[self.portfolio.cash_balance],shares[sells]*closes[sells]]))[-1]
+        # Now we supposedly have an atleast equal or higher amount of buying power due to adjustment we'll do everything else
+        affordable = ~(buying_power < np.abs(allocations_plan['value_allocations']))
+        buys = np.flatnonzero(affordable & (current < target) & (shares != 0))
+        columns = np.concatenate([sells,buys])
+        actions = np.array(['SELL']*len(sells)+['BUY']*len(buys),dtype=object)
+        return columns, actions, shares[columns]
 
     def calculate_allocations_plan(self,event,symbols,mode,allocations_pct=1,tail_count=None):
-        result = pd.DataFrame()
-        allocations = (self.calculate_optimal_allocations(symbols=symbols,mode=mode,tail_count=tail_count).loc[symbols])
-        close = pd.Series(data = 0.0, index = symbols)
-        value = pd.Series(data = 0.0, index = symbols)
-        position = pd.Series(data = 0.0, index = symbols)
+        return pd.DataFrame(self.allocations_plan(event,symbols,mode,allocations_pct,tail_count),index=symbols)
+
+    def allocations_plan(self,event,symbols,mode,allocations_pct=1,tail_count=None):
+        # columns of calculate_allocations_plan as arrays (in symbols order), rebuilt for every strategy
+        # on every bar so no pandas objects are created along the way
+        bar = self.bars.event_bar(event)
+        if (self.schedule is not None and bar in self.schedule) and list(symbols) == list(self.symbols):
+            weights = self.scheduled_weights(bar)
+        else:
+            weights, report = self.optimal_weights(symbols,mode,tail_count)
+        # read the current holdings straight from the portfolio ledger row of this bar
+        ledger = self.portfolio.ledger
+        row = self.portfolio.get_row(bar)
+        columns = [ledger.symbol_index[s] for s in symbols]
+        close = ledger.close[row,columns]
+        value = ledger.value[row,columns]
         current_portfolio_value = self.portfolio.cash_balance
-        for s in symbols:
-            current_portfolio_value += self.portfolio.holdings[s].at[event.stamp,'value']
-            close[s] = self.portfolio.holdings[s].at[event.stamp,'close']
-            value[s] = self.portfolio.holdings[s].at[event.stamp,'value']
-            position[s] = self.portfolio.holdings[s].at[event.stamp,'position']
-        value_allocations = (allocations_pct*current_portfolio_value*allocations['LONG']).round(6)
-        result['value_allocations'] = value_allocations
-        result['closes'] = close
-        result['share_allocations'] = np.floor(result['value_allocations']/result['closes'])
-        result['current_values'] = value
-        result['current_positions'] = position
-        return result
+        for v in value:
+            current_portfolio_value += v
+        value_allocations = np.round(allocations_pct*current_portfolio_value*weights,6)
+        return {'value_allocations':value_allocations,
+                'closes':close,
+                'share_allocations':np.floor(value_allocations/close),
+                'current_values':value,
+                'current_positions':ledger.position[row,columns]}
 
     #---------------------------------PORTFOLIO OPTIMIZATION--------------------------------#
     #------all functions below are used for finding optimal allocations for our assets------#
 
     def calculate_optimal_allocations(self,symbols,mode,tail_count=None):
         # USING SCIPY.OPTIMIZE'S MINIMIZE() FUNCTION TO OBTAIN OPTIMAL allocations and positions for latest trends
-        cons = ({'type':'eq','fun':self.check_sum})
-        bounds = []
-        init_guess = []
+        return self.allocations_frame(symbols,*self.optimal_weights(symbols,mode,tail_count))
+
+    def optimal_weights(self,symbols,mode,tail_count=None):
+        # (weights, [returns, volatility, sharpe]) of the max sharpe portfolio
+        cons = ({'type':'eq','fun':self.check_sum,'jac':self.check_sum_jac})
+        bounds = [(0,1)]*len(symbols)
+        mean, cov = self.get_return_moments(symbols,mode,tail_count)
+        init_guess = self.get_init_guess(symbols)
+        key = None
+        if self.optimizer_cache is not None:
+            cursor = self.bars.cursor
+            window = (max(cursor-tail_count,0),cursor) if mode == 'tail' else (0,cursor)
+            key = self.optimizer_cache.key(list(symbols),mode,tail_count,window,self.data_key,mean,cov,init_guess)
+            cached = self.optimizer_cache.get(key)
+            if cached is not None:
+                return self.cached_weights(symbols,*cached[:2])
+        solve_start = time.perf_counter()
+        max_sharpe = minimize(self.neg_sharpe_grad,
+                            x0=init_guess,
+                            args=(mean,cov),
+                            jac=True,
+                            method='SLSQP',
+                            bounds = bounds,
+                            constraints = cons)
+        solve_time = time.perf_counter() - solve_start
+        self.solver_stats['solve_time'] += solve_time
+        self.solver_stats['solves'] += 1
+        self.solver_stats['iterations'] += max_sharpe.nit
+        self.solver_stats['evaluations'] += max_sharpe.nfev
+        if list(symbols) == list(self.symbols) and np.all(np.isfinite(max_sharpe.x)):
+            self.last_weights = max_sharpe.x
+        long_rvs = self.sharpe_report_moments(list(max_sharpe.x),mean,cov).values
+        if key is not None:
+            self.optimizer_cache.put(key,max_sharpe.x,long_rvs,[max_sharpe.nit,max_sharpe.nfev,solve_time])
+        return max_sharpe.x, long_rvs
+
+    def cached_weights(self,symbols,weights,report):
+        # same result as optimal_weights from an optimizer cache entry, counted as a hit, not as a solve
+        self.solver_stats['cached'] += 1
+        weights = weights.copy()
+        if list(symbols) == list(self.symbols) and np.all(np.isfinite(weights)):
+            self.last_weights = weights
+        return weights, report
+
+    def allocations_frame(self,symbols,weights,report):
+        # 'LONG' column: the weights of symbols followed by the returns/volatility/sharpe report
+        return pd.DataFrame({'LONG':np.concatenate([weights,report])},
+                            index=list(symbols)+['returns','volatility','sharpe'])
+
+    def scheduled_weights(self,bar):
+        # weights of a bar from the walk-forward schedule, solved (and counted) once when it was built
+        weights = self.schedule.weights[self.schedule.row(bar)]
+        self.solver_stats['scheduled'] += 1
+        if np.all(np.isfinite(weights)):
+            self.last_weights = weights
+        return weights
+
+    def get_return_moments(self,symbols,mode,tail_count=None):
+        # mean vector and covariance matrix of log returns for the optimizer
+        # the running estimator is used whenever it tracks the requested window,
+        # otherwise they are computed from latest_symbol_data
+        if (list(symbols) == self.moments.symbols) and (
+            (mode == 'full' and self.moments.tail_count is None) or
+            (mode == 'tail' and self.moments.tail_count == tail_count)):
+            self.moments.update()
+            return self.moments.mean, self.moments.cov()
         log_ret = {}
-        for s in symbols:
-            bounds.append((0,1))
-            init_guess.append(1/len(symbols))
         if mode == 'tail':
             try:
                 for s in symbols:
@@ -149,27 +262,57 @@ class PortfolioSharpeMaximization(Strategy):
             for s in symbols:
                 df = self.bars.latest_symbol_data[s]
                 log_ret[s] = np.log(df.close/df.close.shift(1)).dropna()
-        log_ret = pd.DataFrame(log_ret)    
-        max_sharpe = minimize(self.neg_sharpe,
-                            x0=init_guess,
-                            args=log_ret,
-                            method='SLSQP',
-                            bounds = bounds,
-                            constraints = cons)
-        long_rvs = self.sharpe_report(list(max_sharpe.x),log_ret=log_ret)
-        long_allocations = pd.Series(data=max_sharpe.x,index=symbols)
-        result = pd.DataFrame()
-        result['LONG'] = long_allocations.append(long_rvs)
-        return result
+        log_ret = pd.DataFrame(log_ret)
+        return log_ret.mean().values, log_ret.cov().values
 
+    def get_init_guess(self,symbols):
+        # previous bar's optimal weights when available (warm start), equal weights otherwise
+        if (self.warm_start and self.last_weights is not None) and (list(symbols) == list(self.symbols)):
+            return self.last_weights
+        return np.full(len(symbols),1/len(symbols))
 
     # minimize negative sharpe = maximizing positive sharpe
-    def neg_sharpe(self,allocations,log_ret):
-        return self.sharpe_report(allocations,log_ret)[2] * (-1)
+    def neg_sharpe(self,allocations,mean,cov):
+        return self.sharpe_report_moments(allocations,mean,cov)[2] * (-1)
+
+    def neg_sharpe_grad(self,allocations,mean,cov):
+        # pure numpy negative sharpe and its analytic gradient, used by the optimizer
+        # d(sharpe)/dw = mean/volatility - returns*(cov.w)/volatility^3
+        weights = np.asarray(allocations)
+        cov_w = cov.dot(weights)
+        returns = mean.dot(weights)
+        volatility = np.sqrt(weights.dot(cov_w))
+        grad = mean/volatility - returns*cov_w/(volatility**3)
+        return -returns/volatility, -grad
     
     #constraint
     def check_sum(self,allocations):
         return (np.sum(allocations) - 1)
+
+    def check_sum_jac(self,allocations):
+        return np.ones(len(allocations))
+
+    def get_state(self):
+        return {'last_weights':np.zeros(0) if self.last_weights is None else np.array(self.last_weights),
+                'solver_stats':dict(self.solver_stats),'moments':self.moments.get_state()}
+
+    def set_state(self, state):
+        self.last_weights = state['last_weights'] if len(state['last_weights']) > 0 else None
+        self.solver_stats.update({k:scalar(v) for k,v in state['solver_stats'].items()})
+        self.moments.set_state(state['moments'])
+
+    def optimizer_report(self):
+        # iteration counts and solve time of every optimization performed so far
+        stats = self.solver_stats
+        solves = max(stats['solves'],1)
+        print('<<-------| OPTIMIZER REPORT |------->>')
+        print('Solves:',stats['solves'])
+        print('Avg. Iterations:',round(stats['iterations']/solves,2))
+        print('Avg. Objective Evaluations:',round(stats['evaluations']/solves,2))
+        print('Avg. Solve Time (us):',round(1e6*stats['solve_time']/solves,2))
+        print('Total Solve Time (s):',round(stats['solve_time'],4))
+        if stats['cached'] + stats['scheduled'] > 0:
+            print('Cached:',stats['cached'],' Scheduled:',stats['scheduled'])
     
     def sharpe_report(self,allocations,log_ret): 
 
@@ -177,9 +320,49 @@ class PortfolioSharpeMaximization(Strategy):
         # The function takes in the log returns of allocated asset values
         # and return the sharpe report for it
 
+        return self.sharpe_report_moments(allocations,log_ret.mean().values,log_ret.cov().values)
+
+    def sharpe_report_moments(self,allocations,mean,cov):
+        # same report from precomputed mean vector and covariance matrix of log returns
         weights = np.array(allocations)
-        returns = np.sum(log_ret.mean() * weights)
-        volatility = np.sqrt(np.dot(weights.T,np.dot(log_ret.cov(),weights)))
+        returns = np.sum(mean * weights)
+        volatility = np.sqrt(np.dot(weights.T,np.dot(cov,weights)))
         sharpe_ratio = returns/volatility
         return pd.Series(data = [returns,volatility,sharpe_ratio],index = ['returns','volatility','sharpe'])
     #--------------------------------------------------------------------------------------#
+
+
+class TargetSharesStrategy(Strategy):
+
+    # Trades the portfolio to a precomputed target share matrix (one row per portfolio ledger row,
+    # one column per symbol), selling before buying with MARKET orders on every bar.
+    # Mostly used to replay a vectorized backtest through the event loop (see vectorized.py)
+
+    def __init__(self,bars,events,portfolio,target_shares,batched=True):
+        self.bars = bars
+        self.symbols = self.bars.symbols
+        self.events = events
+        self.portfolio = portfolio
+        self.target_shares = np.asarray(target_shares,dtype=np.float64)
+        self.batched = batched # one RebalanceEvent per bar instead of one SignalEvent per trade
+        self.bars.set_lookback(1) # only the latest bar is read
+
+    def calculate_signals(self, event):
+        if event.type is EventType.MARKET:
+            bar = self.bars.event_bar(event)
+            row = self.portfolio.get_row(bar)
+            trades = self.target_shares[bar-self.portfolio.ledger.origin] - self.portfolio.ledger.position[row]
+            if self.batched:
+                sells = np.flatnonzero(np.sign(trades) == -1)
+                buys = np.flatnonzero(np.sign(trades) == 1)
+                if len(sells) + len(buys) > 0:
+                    columns = np.concatenate([sells,buys])
+                    self.events.put(RebalanceEvent([self.symbols[j] for j in columns],stamp = event.stamp,
+                                                   order_type = 'MARKET',bar = bar,
+                                                   actions = np.array(['SELL']*len(sells)+['BUY']*len(buys),dtype=object),
+                                                   shares = np.abs(trades[columns])))
+                return
+            for action,side in (('SELL',-1),('BUY',1)):
+                for j in np.flatnonzero(np.sign(trades) == side):
+                    self.events.put(SignalEvent(self.symbols[j],shares = abs(trades[j]),action = action,
+                                                order_type = 'MARKET',stamp = event.stamp,bar = bar))
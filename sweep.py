@@ -0,0 +1,81 @@
+import os
+import json
+import argparse
+import itertools
+import traceback
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from backtest import run_backtest
+
+
+# ------------------------------------------------------------------------------------------------------
+# PARAMETER SWEEP
+# fans backtest configurations out over a process pool and collects one compact summary per run
+# ------------------------------------------------------------------------------------------------------
+
+def build_configs(base=None, grid=None):
+    # cartesian product of the grid values on top of a base config, e.g.
+    # grid = {'mode':['full','tail'], 'tail_count':[60,120], 'allocations_pct':[0.5,1]}
+    base = dict(base or {})
+    grid = grid or {}
+    keys = list(grid)
+    configs = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        config = dict(base)
+        config.update(zip(keys,values))
+        configs.append(config)
+    # 'full' mode ignores tail_count, so drop the duplicates it would create
+    unique = []
+    seen = set()
+    for config in configs:
+        if config.get('mode','full') == 'full' and 'tail_count' in config:
+            config['tail_count'] = None
+        key = json.dumps(config,sort_keys=True,default=str)
+        if key not in seen:
+            seen.add(key)
+            unique.append(config)
+    return unique
+
+def run_config(run_id, config):
+    # executed in the worker processes, returns only the compact summary
+    config = dict(config,quiet=True,update=False)
+    try:
+        summary = run_backtest(config)['summary']
+        summary['error'] = None
+    except Exception:
+        summary = {'symbols':','.join(config.get('symbols',[])),'error':traceback.format_exc(limit=3)}
+    summary['run_id'] = run_id
+    return summary
+
+def run_sweep(configs, workers=None):
+    # workers = None -> one per cpu, workers = 1 -> run serially in this process
+    summaries = []
+    if workers == 1:
+        for run_id,config in enumerate(configs):
+            summaries.append(run_config(run_id,config))
+            print('---| RUN',run_id+1,'OF',len(configs),'DONE |---')
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_config,run_id,config) for run_id,config in enumerate(configs)]
+            for done,future in enumerate(as_completed(futures)):
+                summaries.append(future.result())
+                print('---| RUN',done+1,'OF',len(configs),'DONE |---')
+    return pd.DataFrame(summaries).set_index('run_id').sort_index()
+
+
+if __name__ == '__main__':
+    # python sweep.py sweep.json --workers 4 --output sweep_results.csv
+    # sweep.json -> {"base": {"interval": "1D", "symbols": [...]}, "grid": {"mode": ["full","tail"], ...}}
+    parser = argparse.ArgumentParser(description='Run a parameter sweep of backtests over a process pool')
+    parser.add_argument('sweep_file')
+    parser.add_argument('--workers',type=int,default=None)
+    parser.add_argument('--output',default='sweep_results.csv')
+    args = parser.parse_args()
+    with open(args.sweep_file) as f:
+        sweep = json.load(f)
+    configs = build_configs(sweep.get('base'),sweep.get('grid'))
+    print('---| RUNNING',len(configs),'BACKTESTS |---')
+    results = run_sweep(configs,workers=args.workers)
+    results.to_csv(args.output)
+    print(results)
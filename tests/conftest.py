@@ -0,0 +1,47 @@
+import os, os.path
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def random_closes(n_symbols, n_bars, seed=0):
+    # symbols x bars random walk closes
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0.0005,0.02,size=(n_symbols,n_bars))
+    return 100*np.exp(np.cumsum(returns,axis=1))
+
+def write_database(csv_path, symbols, n_bars=400, interval='1D', seed=0, gaps=None):
+    # csvs laid out like the bundled database (interval folder, alpha vantage style headers)
+    # gaps -> {symbol: [(start, stop)]} rows left out of that symbol's csv
+    folder = os.path.join(csv_path,interval.lower())
+    os.makedirs(folder,exist_ok=True)
+    if interval[-1] == 'D':
+        stamps = pd.bdate_range('2015-01-01',periods=n_bars).strftime('%Y-%m-%d 00:00:00')
+    else:
+        days = pd.bdate_range('2019-01-02',periods=-(-n_bars//390))
+        minutes = pd.timedelta_range('9:30:00',periods=390,freq='1min')
+        stamps = (days.values[:,None] + minutes.values[None,:]).ravel()[:n_bars]
+        stamps = pd.DatetimeIndex(stamps).strftime('%Y-%m-%d %H:%M:%S')
+    closes = random_closes(len(symbols),n_bars,seed)
+    rng = np.random.default_rng(seed+1)
+    for k,s in enumerate(symbols):
+        close = closes[k]
+        spread = close*rng.uniform(0.001,0.01,size=n_bars)
+        frame = pd.DataFrame({'1. open':close*(1+rng.normal(0,0.002,size=n_bars)),
+                              '2. high':close+spread,'3. low':close-spread,'4. close':close,
+                              '5. volume':rng.integers(1000,100000,size=n_bars).astype(float)},
+                             index=pd.Index(stamps,name='date'))
+        keep = np.ones(n_bars,dtype=bool)
+        for start,stop in (gaps or {}).get(s,[]):
+            keep[start:stop] = False
+        frame[keep].to_csv(os.path.join(folder,s+'.csv'))
+    return csv_path
+
+
+@pytest.fixture
+def database(tmp_path):
+    # 5 daily symbols, 400 bars each
+    return write_database(str(tmp_path/'db'),['AAA','BBB','CCC','DDD','EEE'])
@@ -0,0 +1,107 @@
+import builtins
+import contextlib
+import io
+import queue
+import pandas as pd
+import pytest
+
+from backtest import (DEFAULT_CONFIG, run_backtest, run_multi_backtest, run_event_loop, build_feed, build_stack,
+                      stack_lookback, quiet_config)
+from event import EventQueue, EventType, SignalEvent
+from strategy import Strategy
+
+SYMBOLS = ['AAA','BBB','CCC','DDD','EEE']
+
+
+def no_prompt(*args):
+    raise AssertionError('run_backtest prompted for input')
+
+
+def test_quiet_run_never_prompts(database, monkeypatch):
+    monkeypatch.setattr(builtins,'input',no_prompt)
+    results = run_backtest({'symbols':SYMBOLS,'csv_path':database,'quiet':True,
+                            'mode':'tail','tail_count':60})
+    assert results['summary']['bars'] == 301
+
+
+def run_loop(config, Events):
+    DataFrame = build_feed(config,Events,stack_lookback(config))
+    Portfolio, Strategy, Broker = build_stack(config,DataFrame,Events)
+    event_counts = run_event_loop(DataFrame,Events,Portfolio,Strategy,Broker)
+    return event_counts, Portfolio.portfolio_value
+
+
+def test_event_loop_runs_on_a_thread_queue(database):
+    config = quiet_config(dict(DEFAULT_CONFIG,symbols=SYMBOLS,csv_path=database,quiet=True,
+                               mode='tail',tail_count=60))
+    counts, value = run_loop(config,EventQueue())
+    queue_counts, queue_value = run_loop(config,queue.Queue())
+    assert queue_counts == counts
+    assert queue_value.equals(value)
+
+
+class BuyEveryTenBars(Strategy):
+
+    # one share of every symbol every 10 bars, with or without the bar number on its signals
+
+    def __init__(self, bars, events, with_bar):
+        self.bars = bars
+        self.events = events
+        self.with_bar = with_bar
+
+    def calculate_signals(self, event):
+        bar = event.bar if self.with_bar else None
+        if event.type is EventType.MARKET and event.bar % 10 == 0:
+            for s in self.bars.symbols:
+                self.events.put(SignalEvent(s,event.stamp,'MARKET','BUY',1,bar=bar))
+
+
+@pytest.mark.parametrize('broker',['basic','simulated'])
+def test_signals_without_a_bar_number(database, broker):
+    config = quiet_config(dict(DEFAULT_CONFIG,symbols=SYMBOLS,csv_path=database,quiet=True,broker=broker))
+    values = []
+    for with_bar in (True,False):
+        Events = EventQueue()
+        DataFrame = build_feed(config,Events)
+        Portfolio, Strategy, Broker = build_stack(config,DataFrame,Events)
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_event_loop(DataFrame,Events,Portfolio,BuyEveryTenBars(DataFrame,Events,with_bar),Broker)
+        assert Portfolio.fill_count == 30*len(SYMBOLS)
+        values.append(Portfolio.portfolio_value)
+    pd.testing.assert_frame_equal(values[0],values[1])
+
+
+def test_cache_hits_are_not_counted_as_solves(database, tmp_path):
+    config = quiet_config(dict(DEFAULT_CONFIG,symbols=SYMBOLS,csv_path=database,quiet=True,mode='tail',
+                               tail_count=60,optimizer_cache=str(tmp_path/'cache')))
+    stats = []
+    for run in range(2):
+        Events = EventQueue()
+        DataFrame = build_feed(config,Events,stack_lookback(config))
+        Portfolio, Strategy, Broker = build_stack(config,DataFrame,Events)
+        run_event_loop(DataFrame,Events,Portfolio,Strategy,Broker)
+        Strategy.optimizer_cache.evict()
+        stats.append(Strategy.solver_stats)
+    assert stats[0]['solves'] == 300 and stats[0]['cached'] == 0
+    assert stats[1]['solves'] == 0 and stats[1]['cached'] == 300
+    assert stats[1]['iterations'] == 0 and stats[1]['solve_time'] == 0.0
+
+
+def test_multi_backtest_times_every_stack_and_matches_single_runs(database):
+    config = {'symbols':SYMBOLS,'csv_path':database,'quiet':True}
+    stacks = {'tail':{'mode':'tail','tail_count':60},'half':{'mode':'tail','tail_count':60,'allocations_pct':0.5}}
+    results = run_multi_backtest(stacks,config)
+    for name,overrides in stacks.items():
+        summary = results[name]['summary']
+        assert 0 < summary['run_time'] < summary['total_time']
+        single = run_backtest(dict(config,**overrides))
+        pd.testing.assert_frame_equal(single['portfolio_value'],results[name]['portfolio_value'])
+    assert results['tail']['summary']['total_time'] == results['half']['summary']['total_time']
+    assert results['tail']['summary']['run_time'] + results['half']['summary']['run_time'] < \
+        results['tail']['summary']['total_time']
+
+
+@pytest.mark.parametrize('key,value',[('instrument',True),('checkpoint_dir','checkpoints')])
+def test_multi_backtest_rejects_single_run_keys(database, key, value):
+    with pytest.raises(ValueError,match=key):
+        run_multi_backtest({'a':{},'b':{key:value}},{'symbols':SYMBOLS,'csv_path':database,'quiet':True})
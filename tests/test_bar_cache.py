@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from bar_cache import (load_bars, stamps_to_index, cache_path, is_fresh, read_header, HEADER,
+                       VERSION)
+from conftest import write_database
+
+
+def test_stamps_to_index_matches_strftime():
+    stamps = pd.date_range('2019-01-02 09:30',periods=500,freq='37min')
+    expected = stamps.strftime('%Y-%m-%d %H:%M:%S')
+    assert list(stamps_to_index(stamps.values.astype(np.int64))) == list(expected)
+    assert list(stamps_to_index(stamps.values.astype(np.int64),daily=True)) == list(stamps.strftime('%Y-%m-%d'))
+
+def test_stamps_to_index_keeps_missing_stamps():
+    stamps = np.array(['2019-01-02T09:30:00','NaT','2019-01-02T09:31:00'],dtype='datetime64[ns]')
+    index = stamps_to_index(stamps.astype(np.int64))
+    assert list(index) == ['2019-01-02 09:30:00','NaT','2019-01-02 09:31:00']
+    assert list(stamps_to_index(np.array([],dtype=np.int64))) == []
+
+def test_load_bars_matches_the_csv(tmp_path):
+    database = write_database(str(tmp_path/'db'),['AAA'],n_bars=50,interval='1Min')
+    csv_file = str(tmp_path/'db'/'1min'/'AAA.csv')
+    stamps, columns = load_bars(csv_file)
+    frame = pd.read_csv(csv_file,index_col=0)
+    assert list(stamps_to_index(stamps)) == list(frame.index)
+    np.testing.assert_array_equal(columns.T,frame.to_numpy())
+
+def test_rewritten_csv_rebuilds_the_cache(tmp_path):
+    write_database(str(tmp_path/'db'),['AAA'],n_bars=50,interval='1Min')
+    csv_file = str(tmp_path/'db'/'1min'/'AAA.csv')
+    load_bars(csv_file)
+    cache_file = cache_path(csv_file)
+    assert is_fresh(csv_file,cache_file)
+    with open(csv_file) as f:
+        lines = f.readlines()
+    with open(csv_file,'w') as f:
+        f.writelines(lines[:21]) # truncated to 20 bars
+    assert not is_fresh(csv_file,cache_file)
+    stamps, before = load_bars(csv_file)
+    before = np.array(before) # the memory map goes stale once the cache is rebuilt
+    assert len(stamps) == 20 and before.shape == (5,20)
+    assert is_fresh(csv_file,cache_file)
+    # same size, new contents: caught by the mtime
+    stat = os.stat(csv_file)
+    with open(csv_file) as f:
+        header, *rows = f.readlines()
+    stamps, values = zip(*[row.split(',',1) for row in rows])
+    with open(csv_file,'w') as f:
+        f.writelines([header]+[s+','+v for s,v in zip(stamps,values[1:]+values[:1])]) # values moved one bar back
+    os.utime(csv_file,ns=(stat.st_atime_ns,stat.st_mtime_ns+10**9))
+    assert os.path.getsize(csv_file) == stat.st_size and not is_fresh(csv_file,cache_file)
+    stamps, columns = load_bars(csv_file)
+    np.testing.assert_array_equal(columns.T,pd.read_csv(csv_file,index_col=0).to_numpy())
+    np.testing.assert_array_equal(columns[:,:-1],before[:,1:])
+
+@pytest.mark.parametrize('field,value',[('magic',b'NOTBARS!'),('version',VERSION+1)])
+def test_bad_header_is_rejected(tmp_path, field, value):
+    write_database(str(tmp_path/'db'),['AAA'],n_bars=50,interval='1Min')
+    csv_file = str(tmp_path/'db'/'1min'/'AAA.csv')
+    load_bars(csv_file)
+    cache_file = cache_path(csv_file)
+    header = np.fromfile(cache_file,dtype=HEADER,count=1)
+    header[field] = value
+    with open(cache_file,'r+b') as f:
+        f.write(header.tobytes())
+    assert read_header(cache_file) is None and not is_fresh(csv_file,cache_file)
+    stamps, columns = load_bars(csv_file) # rebuilt
+    assert read_header(cache_file) is not None and len(stamps) == 50
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from broker import SimulatedBroker, PerShareCommission, PercentCommission, VolumeShareSlippage
+from data import AlpacaDataFrame
+from event import EventQueue, MarketEvent, OrderEvent, BatchOrderEvent
+
+# open, high, low, close, volume of one symbol, bar by bar
+BARS = [[100,101, 99,100,1000],
+        [100,102, 98,101,1000],
+        [ 97, 99, 95, 96,1000], # gaps down
+        [104,106,103,105,1000], # gaps up
+        [105,110,104,108,1000],
+        [102,103,101,102,1000]]
+
+
+def panel():
+    stamps = pd.bdate_range('2020-01-01',periods=len(BARS)).strftime('%Y-%m-%d')
+    frame = pd.DataFrame(np.array(BARS,dtype=np.float64),index=stamps,columns=['open','high','low','close','volume'])
+    return AlpacaDataFrame(events=EventQueue(),csv_path='',symbols=['AAA'],interval='1D',
+                           symbol_data={'AAA':frame},warm_up=0)
+
+def run(broker, orders, max_bar=len(BARS)-1):
+    # orders placed on bar 0, then every later bar checked; -> [(bar, action, order type, price)]
+    for order_type,action,limit,stop in orders:
+        broker.execute_order(OrderEvent('AAA',broker.bars.timestamps[0],order_type,action,100,
+                                        limit_price=limit,stop_price=stop,bar=0))
+    for bar in range(1,max_bar+1):
+        broker.check_orders(MarketEvent(broker.bars.timestamps[bar],bar))
+    fills = []
+    while not broker.events.empty():
+        event = broker.events.get()
+        fills += [(event.bar,a,event.order_type,p) for a,p in zip(event.actions,event.prices)]
+    return fills
+
+def test_limit_fills_only_when_the_bar_trades_through_it():
+    broker = SimulatedBroker(panel(),EventQueue())
+    fills = run(broker,[('LIMIT','BUY',98.5,None),  # bar 1 low 98
+                        ('LIMIT','BUY',97.9,None),  # missed on bar 1, bar 2 opens below it
+                        ('LIMIT','SELL',103,None),  # bar 3 opens above it
+                        ('LIMIT','BUY',90,None)])   # never reached
+    assert sorted(fills) == [(1,'BUY','LIMIT',98.5),(2,'BUY','LIMIT',97),(3,'SELL','LIMIT',104)]
+    assert broker.n_orders == 1 and broker.limit[0] == 90
+
+def test_orders_are_not_checked_on_the_bar_they_were_placed():
+    broker = SimulatedBroker(panel(),EventQueue())
+    broker.execute_order(OrderEvent('AAA',broker.bars.timestamps[0],'LIMIT','BUY',100,limit_price=100.5,bar=0))
+    broker.check_orders(MarketEvent(broker.bars.timestamps[0],0))
+    assert broker.events.empty() and broker.n_orders == 1
+
+def test_stop_triggers_at_the_stop_or_the_gap_open():
+    broker = SimulatedBroker(panel(),EventQueue())
+    fills = run(broker,[('STOP','BUY',None,105),   # bar 3 high 106, opens at 104
+                        ('STOP','SELL',None,97.5), # bar 2 gaps down to 97
+                        ('STOP','BUY',None,103)])  # bar 3 gaps up through it
+    assert sorted(fills) == [(2,'SELL','STOP',97),(3,'BUY','STOP',104),(3,'BUY','STOP',105)]
+
+def test_stop_limit_needs_the_stop_before_the_limit():
+    broker = SimulatedBroker(panel(),EventQueue())
+    fills = run(broker,[('STOP-LIMIT','BUY',101.8,101.5), # stop and limit on bar 1, from the stop price
+                        ('STOP-LIMIT','BUY',102.5,105)])  # bar 2's low is under the limit before the stop is hit
+    assert sorted(fills) == [(1,'BUY','STOP-LIMIT',101.5),(5,'BUY','STOP-LIMIT',102)]
+
+def test_stop_limit_triggered_keeps_resting():
+    broker = SimulatedBroker(panel(),EventQueue())
+    assert run(broker,[('STOP-LIMIT','BUY',102.5,105)],max_bar=4) == []
+    assert broker.n_orders == 1 and broker.triggered[0]
+    broker.check_orders(MarketEvent(broker.bars.timestamps[5],5))
+    assert broker.n_orders == 0 and broker.stats['fills'] == 1
+
+def test_orders_expire_after_max_age():
+    broker = SimulatedBroker(panel(),EventQueue(),max_age=2)
+    fills = run(broker,[('LIMIT','BUY',98.5,None),('LIMIT','BUY',90,None)],max_bar=1)
+    assert fills == [(1,'BUY','LIMIT',98.5)] and broker.n_orders == 1
+    broker.check_orders(MarketEvent(broker.bars.timestamps[2],2))
+    assert broker.n_orders == 0 and broker.stats['cancelled'] == 1 and broker.events.empty()
+
+def test_cancel_all_drops_the_resting_orders():
+    broker = SimulatedBroker(panel(),EventQueue())
+    for limit in (98.5,97.9):
+        broker.execute_order(OrderEvent('AAA',broker.bars.timestamps[0],'LIMIT','BUY',100,limit_price=limit,bar=0))
+    broker.cancel_all()
+    assert run(broker,[]) == []
+    assert broker.stats['cancelled'] == 2 and broker.stats['fills'] == 0
+
+def test_per_share_commission():
+    shares = np.array([100,10000,10,-300])
+    prices = np.array([50.0,50.0,5.0,20.0])
+    # minimum 1.0, rate x shares, capped at 1% of 10 x 5, rate x |shares|
+    np.testing.assert_allclose(PerShareCommission().commission(shares,prices),[1.0,50.0,0.5,1.5])
+    np.testing.assert_allclose(PerShareCommission(rate=0.01,minimum=2.0,max_pct=0.5).commission(shares,prices),
+                               [2.0,100.0,2.0,3.0])
+
+def test_percent_commission():
+    np.testing.assert_allclose(PercentCommission(rate=0.002).commission(np.array([100,-50]),np.array([10.0,20.0])),
+                               [2.0,2.0])
+
+def test_volume_share_slippage_is_capped():
+    prices = np.full(4,100.0)
+    sides = np.array([1,-1,1,1])
+    shares = np.array([100.0,500.0,5000.0,10.0])
+    volumes = np.array([1000.0,1000.0,1000.0,0.0])
+    # 10% and 50% of the volume, more than the whole bar (capped at 100%), no volume (no impact)
+    np.testing.assert_allclose(VolumeShareSlippage(impact=0.1).fill_prices(prices,sides,shares,volumes),
+                               [100.1,97.5,110.0,100.0])
+
+def test_fills_go_through_slippage_and_commission():
+    broker = SimulatedBroker(panel(),EventQueue(),commission=PercentCommission(rate=0.001),
+                             slippage=VolumeShareSlippage(impact=0.1))
+    broker.execute_order(BatchOrderEvent(['AAA','AAA'],broker.bars.timestamps[0],'LIMIT',np.array(['BUY','SELL']),
+                                         np.array([100.0,500.0]),limit_prices=np.array([98.5,103.0]),bar=0))
+    for bar in range(1,4):
+        broker.check_orders(MarketEvent(broker.bars.timestamps[bar],bar))
+    buy, sell = broker.events.get(), broker.events.get()
+    np.testing.assert_allclose(buy.prices,[98.5*1.001])
+    np.testing.assert_allclose(buy.commission,[0.001*100*98.5*1.001])
+    np.testing.assert_allclose(sell.prices,[104*0.975])
+    np.testing.assert_allclose(sell.commission,[0.001*500*104*0.975])
+    assert broker.stats['commission'] == pytest.approx(buy.commission[0]+sell.commission[0])
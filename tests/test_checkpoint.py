@@ -0,0 +1,85 @@
+import os, os.path
+import numpy as np
+import pandas as pd
+import pytest
+
+from backtest import run_backtest
+from broker import PerShareCommission, FixedSlippage
+from checkpoint import LATEST, latest_checkpoint, flatten, unflatten, write_npz, pack_events, unpack_events
+from event import (MarketEvent, SignalEvent, OrderEvent, FillEvent, RebalanceEvent, BatchOrderEvent,
+                   BatchFillEvent)
+
+SYMBOLS = ['AAA','BBB','CCC','DDD','EEE']
+
+
+def base_config(database, folder, **kwargs):
+    return dict({'symbols':SYMBOLS,'csv_path':database,'quiet':True,'mode':'tail','tail_count':60,
+                 'checkpoint_dir':folder,'checkpoint_every':40},**kwargs)
+
+def rewind(folder):
+    # as if the run had stopped after the checkpoint before its latest one
+    number = latest_checkpoint(folder)
+    with open(os.path.join(folder,LATEST),'w') as f:
+        f.write(str(number-1))
+
+
+@pytest.mark.parametrize('overrides',[{},{'feed':'stream','chunk_size':32},
+                                      {'broker':'simulated','commission':PerShareCommission(0.01),
+                                       'slippage':FixedSlippage(0.001)}])
+def test_resumed_run_matches_uninterrupted_run(database, tmp_path, overrides):
+    config = base_config(database,str(tmp_path/'checkpoints'),**overrides)
+    uninterrupted = run_backtest(config)
+    rewind(config['checkpoint_dir'])
+    resumed = run_backtest(dict(config,resume=True))
+    pd.testing.assert_frame_equal(uninterrupted['portfolio_value'],resumed['portfolio_value'])
+    assert uninterrupted['summary']['fills'] == resumed['summary']['fills']
+
+
+def test_resume_refuses_another_config(database, tmp_path):
+    config = base_config(database,str(tmp_path/'checkpoints'))
+    run_backtest(config)
+    with pytest.raises(ValueError,match='another config'):
+        run_backtest(dict(config,allocations_pct=0.5,resume=True))
+    with pytest.raises(ValueError,match='another config'):
+        run_backtest(dict(config,broker='simulated',commission=PerShareCommission(0.02),resume=True))
+
+
+def test_fresh_run_clears_the_folder(database, tmp_path):
+    folder = str(tmp_path/'checkpoints')
+    run_backtest(base_config(database,folder))
+    assert latest_checkpoint(folder) is not None
+    # no checkpoint is taken in 300 bars: nothing of the first run may be left to resume
+    config = base_config(database,folder,allocations_pct=0.5,checkpoint_every=1000)
+    fresh = run_backtest(config)
+    assert os.listdir(folder) == []
+    resumed = run_backtest(dict(config,resume=True))
+    pd.testing.assert_frame_equal(fresh['portfolio_value'],resumed['portfolio_value'])
+
+
+def test_events_round_trip_without_pickle(tmp_path):
+    events = [MarketEvent('2019-01-02',3),
+              SignalEvent('BBB','2019-01-02','LIMIT','BUY',10,limit_price=99.5,bar=3),
+              OrderEvent('CCC','2019-01-02','STOP-LIMIT','SELL',7.0,limit_price=98.0,stop_price=97.5),
+              FillEvent('2019-01-02','AAA','BROKER',5,'BUY','MARKET',commission=0.05,bar=3,price=101.25),
+              RebalanceEvent(['AAA','EEE'],'2019-01-02','MARKET',np.array(['SELL','BUY'],dtype=object),
+                             np.array([3.0,4.0]),bar=3),
+              BatchOrderEvent(['DDD'],'2019-01-02','STOP',np.array(['BUY'],dtype=object),np.array([2.0]),
+                              stop_prices=np.array([120.0]),bar=3),
+              BatchFillEvent('2019-01-02',['AAA','BBB'],'BROKER',np.array([1.0,2.0]),
+                             np.array(['BUY','SELL'],dtype=object),'MARKET',bar=3,prices=np.array([1.5,2.5]))]
+    npz_file = str(tmp_path/'events.npz')
+    write_npz(npz_file,flatten({'events':pack_events(events,SYMBOLS)}))
+    with np.load(npz_file,allow_pickle=False) as f:
+        restored = unpack_events(unflatten(dict(f))['events'],SYMBOLS)
+    assert [type(e) for e in restored] == [type(e) for e in events]
+    for event,copy in zip(events,restored):
+        for name in type(event).__slots__ or type(event).__mro__[1].__slots__:
+            a, b = getattr(event,name), getattr(copy,name)
+            if a is None or isinstance(a,(str,int,float)):
+                assert a == b and type(a) == type(b), name
+            else:
+                np.testing.assert_array_equal(np.asarray(a),np.asarray(b))
+    with pytest.raises(ValueError,match='action'):
+        pack_events([SignalEvent('AAA','2019-01-02','MARKET','HOLD',1)],SYMBOLS)
+    with pytest.raises(ValueError,match='symbol'):
+        pack_events([SignalEvent('ZZZ','2019-01-02','MARKET','BUY',1)],SYMBOLS)
@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+import pytest
+import talib
+
+from data import AlpacaDataFrame, StreamingAlpacaDataFrame, RingBuffer
+from event import EventQueue
+from feature_cache import FeatureCache
+
+SYMBOLS = ['AAA','BBB','CCC','DDD','EEE']
+INDICATORS = {'periods':[5,14],'sma':True,'ema':True,'rsi':True,'natr':True,'log_ret':True}
+COLUMNS = ['sma5','ema14','rsi14','natr5','log_ret']
+
+
+def feed(database, stream=False, **kwargs):
+    if stream:
+        return StreamingAlpacaDataFrame(events=EventQueue(),csv_path=database,symbols=list(SYMBOLS),
+                                        interval='1D',update=False,chunk_size=32,**kwargs)
+    return AlpacaDataFrame(events=EventQueue(),csv_path=database,symbols=list(SYMBOLS),interval='1D',
+                           update=False,**kwargs)
+
+def latest_columns(DataFrame):
+    # latest value of every indicator column, bar by bar to the end of the run
+    rows = []
+    while True:
+        DataFrame.update_bars()
+        if not DataFrame.continue_backtest:
+            return np.array(rows)
+        rows.append([DataFrame.get_latest_values(c) for c in COLUMNS])
+
+
+def test_stream_batch_add_data_gives_the_online_columns(database):
+    memory = feed(database)
+    memory.add_data(SYMBOLS,online=True,**INDICATORS)
+    stream = feed(database,stream=True)
+    stream.add_data(SYMBOLS,online=False,**INDICATORS)
+    np.testing.assert_array_equal(latest_columns(memory),latest_columns(stream))
+
+def test_stream_add_data_rejects_hpfilter(database):
+    with pytest.raises(ValueError):
+        feed(database,stream=True).add_data(SYMBOLS,online=False,hpfilter=True)
+
+
+def test_batch_add_data_keeps_the_online_columns(database):
+    DataFrame = feed(database)
+    DataFrame.add_data(SYMBOLS,online=True,periods=[5],sma=True,rsi=True)
+    for _ in range(50):
+        DataFrame.update_bars()
+    stamp = DataFrame.timestamps[DataFrame.cursor-1]
+    DataFrame.add_data(SYMBOLS,periods=[20],sma=True) # rebuilds the store, the leading rows are trimmed
+    assert DataFrame.timestamps[DataFrame.cursor-1] == stamp
+    while DataFrame.continue_backtest:
+        DataFrame.update_bars()
+    untrimmed = feed(database,warm_up=0)
+    closes = untrimmed.bar_data[:,:,untrimmed.fields.index('close')]
+    bars = untrimmed.bar_lookup.get_indexer(DataFrame.stamps)
+    for i in range(len(SYMBOLS)):
+        expected = {'sma5':talib.SMA(closes[i],5),'rsi5':talib.RSI(closes[i],5),'sma20':talib.SMA(closes[i],20)}
+        for name,values in expected.items():
+            np.testing.assert_allclose(DataFrame.bar_data[i,:,DataFrame.fields.index(name)],values[bars],rtol=1e-9)
+
+
+def test_online_indicators_match_the_batch_columns(database):
+    batch = feed(database,warm_up=0)
+    batch.add_data(SYMBOLS,**INDICATORS)
+    online = feed(database,warm_up=0)
+    online.add_data(SYMBOLS,online=True,**INDICATORS)
+    while online.continue_backtest:
+        online.update_bars()
+    bars = online.bar_lookup.get_indexer(batch.stamps)
+    for name in COLUMNS:
+        np.testing.assert_allclose(online.bar_data[:,bars,online.fields.index(name)],
+                                   batch.bar_data[:,:,batch.fields.index(name)],rtol=1e-9)
+
+
+def test_ring_buffer_holds_the_latest_bars():
+    rng = np.random.default_rng(0)
+    ring = RingBuffer(2,8,3)
+    written = np.zeros((2,0,3))
+    assert ring.view(0,0).shape == (2,0,3)
+    for step in range(60):
+        if step % 7 == 6:
+            ring.resize(int(rng.integers(1,16))) # shrinks and grows
+        n = int(rng.integers(0,2*ring.capacity+1)) # n > capacity writes too
+        bars = rng.normal(size=(2,n,3))
+        ring.write(bars)
+        written = np.concatenate([written,bars],axis=1)
+        assert ring.count == written.shape[1]
+        assert ring.first <= ring.count and ring.count - ring.first <= ring.capacity
+        np.testing.assert_array_equal(ring.view(ring.first,ring.count),written[:,ring.first:ring.count])
+        assert ring.view(ring.count,ring.count).shape == (2,0,3)
+        if ring.first > 0:
+            with pytest.raises(IndexError):
+                ring.view(ring.first-1,ring.count)
+
+def test_ring_buffer_grown_holds_only_the_kept_bars():
+    ring = RingBuffer(1,1,1)
+    ring.write(np.arange(699,dtype=np.float64).reshape(1,-1,1))
+    ring.resize(6)
+    assert (ring.first,ring.count) == (698,699)
+    assert ring.view(698,699)[0,0,0] == 698
+    with pytest.raises(IndexError):
+        ring.view(694,695)
+    with pytest.raises(IndexError):
+        ring.set(697,[0],[0],[[0.0]])
+    ring.write(np.array([[[699.0],[700.0]]]))
+    np.testing.assert_array_equal(ring.view(698,701)[0,:,0],[698,699,700])
+    ring.resize(2) # shrinking keeps the latest bars
+    assert (ring.first,ring.count) == (699,701)
+    np.testing.assert_array_equal(ring.view(699,701)[0,:,0],[699,700])
+
+
+ALL_FLAGS = {'sma':True,'ema':True,'wma':True,'ewma':True,'rsi':True,'natr':True,'arith_ret':True,
+             'hpfilter':True,'log_ret':True,'d1close':True,'d2close':True}
+
+@pytest.mark.parametrize('cached',[False,True])
+def test_parallel_add_data_matches_serial(database, tmp_path, cached):
+    def store(workers, cache_dir):
+        cache = FeatureCache(str(tmp_path/cache_dir)) if cached else None
+        DataFrame = feed(database,feature_cache=cache)
+        DataFrame.add_data(SYMBOLS,periods=[5,14],workers=workers,**ALL_FLAGS)
+        return DataFrame
+    serial = store(None,'serial')
+    # cold cache, warm cache, then the cache the serial path filled
+    for cache_dir,warm in (('parallel',False),('parallel',True),('serial',True)):
+        parallel = store(2,cache_dir)
+        assert parallel.fields == serial.fields
+        np.testing.assert_array_equal(parallel.stamps,serial.stamps)
+        np.testing.assert_array_equal(parallel.bar_data,serial.bar_data)
+        if cached:
+            stats = parallel.feature_cache.stats
+            assert stats['hits' if warm else 'misses'] > 0 and stats['misses' if warm else 'hits'] == 0
+
+
+def per_day_reindex(symbol_data, interval, session_open='9:30', session_close='15:59', drop_first_day=True):
+    # fill_intraday as it was first written: one reindex per trading day onto a session template
+    days = [group for _,group in symbol_data.groupby(pd.to_datetime(symbol_data.index).date)]
+    template = pd.DataFrame(index=pd.to_datetime(['2019-01-18 '+session_open+':00','2019-01-18 '+session_close+':00']))
+    template = [str(dt).split(' ')[1] for dt in template.asfreq(interval).index]
+    filled = [day.reindex(pd.Index([day.index[0].split(' ')[0]+' '+t for t in template]))
+              for day in days[1 if drop_first_day else 0:]]
+    return pd.concat(filled)
+
+def raw_minutes(start, n_days, missing=0.3, seed=0):
+    # utc minute bars from 13:00 to 21:30 on n_days business days (pre- and post-market included),
+    # a `missing` share of them left out
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range(start,periods=n_days)
+    stamps = (days.values[:,None] + pd.timedelta_range('13:00:00','21:30:00',freq='1min').values[None,:]).ravel()
+    stamps = pd.DatetimeIndex(stamps)[rng.random(len(stamps)) >= missing]
+    values = rng.normal(size=(len(stamps),2))
+    return pd.DataFrame(values,index=pd.Index(stamps.strftime('%Y-%m-%d %H:%M:%S')),columns=['close','volume'])
+
+def intraday(interval='1Min'):
+    DataFrame = AlpacaDataFrame.__new__(AlpacaDataFrame)
+    DataFrame.interval = interval
+    return DataFrame
+
+@pytest.mark.parametrize('interval,session,drop_first_day',[
+    ('1Min',('9:30','15:59'),True),
+    ('1Min',('9:30','15:59'),False),
+    ('5Min',('10:00','14:55'),True),
+    ('15Min',('9:30','15:45'),False)])
+def test_fill_intraday_matches_the_per_day_reindex(interval, session, drop_first_day):
+    DataFrame = intraday(interval)
+    raw = DataFrame.utc_to_est(raw_minutes('2019-01-02',6))
+    filled = DataFrame.fill_intraday(raw,session_open=session[0],session_close=session[1],
+                                     drop_first_day=drop_first_day)
+    expected = per_day_reindex(raw,interval,session[0],session[1],drop_first_day)
+    assert list(filled.index) == list(expected.index)
+    np.testing.assert_array_equal(filled.to_numpy(),expected.to_numpy())
+
+def test_utc_to_est_is_a_fixed_offset_unless_asked_for_dst():
+    DataFrame = intraday()
+    raw = raw_minutes('2019-03-07',4,missing=0) # daylight saving starts on Sunday 2019-03-10
+    utc = pd.to_datetime(raw.index).tz_localize('UTC')
+    est = DataFrame.utc_to_est(raw)
+    assert list(est.index) == [str(dt).split('-05:00')[0] for dt in utc.tz_convert('EST')]
+    new_york = DataFrame.utc_to_est(raw,tz='America/New_York')
+    assert list(new_york.index) == [dt.strftime('%Y-%m-%d %H:%M:%S') for dt in utc.tz_convert('America/New_York')]
+    np.testing.assert_array_equal(new_york.to_numpy(),raw.to_numpy())
+    # 13:30 UTC is the open once New York is on daylight time, an hour before it on EST
+    assert '2019-03-11 09:30:00' in new_york.index and '2019-03-11 08:30:00' in est.index
+    assert '2019-03-08 09:30:00' in new_york.index and '2019-03-08 09:30:00' in est.index
+    sessions = DataFrame.fill_intraday(new_york,drop_first_day=False)
+    assert len(sessions) == 4*390
+    assert sessions.loc['2019-03-11 09:30:00','close'] == raw.loc['2019-03-11 13:30:00','close']
@@ -0,0 +1,83 @@
+import os, os.path
+import time
+import urllib.error
+import numpy as np
+import pandas as pd
+
+from downloader import BarDownloader, StubBarServer
+
+START = int(pd.Timestamp('2019-01-02 14:30',tz='UTC').timestamp()) # 9:30 exchange time
+
+
+def minute_bars(n, seed=0):
+    rng = np.random.default_rng(seed)
+    close = np.round(100*np.exp(np.cumsum(rng.normal(0,0.001,size=n))),4)
+    return [{'t':START+60*k,'o':close[k],'h':close[k]+0.1,'l':close[k]-0.1,'c':close[k],'v':1000.0+k}
+            for k in range(n)]
+
+def downloader(server, **kwargs):
+    return BarDownloader(base_url=server.url,backoff=0.01,**kwargs)
+
+def read_csv(csv_path, symbol):
+    return pd.read_csv(os.path.join(csv_path,symbol+'.csv'),index_col=0)
+
+
+def test_backward_paging_writes_every_bar_once(tmp_path):
+    bars = minute_bars(35)
+    with StubBarServer({'minute':{'AAA':bars}}) as server:
+        d = downloader(server,limit=10)
+        assert d.update(str(tmp_path),['AAA'],'minute') == {'AAA':35}
+    assert server.requests == 4 # 10 + 10 + 10 + 5 bars, walked backwards
+    frame = read_csv(str(tmp_path),'AAA')
+    assert list(frame.index) == list(pd.date_range('2019-01-02 09:30',periods=35,freq='1min').strftime('%Y-%m-%d %H:%M:%S'))
+    np.testing.assert_array_equal(frame['close'].to_numpy(),[b['c'] for b in bars])
+
+
+def test_updates_only_append_the_new_bars(tmp_path):
+    bars = minute_bars(35)
+    with StubBarServer({'minute':{'AAA':bars[:20]}}) as server:
+        d = downloader(server,limit=10)
+        assert d.update(str(tmp_path),['AAA'],'minute') == {'AAA':20}
+        server.payloads['minute']['AAA'] = bars
+        assert d.update(str(tmp_path),['AAA'],'minute') == {'AAA':15}
+        assert d.update(str(tmp_path),['AAA'],'minute') == {'AAA':0}
+    frame = read_csv(str(tmp_path),'AAA')
+    assert frame.index.is_unique and frame.index.is_monotonic_increasing
+    assert len(frame) == 35 and d.stats['rows_written'] == 35
+
+
+def test_rate_limited_and_failed_requests_are_retried(tmp_path):
+    with StubBarServer({'minute':{'AAA':minute_bars(5)}},errors=[429,500,503]) as server:
+        d = downloader(server)
+        assert d.update(str(tmp_path),['AAA'],'minute') == {'AAA':5}
+    assert d.stats['retries'] == 3 and server.requests == 4
+
+
+def test_retries_back_off_exponentially(tmp_path):
+    with StubBarServer({'minute':{'AAA':minute_bars(5)}},errors=[429,429,429]) as server:
+        d = BarDownloader(base_url=server.url,backoff=0.05)
+        start = time.perf_counter()
+        d.update(str(tmp_path),['AAA'],'minute')
+        assert time.perf_counter() - start >= 0.05*(1+2+4)
+
+
+def test_client_errors_and_exhausted_retries_fail_the_symbol(tmp_path):
+    with StubBarServer({'minute':{'AAA':minute_bars(5)}},errors=[404]) as server:
+        result = downloader(server).update(str(tmp_path),['AAA'],'minute')
+        assert isinstance(result['AAA'],urllib.error.HTTPError) and server.requests == 1
+    with StubBarServer({'minute':{'AAA':minute_bars(5)}},errors=[500]*3) as server:
+        result = downloader(server,retries=2).update(str(tmp_path),['AAA'],'minute')
+        assert isinstance(result['AAA'],urllib.error.HTTPError) and server.requests == 3
+    assert not os.path.exists(os.path.join(str(tmp_path),'AAA.csv'))
+
+
+def test_token_bucket_paces_the_requests(tmp_path):
+    symbols = ['AAA','BBB','CCC','DDD']
+    with StubBarServer({'minute':{s:minute_bars(35,k) for k,s in enumerate(symbols)}}) as server:
+        d = downloader(server,limit=10,rate=20,burst=1)
+        start = time.perf_counter()
+        result = d.update(str(tmp_path),symbols,'minute')
+        elapsed = time.perf_counter() - start
+    assert result == dict.fromkeys(symbols,35)
+    assert server.requests == 16
+    assert elapsed >= 15/20 # one request every 1/rate seconds after the first
@@ -0,0 +1,61 @@
+import os
+import numpy as np
+
+from feature_cache import FeatureCache
+
+
+def computed(values, calls):
+    def compute():
+        calls.append(1)
+        return values
+    return compute
+
+
+def test_hits_and_misses(tmp_path):
+    cache = FeatureCache(str(tmp_path/'features'))
+    calls = []
+    values = np.arange(10,dtype=np.float64)
+    first = cache.column('AAA','sma',(10,),computed(values,calls))
+    second = cache.column('AAA','sma',(10,),computed(values,calls))
+    other = cache.column('AAA','sma',(20,),computed(2*values,calls))
+    assert len(calls) == 2
+    assert cache.stats['hits'] == 1 and cache.stats['misses'] == 2
+    np.testing.assert_array_equal(first,values)
+    np.testing.assert_array_equal(second,values)
+    np.testing.assert_array_equal(other,2*values)
+    assert cache.stats['bytes_written'] == 2*values.nbytes and cache.stats['bytes_read'] == values.nbytes
+
+
+def test_evicts_least_recently_used_first(tmp_path):
+    cache = FeatureCache(str(tmp_path/'features'))
+    values = np.zeros(100)
+    paths = {}
+    for k,name in enumerate(['a','b','c']):
+        cache.column('AAA',name,(),lambda: values)
+        paths[name] = cache.entry_path('AAA',name)
+        os.utime(paths[name],ns=(k*10**9,k*10**9)) # a used first, c last
+    cache.get(paths['a']) # a becomes the most recently used
+    size = os.path.getsize(paths['a'])
+    assert cache.evict(max_bytes=2*size) == 2*size
+    assert not os.path.exists(paths['b'])
+    assert os.path.exists(paths['a']) and os.path.exists(paths['c'])
+    assert cache.evict(max_bytes=size) == size
+    assert os.path.exists(paths['a']) and not os.path.exists(paths['c'])
+    assert cache.stats['evictions'] == 2
+
+
+def test_entries_evicted_by_another_process(tmp_path, monkeypatch):
+    cache = FeatureCache(str(tmp_path/'features'))
+    cache.column('AAA','sma',(10,),lambda: np.ones(5))
+    path = cache.entry_path('AAA','sma',(10,))
+    # the file is removed between the load and the access time update
+    load = np.load
+    def load_then_evict(*args, **kwargs):
+        values = load(*args,**kwargs)
+        os.remove(path)
+        return values
+    monkeypatch.setattr(np,'load',load_then_evict)
+    assert cache.get(path) is None
+    monkeypatch.setattr(np,'load',load)
+    assert cache.entries() == []
+    np.testing.assert_array_equal(cache.column('AAA','sma',(10,),lambda: np.ones(5)),np.ones(5))
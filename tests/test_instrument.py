@@ -0,0 +1,32 @@
+import json
+import numpy as np
+
+from backtest import run_backtest
+from instrument import Log2Histogram
+
+SYMBOLS = ['AAA','BBB','CCC','DDD','EEE']
+
+
+def test_histogram_percentiles():
+    h = Log2Histogram()
+    for value in range(1,1001):
+        h.add(value)
+    assert h.count == 1000 and h.min == 1 and h.max == 1000
+    assert 256 <= h.percentile(50) <= 512
+    assert h.percentile(100) == 1000
+
+def test_instrumented_run_matches_plain_run(database, tmp_path):
+    config = {'symbols':SYMBOLS,'csv_path':database,'quiet':True,'mode':'tail','tail_count':60,
+              'checkpoint_dir':str(tmp_path/'checkpoints'),'checkpoint_every':50}
+    plain = run_backtest(config)
+    trace_file = str(tmp_path/'trace.json')
+    instrumented = run_backtest(dict(config,instrument=True,trace_file=trace_file))
+    np.testing.assert_array_equal(plain['portfolio_value'].values,instrumented['portfolio_value'].values)
+    with open(trace_file) as f:
+        events = json.load(f)['traceEvents']
+    names = set(e['name'] for e in events)
+    assert {'AlpacaDataFrame.update_bars','Checkpointer.tick','queue depth',
+            'PortfolioSharpeMaximization.calculate_signals'} <= names
+    # one queue depth sample per update_bars call: 300 bars, plus the call that ends the run
+    assert sum(e['name'] == 'AlpacaDataFrame.update_bars' for e in events) == 301
+    assert sum(e['name'] == 'queue depth' for e in events) == 301
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+from moments import ReturnMomentsEstimator
+from walkforward import ClosesView
+from conftest import random_closes
+
+
+def pandas_moments(closes, symbols, cursor, tail_count=None):
+    # what PortfolioSharpeMaximization computed from latest_symbol_data before the running estimator
+    log_ret = {}
+    for k,s in enumerate(symbols):
+        close = pd.Series(closes[k,:cursor])
+        if tail_count is not None:
+            close = close.tail(tail_count)
+        log_ret[s] = np.log(close/close.shift(1)).dropna()
+    log_ret = pd.DataFrame(log_ret)
+    return log_ret.mean().values, log_ret.cov().values
+
+def gapped_closes():
+    # a late listing, a halt and scattered missing closes
+    closes = random_closes(4,300,seed=3)
+    closes[1,:80] = np.nan
+    closes[2,150:170] = np.nan
+    rng = np.random.default_rng(7)
+    closes[3,rng.choice(300,25,replace=False)] = np.nan
+    closes[0,5] = np.nan
+    return closes
+
+def check_estimator(closes, tail_count, steps):
+    symbols = ['A','B','C','D']
+    bars = ClosesView(symbols,closes)
+    estimator = ReturnMomentsEstimator(bars,symbols,tail_count)
+    for cursor in steps:
+        bars.cursor = cursor
+        estimator.update()
+        mean, cov = pandas_moments(closes,symbols,cursor,tail_count)
+        np.testing.assert_allclose(estimator.mean,mean,rtol=1e-9,atol=1e-15)
+        np.testing.assert_allclose(estimator.cov(),cov,rtol=1e-7,atol=1e-15)
+
+
+def test_expanding_window_matches_pandas_pairwise():
+    check_estimator(gapped_closes(),None,[60]+list(range(61,300)))
+
+def test_fixed_window_matches_pandas_pairwise():
+    check_estimator(gapped_closes(),30,[60]+list(range(61,300,1)))
+    check_estimator(gapped_closes(),30,list(range(40,300,7)))
+
+def test_complete_panel():
+    check_estimator(random_closes(4,200,seed=5),None,[50]+list(range(51,200)))
+    check_estimator(random_closes(4,200,seed=5),20,[50]+list(range(51,200)))
+
+def test_state_round_trip():
+    closes = gapped_closes()
+    symbols = ['A','B','C','D']
+    bars = ClosesView(symbols,closes)
+    estimator = ReturnMomentsEstimator(bars,symbols,30)
+    bars.cursor = 150
+    estimator.update()
+    restored = ReturnMomentsEstimator(bars,symbols,30)
+    restored.set_state(estimator.get_state())
+    for cursor in range(151,300):
+        bars.cursor = cursor
+        estimator.update()
+        restored.update()
+        np.testing.assert_array_equal(restored.mean,estimator.mean)
+        np.testing.assert_array_equal(restored.cov(),estimator.cov())
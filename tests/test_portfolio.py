@@ -0,0 +1,50 @@
+import os, os.path
+import numpy as np
+import pandas as pd
+
+from backtest import run_backtest
+from checkpoint import LATEST, latest_checkpoint
+from conftest import write_database
+
+SYMBOLS = ['AAA','BBB','CCC','DDD','EEE']
+
+
+def assert_same_run(expected, result):
+    pd.testing.assert_frame_equal(expected['portfolio_value'],result['portfolio_value'])
+    assert expected['summary']['final_value'] == result['summary']['final_value']
+
+
+def test_spilled_ledger_matches_in_memory_ledger(database):
+    config = {'symbols':SYMBOLS,'csv_path':database,'quiet':True,'mode':'tail','tail_count':60}
+    in_memory = run_backtest(config)
+    spilled = run_backtest(dict(config,ledger_rows=16))
+    assert_same_run(in_memory,spilled)
+
+
+def test_intraday_daily_values_with_a_spilled_ledger(tmp_path):
+    database = write_database(str(tmp_path/'db'),SYMBOLS,n_bars=1200,interval='1Min')
+    config = {'symbols':SYMBOLS,'csv_path':database,'interval':'1Min','quiet':True,'mode':'tail','tail_count':60}
+    in_memory = run_backtest(config)
+    spilled = run_backtest(dict(config,ledger_rows=50))
+    assert_same_run(in_memory,spilled)
+    pd.testing.assert_frame_equal(in_memory['daily_value'],spilled['daily_value'])
+
+
+def test_stream_feed_matches_memory_feed(database):
+    config = {'symbols':SYMBOLS,'csv_path':database,'quiet':True,'mode':'tail','tail_count':60}
+    memory = run_backtest(config)
+    stream = run_backtest(dict(config,feed='stream',chunk_size=32))
+    assert_same_run(memory,stream)
+
+
+def test_resume_with_a_spilled_ledger(database, tmp_path):
+    folder = str(tmp_path/'checkpoints')
+    config = {'symbols':SYMBOLS,'csv_path':database,'quiet':True,'mode':'tail','tail_count':60,
+              'ledger_rows':16,'checkpoint_dir':folder,'checkpoint_every':40}
+    uninterrupted = run_backtest(config)
+    # resume from the checkpoint before the latest one, as if the run stopped there
+    number = latest_checkpoint(folder)
+    with open(os.path.join(folder,LATEST),'w') as f:
+        f.write(str(number-1))
+    resumed = run_backtest(dict(config,resume=True))
+    assert_same_run(uninterrupted,resumed)
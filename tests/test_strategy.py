@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from scipy.optimize import minimize
+
+from conftest import random_closes
+from strategy import PortfolioSharpeMaximization
+
+
+def optimizer():
+    # only the optimizer functions are needed, they use no strategy state
+    return PortfolioSharpeMaximization.__new__(PortfolioSharpeMaximization)
+
+def moments(n_symbols, start, stop, seed=0):
+    log_ret = np.diff(np.log(random_closes(n_symbols,stop,seed)[:,start:stop]),axis=1).T
+    return log_ret.mean(axis=0), np.cov(log_ret,rowvar=False)
+
+def solve(strategy, mean, cov, init_guess, analytic):
+    cons = ({'type':'eq','fun':strategy.check_sum,'jac':strategy.check_sum_jac})
+    if analytic:
+        fun, jac = strategy.neg_sharpe_grad, True
+    else:
+        fun, jac = strategy.neg_sharpe, None # finite differences, as before the analytic gradient
+    return minimize(fun,x0=init_guess,args=(mean,cov),jac=jac,method='SLSQP',
+                    bounds=[(0,1)]*len(mean),constraints=cons).x
+
+
+@pytest.mark.parametrize('seed',range(5))
+def test_neg_sharpe_grad_matches_finite_differences(seed):
+    strategy = optimizer()
+    mean, cov = moments(6,0,120,seed)
+    weights = np.random.default_rng(seed).dirichlet(np.ones(6))
+    value, grad = strategy.neg_sharpe_grad(weights,mean,cov)
+    assert value == pytest.approx(strategy.neg_sharpe(weights,mean,cov),rel=1e-12)
+    step = 1e-6
+    numeric = np.array([(strategy.neg_sharpe(weights+step*e,mean,cov)-strategy.neg_sharpe(weights-step*e,mean,cov))/(2*step)
+                        for e in np.eye(6)])
+    np.testing.assert_allclose(grad,numeric,rtol=1e-5,atol=1e-7)
+
+def test_analytic_gradient_solves_land_on_the_numeric_weights():
+    # a tail window moved along the series, solved cold and warm-started from the previous window's weights,
+    # each against the finite-difference solve from the same starting point
+    strategy = optimizer()
+    n_symbols = 5
+    equal = np.full(n_symbols,1/n_symbols)
+    warm = equal
+    for stop in range(80,400,40):
+        mean, cov = moments(n_symbols,stop-60,stop,seed=3)
+        cold = solve(strategy,mean,cov,equal,analytic=True)
+        np.testing.assert_allclose(cold,solve(strategy,mean,cov,equal,analytic=False),atol=1e-6)
+        baseline = solve(strategy,mean,cov,warm,analytic=False)
+        warm = solve(strategy,mean,cov,warm,analytic=True)
+        np.testing.assert_allclose(warm,baseline,atol=1e-6)
+        # warm and cold stop within the solver's tolerance of the same sharpe
+        assert strategy.neg_sharpe(warm,mean,cov) == pytest.approx(strategy.neg_sharpe(cold,mean,cov),abs=1e-6)
@@ -0,0 +1,77 @@
+import os, os.path
+import numpy as np
+import pytest
+
+from broker import BasicBroker
+from event import EventQueue
+from data import AlpacaDataFrame
+from portfolio import SamplePortfolio
+from strategy import TargetSharesStrategy, PortfolioSharpeMaximization
+from backtest import run_event_loop
+from vectorized import VectorizedBacktest
+from walkforward import build_schedule
+
+DATABASE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'database')
+SYMBOLS = ['AAPL','AMD','CSCO','FB','INTC','NFLX','NVDA','TSLA']
+
+
+def sample_target_shares(closes, lookback=30, rebalance=30, dollars=5000.0):
+    # simple momentum target: every `rebalance` rows hold `dollars` worth of each symbol
+    # that is up over the last `lookback` rows, nothing otherwise
+    target = np.zeros_like(closes)
+    for t in range(1,len(closes)):
+        target[t] = target[t-1]
+        if t % rebalance == 0 and t >= lookback:
+            up = closes[t] > closes[t-lookback]
+            new_target = np.where(up,np.floor(dollars/closes[t]),0.0)
+            tradable = np.isfinite(closes[t]) & np.isfinite(new_target)
+            target[t] = np.where(tradable,new_target,target[t-1])
+    return target
+
+@pytest.fixture
+def bundled_database(tmp_path):
+    # bundled csvs are not split into interval folders, so link them into one
+    os.makedirs(tmp_path/'1min')
+    for s in SYMBOLS:
+        os.symlink(os.path.join(DATABASE,s+'.csv'),tmp_path/'1min'/(s+'.csv'))
+    return str(tmp_path)
+
+def assert_same_ledger(evented, vectorized, rtol=1e-9):
+    np.testing.assert_array_equal(evented.position,vectorized.position)
+    np.testing.assert_allclose(evented.value,vectorized.value,rtol=rtol)
+    np.testing.assert_allclose(evented.cash,vectorized.cash,rtol=rtol)
+    np.testing.assert_allclose(evented.total,vectorized.total,rtol=rtol)
+
+
+@pytest.mark.parametrize('batched',[True,False])
+def test_target_shares_match_event_loop(bundled_database, batched):
+    Events = EventQueue()
+    DataFrame = AlpacaDataFrame(events = Events, csv_path = bundled_database, symbols = SYMBOLS,
+                                interval = '1Min', use_cache = False, update = False)
+    engine = VectorizedBacktest(DataFrame)
+    target = sample_target_shares(engine.closes)
+    vectorized = engine.run_shares(target)
+    Portfolio = SamplePortfolio(bars = DataFrame, events = Events)
+    Strategy = TargetSharesStrategy(bars = DataFrame, events = Events, portfolio = Portfolio,
+                                    target_shares = target, batched = batched)
+    run_event_loop(DataFrame,Events,Portfolio,Strategy,BasicBroker(events = Events))
+    assert Portfolio.fill_count > 0
+    assert_same_ledger(Portfolio.ledger,vectorized)
+
+def test_weights_match_sharpe_strategy(database):
+    # the strategy trading a walk-forward schedule's weights vs run_weights on the same weights
+    Events = EventQueue()
+    DataFrame = AlpacaDataFrame(events = Events, csv_path = database, symbols = ['AAA','BBB','CCC','DDD','EEE'],
+                                interval = '1D', update = False)
+    schedule = build_schedule(DataFrame,mode = 'tail',tail_count = 60,warm_start = False)
+    engine = VectorizedBacktest(DataFrame)
+    weights = np.zeros_like(engine.closes)
+    weights[1:] = schedule.weights # ledger row 0 is the latest warm-up bar
+    vectorized = engine.run_weights(weights,allocations_pct = 0.8)
+    Portfolio = SamplePortfolio(bars = DataFrame, events = Events)
+    Strategy = PortfolioSharpeMaximization(bars = DataFrame, events = Events, portfolio = Portfolio,
+                                           mode = 'tail', tail_count = 60, allocations_pct = 0.8,
+                                           warm_start = False, schedule = schedule)
+    run_event_loop(DataFrame,Events,Portfolio,Strategy,BasicBroker(events = Events))
+    assert Portfolio.fill_count > 0
+    assert_same_ledger(Portfolio.ledger,vectorized)
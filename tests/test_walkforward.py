@@ -0,0 +1,31 @@
+import contextlib
+import io
+import warnings
+import numpy as np
+import pytest
+
+from data import AlpacaDataFrame
+from event import EventQueue
+from walkforward import build_schedule
+
+SYMBOLS = ['AAA','BBB','CCC','DDD','EEE']
+
+
+def schedule(database, **kwargs):
+    DataFrame = AlpacaDataFrame(events=EventQueue(),csv_path=database,symbols=list(SYMBOLS),interval='1D',
+                                update=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return build_schedule(DataFrame,mode='tail',tail_count=60,**kwargs)
+
+
+def test_warm_started_exact_schedule_warns_when_workers_are_ignored(database):
+    with pytest.warns(UserWarning,match='workers=2 ignored'):
+        parallel = schedule(database,warm_start=True,workers=2)
+    np.testing.assert_array_equal(parallel.weights,schedule(database,warm_start=True).weights)
+
+
+def test_cold_schedule_is_spread_over_workers_without_a_warning(database):
+    with warnings.catch_warnings():
+        warnings.simplefilter('error',UserWarning)
+        parallel = schedule(database,warm_start=False,workers=2)
+    np.testing.assert_array_equal(parallel.weights,schedule(database,warm_start=False).weights)
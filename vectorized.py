@@ -0,0 +1,80 @@
+import numpy as np
+
+from portfolio import PortfolioLedger
+
+
+# ------------------------------------------------------------------------------------------------------
+# VECTORIZED BACKTEST ENGINE
+# computes positions, cash, per-symbol values and total value for the whole history at once,
+# from the aligned price panel of an AlpacaDataFrame and a target share (or weight) matrix.
+# Fill semantics are the same as BasicBroker + SamplePortfolio.update_portfolio:
+# MARKET orders fill at the close of the bar they were placed on, with no commission.
+# ------------------------------------------------------------------------------------------------------
+class VectorizedBacktest(object):
+
+    def __init__(self, bars, initial_balance=100000.0):
+        # rows line up with SamplePortfolio's ledger: row 0 is the latest warm-up bar (no trading),
+        # every following row is one bar the event loop would update
+        self.bars = bars
+        if self.bars.bar_data is None:
+            raise ValueError('the vectorized engine needs the whole history in memory (AlpacaDataFrame)')
+        self.symbols = list(self.bars.symbols)
+        self.initial_balance = initial_balance
+        self.start = self.bars.cursor-1
+        self.stamps = self.bars.timestamps[self.start:]
+        self.closes = self.bars.bar_data[:,self.start:,self.bars.fields.index('close')].T # rows x symbols
+
+    def run_shares(self, target_shares):
+        # target_shares: rows x symbols positions held after each bar's orders were filled
+        positions = np.array(target_shares,dtype=np.float64)
+        if positions.shape != self.closes.shape:
+            raise ValueError('target_shares needs shape '+str(self.closes.shape)+', got '+str(positions.shape))
+        positions[0] = 0.0 # nothing is traded on the warm-up bar
+        trades = np.diff(positions,axis=0,prepend=np.zeros((1,len(self.symbols))))
+        trade_cost = np.where(trades != 0,trades*self.closes,0.0)
+        cash = self.initial_balance - np.cumsum(trade_cost.sum(axis=1))
+        return self.build_ledger(positions,cash)
+
+    def run_weights(self, target_weights, allocations_pct=1):
+        # target_weights: rows x symbols fraction of total portfolio value to hold after each bar,
+        # traded like PortfolioSharpeMaximization does (calculate_allocations_plan and its signals):
+        # whole shares, sells first, and a buy only goes through when the cash plus what the sells
+        # bring back covers that symbol's allocation. A bar where any symbol has no price (or weight)
+        # gives no portfolio value, so nothing is traded on it.
+        # Share counts depend on the portfolio value reached so far, so this walks the rows once,
+        # with every row computed across all symbols at once
+        weights = np.asarray(target_weights,dtype=np.float64)
+        if weights.shape != self.closes.shape:
+            raise ValueError('target_weights needs shape '+str(self.closes.shape)+', got '+str(weights.shape))
+        positions = np.zeros_like(self.closes)
+        cash = np.empty(len(self.closes))
+        cash[0] = self.initial_balance
+        for t in range(1,len(self.closes)):
+            close = self.closes[t]
+            current = positions[t-1]
+            # summed in symbol order, like the strategy
+            portfolio_value = np.add.accumulate(np.concatenate([[cash[t-1]],current*close]))[-1]
+            value_allocations = np.round(allocations_pct*portfolio_value*weights[t],6)
+            target = np.floor(value_allocations/close)
+            shares = np.abs(target-current)
+            sells = np.flatnonzero((current > target) & (shares != 0))
+            buying_power = np.add.accumulate(np.concatenate([[cash[t-1]],shares[sells]*close[sells]]))[-1]
+            affordable = ~(buying_power < np.abs(value_allocations))
+            buys = np.flatnonzero(affordable & (current < target) & (shares != 0))
+            columns = np.concatenate([sells,buys])
+            positions[t] = current
+            positions[t,columns] = target[columns]
+            trades = target[columns] - current[columns]
+            cash[t] = np.subtract.accumulate(np.concatenate([[cash[t-1]],trades*close[columns]]))[-1]
+        return self.build_ledger(positions,cash)
+
+    def build_ledger(self, positions, cash):
+        # results are returned in a PortfolioLedger, same layout as SamplePortfolio.ledger
+        ledger = PortfolioLedger(self.symbols,self.stamps,self.initial_balance,self.start)
+        ledger.position[:] = positions
+        ledger.close[:] = self.closes
+        np.multiply(positions,self.closes,out=ledger.value)
+        ledger.cash[:] = cash
+        ledger.total[:] = np.nansum(ledger.value,axis=1) + cash
+        ledger.row = len(cash)-1
+        return ledger
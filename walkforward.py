@@ -0,0 +1,145 @@
+import time
+import warnings
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+
+# ------------------------------------------------------------------------------------------------------
+# WALK-FORWARD ALLOCATION SCHEDULE
+# PortfolioSharpeMaximization's optimal weights only depend on price history, so they can be solved for
+# every rebalance bar ahead of the backtest: the bars are split into contiguous chunks solved across a
+# process pool, each worker replaying the strategy's own moments estimator and optimizer over a closes
+# array, and the weights are kept as one compact (bars x symbols) array. During the run
+# calculate_allocations_plan only looks up the row of the bar (strategy.schedule).
+# Without warm_start every solve is independent and the chunks give exactly the inline solver's weights.
+# With warm_start each solve starts from the previous bar's weights, a chain that only stays exact in one
+# process: exact=False still splits it, every chunk but the first starting from equal weights, which moves
+# the weights within the solver's tolerance (and can change a share count here and there).
+# ------------------------------------------------------------------------------------------------------
+
+class ClosesView(object):
+
+    # the part of the dataframe interface the moments estimator and the optimizer read, over closes only
+
+    def __init__(self, symbols, closes):
+        self.symbols = list(symbols)
+        self.symbol_index = {s:i for i,s in enumerate(self.symbols)}
+        self.fields = ['close']
+        self.bars = np.ascontiguousarray(closes,dtype=np.float64)[:,:,None] # symbols x time x 1
+        self.cursor = 0
+
+    def set_lookback(self, lookback):
+        pass
+
+    def get_bar_window(self, start, stop):
+        return self.bars[:,start:stop]
+
+
+class AllocationSchedule(object):
+
+    def __init__(self, symbols, start, weights, iterations=None, evaluations=None, solve_time=None,
+                mode='full', tail_count=None):
+        self.symbols = list(symbols)
+        self.start = start # bar number of row 0
+        self.weights = weights # bars x symbols, weights held after each bar's rebalance
+        n = len(weights)
+        self.iterations = np.zeros(n,dtype=np.int64) if iterations is None else iterations
+        self.evaluations = np.zeros(n,dtype=np.int64) if evaluations is None else evaluations
+        self.solve_time = np.zeros(n,dtype=np.float64) if solve_time is None else solve_time
+        self.mode = mode
+        self.tail_count = tail_count
+
+    def __contains__(self, bar):
+        return self.start <= bar < self.start + len(self.weights)
+
+    def matches(self, symbols, mode, tail_count):
+        # whether the schedule was solved for this strategy setup
+        return (list(symbols) == self.symbols and mode == self.mode
+                and (mode == 'full' or tail_count == self.tail_count))
+
+    def row(self, bar):
+        return bar - self.start
+
+    def save(self, npz_file):
+        np.savez(npz_file,symbols=np.array(self.symbols),start=self.start,weights=self.weights,
+                 iterations=self.iterations,evaluations=self.evaluations,solve_time=self.solve_time,
+                 mode=self.mode,tail_count=-1 if self.tail_count is None else self.tail_count)
+        return npz_file
+
+    @classmethod
+    def load(cls, npz_file):
+        with np.load(npz_file,allow_pickle=False) as f:
+            tail_count = int(f['tail_count'])
+            return cls(f['symbols'].tolist(),int(f['start']),f['weights'],f['iterations'],f['evaluations'],
+                       f['solve_time'],str(f['mode']),None if tail_count < 0 else tail_count)
+
+
+def solve_chunk(symbols, closes, first, start, stop, mode, tail_count, warm_start, every):
+    # worker: weights of bars [start, stop), replaying the moments estimator from the first market bar
+    from strategy import PortfolioSharpeMaximization
+    bars = ClosesView(symbols,closes)
+    strategy = PortfolioSharpeMaximization(bars,None,None,mode=mode,tail_count=tail_count,warm_start=warm_start)
+    n = stop - start
+    weights = np.full((n,len(symbols)),np.nan)
+    iterations = np.zeros(n,dtype=np.int64)
+    evaluations = np.zeros(n,dtype=np.int64)
+    solve_time = np.zeros(n,dtype=np.float64)
+    for bar in range(first,stop):
+        bars.cursor = bar + 1 # the bar's MarketEvent comes after update_bars
+        strategy.moments.update()
+        if bar < start or (bar - first) % every != 0:
+            continue
+        stats = dict(strategy.solver_stats)
+        allocations = strategy.calculate_optimal_allocations(symbols,mode,tail_count)
+        r = bar - start
+        weights[r] = allocations['LONG'].loc[symbols].values
+        iterations[r] = strategy.solver_stats['iterations'] - stats['iterations']
+        evaluations[r] = strategy.solver_stats['evaluations'] - stats['evaluations']
+        solve_time[r] = strategy.solver_stats['solve_time'] - stats['solve_time']
+    return start, weights, iterations, evaluations, solve_time
+
+
+def build_schedule(bars, mode='full', tail_count=None, warm_start=True, workers=None, every=1, chunk_size=None,
+                  exact=True):
+    # weights for every bar after the dataframe's warm-up (its first MarketEvent onwards),
+    # re-solved every `every` bars and held in between
+    if bars.bar_data is None:
+        raise ValueError('the walk-forward schedule needs the whole history in memory (AlpacaDataFrame)')
+    symbols = list(bars.symbols)
+    closes = bars.bar_data[:,:,bars.fields.index('close')]
+    first = bars.cursor
+    n_bars = closes.shape[1]
+    workers = max(workers or 1,1)
+    if warm_start and exact:
+        # one warm-started chain: every solve starts from the previous bar's weights
+        if workers > 1:
+            warnings.warn('build_schedule: warm_start with exact=True solves one chain, workers='+str(workers)+
+                          ' ignored (pass warm_start=False or exact=False to spread it over processes)')
+        workers, chunk_size = 1, None
+    if chunk_size is None:
+        chunk_size = max(-(-(n_bars-first)//workers),1)
+    bounds = [(a,min(a+chunk_size,n_bars)) for a in range(first,n_bars,chunk_size)]
+    weights = np.full((n_bars-first,len(symbols)),np.nan)
+    iterations = np.zeros(n_bars-first,dtype=np.int64)
+    evaluations = np.zeros(n_bars-first,dtype=np.int64)
+    solve_time = np.zeros(n_bars-first,dtype=np.float64)
+    start_time = time.perf_counter()
+    def collect(result):
+        a, w, it, ev, st = result
+        rows = slice(a-first,a-first+len(w))
+        weights[rows], iterations[rows], evaluations[rows], solve_time[rows] = w, it, ev, st
+    if workers == 1 or len(bounds) == 1:
+        for a,b in bounds:
+            collect(solve_chunk(symbols,closes[:,:b],first,a,b,mode,tail_count,warm_start,every))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(solve_chunk,symbols,closes[:,:b],first,a,b,mode,tail_count,warm_start,every)
+                       for a,b in bounds]
+            for f in futures:
+                collect(f.result())
+    # bars between rebalances hold the last solved weights
+    solved = np.flatnonzero((np.arange(n_bars-first) % every) == 0)
+    weights = weights[solved[np.searchsorted(solved,np.arange(n_bars-first),side='right')-1]]
+    print('---|WALK-FORWARD SCHEDULE:',len(solved),'SOLVES OVER',len(bounds),'CHUNK(S) IN',
+          round(time.perf_counter()-start_time,2),'s|---')
+    return AllocationSchedule(symbols,first,weights,iterations,evaluations,solve_time,mode,tail_count)